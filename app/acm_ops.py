@@ -1,16 +1,26 @@
 import boto3
+import json
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from app.boto_factory import BotoFactory
+from app.json_cache import CACHE_DIR
+from app.region_ops import region_resolver
+
+ACM_MAX_WORKERS = 8
+ACM_ROLE = os.getenv('ACM_ROLE', 'AxisCloudAdmin')
 
 
 class ACMOps():
 
-    def __init__(self, session, account_id, regions='', certificate_status=''):
+    def __init__(self, session, account_id, regions='', certificate_status='',
+                 rolename=''):
         if regions == '':
-            regions = set(session.get_available_regions('acm'))
-            regions.discard('ap-east-1')    # discard hongkong
-            regions.discard('me-south-1')   # discard bahrain
-            self.regions = list(regions)
+            # only regions enabled in the account, opt-in regions that are
+            # not enabled would fail on every call
+            self.regions = region_resolver.enabled_regions(
+                session, account_id, 'acm')
         elif not isinstance(regions, list):
             raise TypeError('Regions must be given in a list')
         else:
@@ -28,36 +38,194 @@ class ACMOps():
         self.session = session
         self.account_id = account_id
         self.filters = certificate_status
+        self.rolename = rolename or ACM_ROLE
 
     def get_all_email_validated_certs(self):
         """returns an ARN list of all ACM certificates with email validation"""
         certificates = list()
         for r in self.regions:
-            logging.info(f"Processing {self.account_id}:{r}")
             try:
-                acm = BotoFactory().get_capability(
-                    boto3.client, self.session, 'acm',
-                    account_id=self.account_id, region=r, rolename='AxisCloudAdmin'
-                )
-
-                pngt = acm.get_paginator('list_certificates')
-                itr = pngt.paginate(
-                    CertificateStatuses=self.certificate_status
-                )
-                for i in itr:
-                    for c in i.get('CertificateSummaryList'):
-                        result = (
-                            acm.describe_certificate(
-                                CertificateArn=c.get('CertificateArn')
-                            )
-                        )
-                        validations_opts = result.get(
-                            'Certificate').get(
-                                'DomainValidationOptions')
-                        for v in validations_opts:
-                            if v.get('ValidationMethod') == 'EMAIL':
-                                certificates.append(c.get('CertificateArn'))
+                certificates += self.get_email_validated_certs(r)
             except Exception as e:
                 logging.error(f"{e} for {r}")
         logging.info(certificates)
         return certificates
+
+    def get_email_validated_certs(self, region):
+        """returns an ARN list of the ACM certificates with email validation
+        in one region"""
+        return [
+            c['CertificateArn'] for c in self.query_certificates(
+                lambda c: 'EMAIL' in c['ValidationMethods'], [region])
+        ]
+
+    def query_certificates(self, predicate, regions=None):
+        """
+        returns the certificate records of the given regions (all regions by
+        default) for which predicate(record) is true, e.g.
+        query_certificates(lambda c: c['Status'] == 'EXPIRED')
+        """
+        certificates = list()
+        for r in self.regions if regions is None else regions:
+            try:
+                certificates += [
+                    c for c in self.describe_certificates(r) if predicate(c)
+                ]
+            except Exception as e:
+                logging.error(f"{e} for {r}")
+        return certificates
+
+    def describe_certificates(self, region, max_workers=ACM_MAX_WORKERS):
+        """
+        Returns one record per certificate in a region, combining the
+        current list_certificates summary with the describe_certificate
+        attributes that never change for an ARN. Those are kept in an on-disk
+        cache, so only certificates that were never seen before are
+        described, concurrently. A certificate re-imported or renewed under
+        the same ARN is described again:
+
+        {
+            "AccountId": "123456789012",
+            "Region": "eu-west-1",
+            "CertificateArn": "arn:aws:acm:eu-west-1:...:certificate/...",
+            "DomainName": "example.com",
+            "Status": "ISSUED",
+            "NotAfter": "2021-01-01 00:00:00+00:00",
+            "InUse": true,
+            "Type": "AMAZON_ISSUED",
+            "KeyAlgorithm": "RSA-2048",
+            "SubjectAlternativeNames": ["example.com"],
+            "ValidationMethods": ["EMAIL"]
+        }
+        """
+        logging.info(f"Processing {self.account_id}:{region}")
+        acm = BotoFactory().get_capability(
+            boto3.client, self.session, 'acm',
+            account_id=self.account_id, region=region,
+            rolename=self.rolename
+        )
+
+        pngt = acm.get_paginator('list_certificates')
+        summaries = pngt.paginate(
+            CertificateStatuses=self.certificate_status
+        ).build_full_result()['CertificateSummaryList']
+
+        unknown = [
+            c['CertificateArn'] for c in summaries
+            if certificate_cache.get(c['CertificateArn'], c) is None
+        ]
+        if unknown:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                described = executor.map(
+                    lambda arn: acm.describe_certificate(
+                        CertificateArn=arn)['Certificate'],
+                    unknown
+                )
+                for certificate in described:
+                    certificate_cache.put(certificate)
+            certificate_cache.save()
+
+        certificates = list()
+        for c in summaries:
+            static = certificate_cache.get(c['CertificateArn'])
+            certificates.append(dict(
+                static,
+                AccountId=self.account_id,
+                Region=region,
+                Status=c.get('Status'),
+                NotAfter=c.get('NotAfter'),
+                InUse=c.get('InUse')
+            ))
+        return certificates
+
+
+def _freshness(certificate):
+    """what changes when a certificate is re-imported or renewed under the
+    same ARN, from a summary or a description"""
+    return [
+        None if certificate.get(key) is None else str(certificate[key])
+        for key in ('ImportedAt', 'NotAfter')
+    ]
+
+
+class CertificateCache():
+    """
+    On-disk cache of the describe_certificate attributes that are fixed
+    when a certificate is requested or imported, keyed by certificate ARN.
+    An entry is only used while its ImportedAt and NotAfter match the
+    list_certificates summary. New entries are appended to the file, so a
+    save writes what was added since the last one and not the whole cache.
+    """
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'acm_certificates.jsonl')):
+        self.path = path
+        self._lock = threading.Lock()
+        self._certificates = None
+        self._unsaved = list()
+
+    def get(self, arn, summary=None):
+        """the cached attributes, None if unknown or if the certificate in
+        summary was re-imported or renewed since"""
+        with self._lock:
+            self.__load()
+            entry = self._certificates.get(arn)
+        if entry is None:
+            return None
+        if summary is not None and entry['Freshness'] != _freshness(summary):
+            return None
+        return entry['Certificate']
+
+    def put(self, certificate):
+        static = {
+            'CertificateArn': certificate['CertificateArn'],
+            'DomainName': certificate.get('DomainName'),
+            'Type': certificate.get('Type'),
+            'KeyAlgorithm': certificate.get('KeyAlgorithm'),
+            'SubjectAlternativeNames':
+                certificate.get('SubjectAlternativeNames', []),
+            'ValidationMethods': sorted({
+                v['ValidationMethod'] for v in
+                certificate.get('DomainValidationOptions', [])
+                if 'ValidationMethod' in v
+            })
+        }
+        entry = {'Certificate': static, 'Freshness': _freshness(certificate)}
+        with self._lock:
+            self.__load()
+            self._certificates[certificate['CertificateArn']] = entry
+            self._unsaved.append(entry)
+
+    def save(self):
+        """appends the entries added since the last save"""
+        with self._lock:
+            if not self._unsaved:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(''.join(
+                    json.dumps(entry) + '\n' for entry in self._unsaved))
+            self._unsaved = list()
+
+    def __load(self):
+        if self._certificates is not None:
+            return
+        self._certificates = dict()
+        try:
+            f = open(self.path)
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning(f"Skipping incomplete line in {self.path}")
+                    continue
+                # later entries of an ARN replace earlier ones
+                self._certificates[
+                    entry['Certificate']['CertificateArn']] = entry
+
+
+certificate_cache = CertificateCache()
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+import os
+from functools import partial
+from app.boto_factory import RETRIES, credential_cache
+from app.collectors import Collector
+from app.job_runner import GLOBAL, close_outputs, open_outputs
+from app.metrics import metrics
+from app.acm_ops import ACM_ROLE, certificate_cache
+from app.region_ops import region_resolver
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+log = logging.getLogger('parseley')
+
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', 500))
+MAX_IN_FLIGHT_PER_ACCOUNT = 50
+# clients being created at once, each may assume a role first
+MAX_CONNECTING = 20
+
+
+class InFlightLimiter():
+    """
+    Bounds the requests in flight with semaphores instead of threads: one
+    for the whole run and one per account, so a single account with many
+    regions can't use up the run's budget.
+
+    Example usage:
+    async with limiter.slot('123456789012'):
+        await client.describe_subnets()
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT,
+                 max_per_account=MAX_IN_FLIGHT_PER_ACCOUNT):
+        self.max_per_account = max_per_account
+        self._total = asyncio.Semaphore(max_in_flight)
+        self._accounts = dict()
+
+    def slot(self, account_id):
+        if account_id not in self._accounts:
+            self._accounts[account_id] = asyncio.Semaphore(
+                self.max_per_account)
+        return _Slot(self._total, self._accounts[account_id])
+
+
+class _Slot():
+
+    def __init__(self, *semaphores):
+        self.semaphores = semaphores
+
+    async def __aenter__(self):
+        for semaphore in self.semaphores:
+            await semaphore.acquire()
+
+    async def __aexit__(self, *exc_info):
+        for semaphore in reversed(self.semaphores):
+            semaphore.release()
+
+
+class AsyncBotoFactory():
+    """
+    Async counterpart of BotoFactory, hands out aiobotocore clients in any
+    account of the organization. Credentials come from the same cache as
+    the synchronous clients, clients are reused per (service, account,
+    role, region) until their credentials change and are closed by close().
+    At most max_connecting clients are set up at once, the units of a run
+    start together and would otherwise all assume roles and open clients at
+    the same moment. Needs the optional aiobotocore package.
+
+    Example usage:
+    factory = AsyncBotoFactory(boto3.Session())
+    ec2 = await factory.client('ec2', '123456789012', region='eu-west-1')
+    await factory.close()
+
+    Parameters:
+        session (boto3.Session): The session that assumes into the accounts
+        max_pool_connections (int): Connections per client
+        max_connecting (int): Clients set up at once
+    """
+
+    def __init__(self, session, max_pool_connections=MAX_IN_FLIGHT,
+                 max_connecting=MAX_CONNECTING):
+        if get_session is None:
+            raise ImportError(
+                'The async collectors need aiobotocore: '
+                'pip3 install aiobotocore')
+        self.session = session
+        self.config = AioConfig(
+            max_pool_connections=max_pool_connections, retries=RETRIES)
+        self._aio_session = get_session()
+        self._connecting = asyncio.Semaphore(max_connecting)
+        self._locks = dict()
+        self._clients = dict()
+
+    async def client(self, service_name, account_id='', rolename='',
+                     region=''):
+        if region == '':
+            region = os.getenv('DEFAULT_REGION')
+        if account_id == '':
+            account_id = os.getenv('DEFAULT_ACCOUNT')
+        if rolename == '':
+            rolename = os.getenv('DEFAULT_ROLE')
+
+        key = (service_name, account_id, rolename, region)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock, self._connecting:
+            # assume_role is blocking, the cache makes it one call per
+            # account and role for the whole run
+            credentials = await asyncio.get_running_loop().run_in_executor(
+                None, credential_cache.get, self.session, account_id,
+                rolename)
+            entry = self._clients.get(key)
+            if entry is not None:
+                if entry[0]['AccessKeyId'] == credentials['AccessKeyId']:
+                    return entry[1]
+                await entry[1].__aexit__(None, None, None)
+
+            client = await self._aio_session.create_client(
+                service_name,
+                region_name=region,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                config=self.config
+            ).__aenter__()
+            metrics.attach(client, account_id, region)
+            self._clients[key] = (credentials, client)
+            return client
+
+    async def close(self):
+        for _, client in self._clients.values():
+            await client.__aexit__(None, None, None)
+        self._clients.clear()
+
+
+async def paginate(client, operation, result_key, slot, **kwargs):
+    """yields the result_key items of every page, each page request holds
+    a slot of the InFlightLimiter"""
+    pages = client.get_paginator(operation).paginate(**kwargs).__aiter__()
+    while True:
+        async with slot:
+            try:
+                page = await pages.__anext__()
+            except StopAsyncIteration:
+                return
+        for item in page.get(result_key, []):
+            yield item
+
+
+async def _collect(factory, limiter, account_id, region, service,
+                   operation, result_key, rolename='', **kwargs):
+    client = await factory.client(
+        service, account_id, rolename=rolename, region=region or '')
+    return [
+        item async for item in paginate(
+            client, operation, result_key, limiter.slot(account_id),
+            **kwargs)
+    ]
+
+
+async def _vpn_connections(factory, limiter, account_id, region):
+    ec2 = await factory.client('ec2', account_id, region=region)
+    async with limiter.slot(account_id):
+        response = await ec2.describe_vpn_connections()
+    return response['VpnConnections']
+
+
+async def _trails(factory, limiter, account_id, region):
+    cloudtrail = await factory.client('cloudtrail', account_id)
+    async with limiter.slot(account_id):
+        response = await cloudtrail.describe_trails()
+    return response['trailList']
+
+
+async def _acm_certificates(factory, limiter, account_id, region):
+    """same records as ACMOps.describe_certificates, unknown certificates
+    are described concurrently"""
+    rolename = ACM_ROLE
+    acm = await factory.client(
+        'acm', account_id, rolename=rolename, region=region)
+    summaries = await _collect(
+        factory, limiter, account_id, region, 'acm', 'list_certificates',
+        'CertificateSummaryList', rolename=rolename)
+
+    async def describe(arn):
+        async with limiter.slot(account_id):
+            response = await acm.describe_certificate(CertificateArn=arn)
+        certificate_cache.put(response['Certificate'])
+
+    unknown = [
+        c['CertificateArn'] for c in summaries
+        if certificate_cache.get(c['CertificateArn'], c) is None
+    ]
+    if unknown:
+        await asyncio.gather(*[describe(arn) for arn in unknown])
+        # writes the whole cache file, off the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, certificate_cache.save)
+    return [
+        dict(
+            certificate_cache.get(c['CertificateArn']),
+            Status=c.get('Status'),
+            NotAfter=c.get('NotAfter'),
+            InUse=c.get('InUse')
+        ) for c in summaries
+    ]
+
+
+ASYNC_COLLECTORS = {c.name: c for c in [
+    Collector('cfn_stacks', partial(
+        _collect, service='cloudformation', operation='list_stacks',
+        result_key='StackSummaries'),
+        service='cloudformation', table='stacks'),
+    Collector('cfn_stacks_detail', partial(
+        _collect, service='cloudformation', operation='describe_stacks',
+        result_key='Stacks'),
+        service='cloudformation', table='stacks', key='StackId'),
+    Collector('subnets', partial(
+        _collect, service='ec2', operation='describe_subnets',
+        result_key='Subnets'),
+        service='ec2', table='subnets', key='SubnetId'),
+    Collector('vpns', _vpn_connections, service='ec2',
+              table='vpn_connections', key='VpnConnectionId'),
+    Collector('acm_certificates', _acm_certificates, service='acm',
+              table='certificates', key='CertificateArn'),
+    Collector('hosted_zones', partial(
+        _collect, service='route53', operation='list_hosted_zones',
+        result_key='HostedZones'),
+        regional=False, table='hosted_zones', key='Id'),
+    Collector('trails', _trails, regional=False, table='trails',
+              key='TrailARN')
+]}
+
+
+class AsyncJobRunner():
+    """
+    Event loop counterpart of JobRunner: every (collector, account, region)
+    unit is a task on one event loop and concurrency is bounded by an
+    InFlightLimiter instead of a thread pool, so thousands of paginated
+    requests can be in flight at once. Writes the same outputs as
+    JobRunner. Needs the optional aiobotocore package.
+
+    Example usage:
+    runner = AsyncJobRunner(session, ['cfn_stacks', 'subnets'])
+    failures = runner.run(accounts)
+
+    Parameters:
+        session (boto3.Session): The session that assumes into the accounts
+        collector_names (list): Names from ASYNC_COLLECTORS
+        output_dir (str): Where the JSONL outputs are written
+        max_in_flight (int): Requests in flight across the organization
+        max_per_account (int): Requests in flight per account
+        store (InventoryStore): (Optional) Also write to the inventory
+    """
+
+    def __init__(self, session, collector_names, output_dir='out',
+                 max_in_flight=MAX_IN_FLIGHT,
+                 max_per_account=MAX_IN_FLIGHT_PER_ACCOUNT, store=None):
+        unknown = set(collector_names) - set(ASYNC_COLLECTORS)
+        if unknown:
+            raise ValueError(
+                f"No async collectors {sorted(unknown)}, "
+                f"choose from {sorted(ASYNC_COLLECTORS)}")
+        self.session = session
+        self.collectors = [ASYNC_COLLECTORS[name] for name in collector_names]
+        self.output_dir = output_dir
+        self.max_in_flight = max_in_flight
+        self.max_per_account = max_per_account
+        self.store = store
+
+    def run(self, accounts):
+        """collects every requested inventory, returns the failed units as
+        a list of (account, region, collector, exception)"""
+        return asyncio.run(self.__run(list(accounts)))
+
+    async def __run(self, accounts):
+        loop = asyncio.get_running_loop()
+        enabled = dict()
+        if any(c.regional for c in self.collectors):
+            enabled = await loop.run_in_executor(
+                None, region_resolver.resolve, self.session, accounts)
+
+        units = list()
+        for c in self.collectors:
+            if not c.regional:
+                units += [(c, account, GLOBAL) for account in accounts]
+                continue
+            available = set(self.session.get_available_regions(c.service))
+            units += [
+                (c, account, region) for account in accounts
+                for region in enabled.get(account, []) if region in available
+            ]
+
+        factory = AsyncBotoFactory(self.session, self.max_in_flight)
+        limiter = InFlightLimiter(self.max_in_flight, self.max_per_account)
+        sinks, run_ids = open_outputs(
+            self.collectors, self.output_dir, self.store)
+        failures = list()
+
+        async def run_unit(collector, account_id, region):
+            try:
+                with metrics.unit(collector.name, account_id, region):
+                    records = await collector.fetch(
+                        factory, limiter, account_id,
+                        None if region == GLOBAL else region)
+            except Exception as e:
+                log.error(f"{collector.name} {account_id}:{region}: {e}")
+                failures.append((account_id, region, collector.name, e))
+                return
+            # push_many blocks while the sink's buffer is full
+            await loop.run_in_executor(None, sinks[collector.name].push_many, [
+                dict(r, AccountId=account_id, Region=region)
+                for r in records
+            ])
+
+        try:
+            await asyncio.gather(*[run_unit(*unit) for unit in units])
+        finally:
+            await factory.close()
+            close_outputs(sinks, run_ids, self.store)
+        log.info(
+            f"Collected {[c.name for c in self.collectors]} from "
+            f"{len(accounts)} accounts, {len(failures)} failed units")
+        return failures
@@ -1,11 +1,192 @@
 import boto3
 import json
+import logging
 import os
+import threading
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from app.metrics import metrics
+from app.rate_limiter import rate_limiter
+
+log = logging.getLogger('parseley')
+
+DURATION_SECONDS = 900
+REFRESH_MARGIN_SECONDS = 120
+MAX_PREFETCH_WORKERS = 20
+MAX_POOL_CONNECTIONS = int(os.getenv('MAX_POOL_CONNECTIONS', 20))
+RETRIES = {'mode': 'standard', 'max_attempts': 10}
+
+
+def session_key(session):
+    """identifies the source session that assumes roles, so that credentials
+    assumed from different profiles are never mixed up"""
+    credentials = session.get_credentials()
+    access_key = credentials.access_key if credentials else None
+    return (session.profile_name, access_key)
+
+
+class CredentialCache:
+    """
+    Thread-safe cache of assume-role credentials, keyed by
+    (account_id, rolename, source session). Credentials are refreshed when
+    they are less than refresh_margin seconds away from their expiry.
+    """
+
+    def __init__(self, duration_seconds=DURATION_SECONDS,
+                 refresh_margin=REFRESH_MARGIN_SECONDS):
+        self.duration_seconds = duration_seconds
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+        self._credentials = dict()
+        self._sts = dict()
+
+    def get(self, session, account_id, rolename):
+        """returns the Credentials dict of sts.assume_role, assuming the role
+        only if no fresh credentials are cached"""
+        key = (account_id, rolename, session_key(session))
+        credentials = self._fresh(key)
+        if credentials is not None:
+            return credentials
+
+        # one lock per key so concurrent callers wait for a single AssumeRole
+        with self._lock_for(key):
+            credentials = self._fresh(key)
+            if credentials is None:
+                credentials = self._assume_role(session, account_id, rolename)
+                with self._lock:
+                    self._credentials[key] = credentials
+                    # waiters already hold the lock object, later callers
+                    # find the credentials
+                    self._key_locks.pop(key, None)
+        return credentials
+
+    def invalidate(self, account_id=None):
+        """drops cached credentials, for one account or all of them"""
+        with self._lock:
+            for key in list(self._credentials):
+                if account_id is None or key[0] == account_id:
+                    del self._credentials[key]
+
+    def _fresh(self, key):
+        with self._lock:
+            credentials = self._credentials.get(key)
+        if credentials is None:
+            return None
+        if credentials['Expiration'] - datetime.now(timezone.utc) \
+                <= self.refresh_margin:
+            return None
+        return credentials
+
+    def _lock_for(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _assume_role(self, session, account_id, rolename):
+        log.debug(f"Assuming {rolename} in {account_id}")
+        sts = self._sts_client(session)
+        response = sts.assume_role(
+            RoleArn=f"arn:aws:iam::{account_id}:role/{rolename}",
+            RoleSessionName='OrganizationsAccount',
+            DurationSeconds=self.duration_seconds
+        )
+        return response['Credentials']
+
+    def _sts_client(self, session):
+        """one STS client per source session, created under the lock since
+        creating clients from a shared session is not thread-safe"""
+        key = session_key(session)
+        with self._lock:
+            sts = self._sts.get(key)
+            if sts is None:
+                sts = self._sts[key] = session.client(
+                    'sts', config=Config(
+                        max_pool_connections=MAX_PREFETCH_WORKERS,
+                        retries=RETRIES))
+                metrics.attach(sts, 'source', session.region_name)
+        return sts
+
+
+credential_cache = CredentialCache()
+
+
+class ClientRegistry:
+    """
+    Hands out reusable boto3 clients and resources keyed by account, role,
+    region, service and source session. Clients are thread-safe and shared
+    between threads, resources are not and are kept per thread. All of them
+    are created from one shared boto3 session so service models are loaded
+    once, and entries are evicted when the credentials they were built with
+    expire.
+    """
+
+    def __init__(self, max_pool_connections=MAX_POOL_CONNECTIONS):
+        self.config = Config(
+            max_pool_connections=max_pool_connections, retries=RETRIES)
+        self._session = boto3.Session()
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self._entries = dict()
+
+    def set_max_pool_connections(self, max_pool_connections):
+        """sizes the HTTP connection pool of every client, should match the
+        number of worker threads sharing them. Drops existing clients."""
+        with self._lock:
+            self.config = Config(
+                max_pool_connections=max_pool_connections, retries=RETRIES)
+            self._entries.clear()
+
+    def get(self, boto3_capability, session, service_name, account_id,
+            rolename, region):
+        credentials = credential_cache.get(session, account_id, rolename)
+        capability = boto3_capability.__name__
+        key = (capability, service_name, account_id, rolename, region,
+               session_key(session))
+        if capability == 'resource':
+            key += (threading.get_ident(),)
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and \
+                entry[0]['AccessKeyId'] == credentials['AccessKeyId']:
+            return entry[1]
+
+        # creating clients from a shared session is not thread-safe
+        with self._create_lock:
+            capability_fn = getattr(self._session, capability)
+            client = capability_fn(
+                service_name,
+                region_name=region,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                config=self.config
+            )
+        botocore_client = \
+            client.meta.client if capability == 'resource' else client
+        rate_limiter.attach(botocore_client, account_id, region)
+        metrics.attach(botocore_client, account_id, region)
+        with self._lock:
+            self._entries[key] = (credentials, client)
+            self._evict_expired()
+        return client
+
+    def _evict_expired(self):
+        now = datetime.now(timezone.utc)
+        for key in [k for k, (credentials, _) in self._entries.items()
+                    if credentials['Expiration'] <= now]:
+            del self._entries[key]
+
+
+client_registry = ClientRegistry()
 
 
 class BotoFactory:
     """Returns anything boto3 is capable of returning but in a slightly more accessible way in any account
-    available to an AWS organization.
+    available to an AWS organization. Assumed role credentials are cached and reused until shortly before
+    they expire, and clients are shared through a registry for as long as their credentials are valid. Every
+    client is rate limited per API by app.rate_limiter and instrumented by app.metrics.
 
     Example usage:
     BotoFactory().get_capability(boto3.client, boto3.Session(profile_name='default', 'ec2', '123456789012', 'OrganizationsAdmin', region='us-east-1'))
@@ -27,16 +208,33 @@ class BotoFactory:
         if rolename == '':
             rolename = os.getenv('DEFAULT_ROLE')
 
-        sts = session.client('sts')
-        response = sts.assume_role(
-            RoleArn=f"arn:aws:iam::{account_id}:role/{rolename}",
-            RoleSessionName='OrganizationsAccount',
-            DurationSeconds=900
+        return client_registry.get(
+            boto3_capability, session, service_name, account_id, rolename,
+            region
         )
-        return boto3_capability(
-            service_name,
-            region_name=region,
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
\ No newline at end of file
+
+    def prefetch_credentials(self, session, account_ids, rolename='',
+                             max_workers=MAX_PREFETCH_WORKERS):
+        """
+        Warms the credential cache for a list of accounts in parallel, before
+        the real work starts. Returns a dict of account ID to exception for
+        the accounts where the role could not be assumed.
+        """
+        if rolename == '':
+            rolename = os.getenv('DEFAULT_ROLE')
+
+        failed = dict()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                account_id: executor.submit(
+                    credential_cache.get, session, account_id, rolename
+                ) for account_id in account_ids
+            }
+        for account_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                log.warning(
+                    f"Could not assume {rolename} in {account_id}: {e}")
+                failed[account_id] = e
+        return failed
@@ -2,6 +2,9 @@ import boto3
 import logging
 from dotenv import load_dotenv
 from app.boto_factory import BotoFactory
+from app.incremental import signature
+from app.pagination import paginate, tagged
+from app.region_ops import region_resolver
 
 load_dotenv
 logging.basicConfig(level=logging.INFO)
@@ -27,38 +30,67 @@ class CFNOps():
         return False
 
     def all_stacks_all_regions(self):
-        regions = [
-            "eu-north-1",
-            "ap-south-1",
-            "eu-west-3",
-            "eu-west-2",
-            "eu-west-1",
-            "ap-northeast-2",
-            "ap-northeast-1",
-            "sa-east-1",
-            "ca-central-1",
-            "ap-southeast-1",
-            "ap-southeast-2",
-            "eu-central-1",
-            "us-east-1",
-            "us-east-2",
-            "us-west-1",
-            "us-west-2"
+        stacks_inventory = [
+            f"{stack['StackId']}:{stack['StackStatus']}"
+            for stack in self.iter_all_stacks()
         ]
-
-        stacks_inventory = list()
-        for r in regions:
-            regional_cfn = BotoFactory().get_capability(
-                boto3.client, self.session, 'cloudformation',
-                account_id=self.account_id, region=r
-            )
-            pgnt = regional_cfn.get_paginator('list_stacks')
-            itr = pgnt.paginate()
-            for i in itr:
-                for stack in i['StackSummaries']:
-                    log.info(f"{stack['StackId']}:{stack['StackStatus']}")
-                    stacks_inventory.append(
-                        f"{stack['StackId']}:{stack['StackStatus']}")
-
         log.info(stacks_inventory)
         return stacks_inventory
+
+    def iter_all_stacks(self):
+        """yields the list_stacks summaries of every region as their pages
+        arrive, tagged with AccountId and Region"""
+        for r in self.get_all_regions():
+            yield from self.iter_stack_summaries(r)
+
+    def get_all_regions(self):
+        """regions enabled in the account where CloudFormation is
+        available"""
+        return region_resolver.enabled_regions(
+            self.session, self.account_id, 'cloudformation')
+
+    def stacks_in_region(self, region):
+        """returns StackId:StackStatus for every stack in one region"""
+        return [
+            f"{stack['StackId']}:{stack['StackStatus']}"
+            for stack in self.stack_summaries_in_region(region)
+        ]
+
+    def stack_summaries_in_region(self, region):
+        """returns the list_stacks summaries of one region"""
+        summaries = list()
+        for stack in paginate(self.__regional_cfn(region), 'list_stacks'):
+            log.info(f"{stack['StackId']}:{stack['StackStatus']}")
+            summaries.append(stack)
+        return summaries
+
+    def iter_stack_summaries(self, region):
+        """yields the list_stacks summaries of one region, tagged with
+        AccountId and Region"""
+        return tagged(paginate(self.__regional_cfn(region), 'list_stacks'),
+                      self.account_id, region)
+
+    def describe_stacks_in_region(self, region):
+        """returns the full describe_stacks details of one region, deleted
+        stacks are not included"""
+        return list(paginate(self.__regional_cfn(region), 'describe_stacks'))
+
+    def iter_stacks(self, region):
+        """yields the describe_stacks details of one region as their pages
+        arrive, tagged with AccountId and Region"""
+        return tagged(paginate(self.__regional_cfn(region), 'describe_stacks'),
+                      self.account_id, region)
+
+    def stack_signature(self, region):
+        """cheap change signature of one region, from the list_stacks
+        summaries"""
+        return signature(
+            self.stack_summaries_in_region(region),
+            ['StackId', 'StackStatus', 'LastUpdatedTime', 'DeletionTime']
+        )
+
+    def __regional_cfn(self, region):
+        return BotoFactory().get_capability(
+            boto3.client, self.session, 'cloudformation',
+            account_id=self.account_id, region=region
+        )
@@ -0,0 +1,408 @@
+import boto3
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from app.json_cache import CACHE_DIR
+
+log = logging.getLogger('parseley')
+
+CLOUDTRAIL_INDEX = os.getenv(
+    'CLOUDTRAIL_INDEX', os.path.join(CACHE_DIR, 'cloudtrail_index.db'))
+CHUNK_SIZE = 1 << 20
+SCAN_CHUNKSIZE = 8
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_RECORDS = re.compile(r'"Records"\s*:\s*\[')
+# digest files sit next to the logs, under CloudTrail-Digest/, and hold
+# no events
+DIGEST = 'CloudTrail-Digest'
+_SEPARATORS = ' \t\r\n,'
+# AWSLogs/[o-org/]<account>/CloudTrail/<region>/<yyyy>/<mm>/<dd>/<file>
+_LOG_PATH = re.compile(
+    r'AWSLogs/(?:o-[a-z0-9]+/)?(\d{12})/CloudTrail/([a-z0-9-]+)/'
+    r'(\d{4})/(\d{2})/(\d{2})/')
+# fields kept in the index, (name, function of the event)
+INDEX_TERMS = (
+    ('account', lambda e: e.get('recipientAccountId')),
+    ('event_name', lambda e: e.get('eventName')),
+    ('event_source', lambda e: e.get('eventSource')),
+    ('principal', lambda e: principal_arn(e))
+)
+
+_s3 = None
+
+
+def principal_arn(event):
+    """ARN of the identity behind an event, the role for assumed roles"""
+    identity = event.get('userIdentity') or dict()
+    issuer = (identity.get('sessionContext') or dict()).get('sessionIssuer')
+    if issuer and issuer.get('arn'):
+        return issuer['arn']
+    return identity.get('arn')
+
+
+def iter_records(f, chunk_size=CHUNK_SIZE):
+    """
+    Yields the events of a CloudTrail log, a text file object holding one
+    {"Records": [...]} document, one at a time without reading the file
+    whole: the buffer only ever holds the event being decoded and one
+    chunk.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    match = None
+    while match is None:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+        match = _RECORDS.search(buf)
+    pos = match.end()
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in _SEPARATORS:
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            if pos == len(buf):
+                raise ValueError('buffer exhausted')
+            record, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                if pos == len(buf):
+                    return
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield record
+        if pos >= chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+
+def _utc(value):
+    if value is None or isinstance(value, str):
+        return value
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime(TIME_FORMAT)
+
+
+class EventFilter():
+    """
+    Which CloudTrail events a query wants. Every criterion that is given
+    must match; lists match any of their values.
+
+    Parameters:
+        accounts (list): recipientAccountId
+        event_names (list): eventName, e.g. DeleteTrail
+        event_sources (list): eventSource, e.g. iam.amazonaws.com
+        principals (list): userIdentity ARN, the role ARN for assumed roles
+        start (datetime or str): eventTime from, inclusive
+        end (datetime or str): eventTime until, exclusive
+    """
+
+    def __init__(self, accounts=None, event_names=None, event_sources=None,
+                 principals=None, start=None, end=None):
+        self.terms = {
+            'account': set(accounts) if accounts else None,
+            'event_name': set(event_names) if event_names else None,
+            'event_source': set(event_sources) if event_sources else None,
+            'principal': set(principals) if principals else None
+        }
+        # eventTime strings in UTC compare like the times they represent
+        self.start = _utc(start)
+        self.end = _utc(end)
+
+    def matches(self, event):
+        event_time = event.get('eventTime', '')
+        if self.start is not None and event_time < self.start:
+            return False
+        if self.end is not None and event_time >= self.end:
+            return False
+        for name, term in INDEX_TERMS:
+            values = self.terms[name]
+            if values is not None and term(event) not in values:
+                return False
+        return True
+
+    def may_contain(self, location):
+        """False when the log file path, AWSLogs/<account>/CloudTrail/
+        <region>/<yyyy>/<mm>/<dd>/, already rules the file out"""
+        match = _LOG_PATH.search(location)
+        if match is None:
+            return True
+        account, _, year, month, day = match.groups()
+        if self.terms['account'] is not None and \
+                account not in self.terms['account']:
+            return False
+        # a file is filed under the day it was written, it can still hold
+        # events from shortly before midnight
+        day_start = datetime(int(year), int(month), int(day),
+                             tzinfo=timezone.utc)
+        if self.end is not None and \
+                _utc(day_start - timedelta(days=1)) >= self.end:
+            return False
+        if self.start is not None and \
+                _utc(day_start + timedelta(days=1)) <= self.start:
+            return False
+        return True
+
+
+def _is_log(location):
+    return location.endswith('.json.gz') and DIGEST not in location
+
+
+def _open_log(location):
+    if location.startswith('s3://'):
+        global _s3
+        if _s3 is None:
+            _s3 = boto3.client('s3')
+        bucket, key = location[len('s3://'):].split('/', 1)
+        body = _s3.get_object(Bucket=bucket, Key=key)['Body']
+        raw = gzip.GzipFile(fileobj=body)
+    else:
+        raw = gzip.open(location, 'rb')
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+def _scan_file(task):
+    """runs in a worker process: the matching events of one log file and,
+    when indexing, its index terms and time range"""
+    location, event_filter, fields, collect_terms, keep_events = task
+    matches = list()
+    terms = {name: set() for name, _ in INDEX_TERMS}
+    first = last = None
+    count = 0
+    try:
+        with _open_log(location) as f:
+            for event in iter_records(f):
+                count += 1
+                if collect_terms:
+                    for name, term in INDEX_TERMS:
+                        value = term(event)
+                        if value is not None:
+                            terms[name].add(value)
+                    event_time = event.get('eventTime')
+                    if event_time:
+                        first = min(first or event_time, event_time)
+                        last = max(last or event_time, event_time)
+                if not keep_events:
+                    continue
+                if event_filter is None or event_filter.matches(event):
+                    if fields is not None:
+                        event = {k: event.get(k) for k in fields}
+                    matches.append(event)
+    except Exception as e:
+        return location, None, None, f"{type(e).__name__}: {e}"
+    index_entry = None
+    if collect_terms:
+        index_entry = {
+            'first': first, 'last': last, 'events': count,
+            'terms': {name: sorted(values) for name, values in terms.items()}
+        }
+    return location, matches, index_entry, None
+
+
+class TrailIndex():
+    """
+    Compact SQLite index of CloudTrail log files: per file its event time
+    range and the distinct accounts, event names, event sources and
+    principals in it, not the events. A query only rescans the files that
+    can hold a match.
+    """
+
+    def __init__(self, path=CLOUDTRAIL_INDEX):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'file_id INTEGER PRIMARY KEY, location TEXT UNIQUE, '
+                'version TEXT, first_time TEXT, last_time TEXT, '
+                'events INTEGER)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS terms ('
+                'file_id INTEGER, field TEXT, value TEXT)')
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS terms_value '
+                'ON terms (field, value)')
+
+    def indexed(self):
+        """location: version of every indexed file"""
+        return dict(self.db.execute('SELECT location, version FROM files'))
+
+    def add(self, location, version, entry):
+        with self.db:
+            row = self.db.execute(
+                'SELECT file_id FROM files WHERE location = ?',
+                (location,)).fetchone()
+            if row is not None:
+                self.db.execute(
+                    'DELETE FROM terms WHERE file_id = ?', (row[0],))
+                self.db.execute(
+                    'DELETE FROM files WHERE file_id = ?', (row[0],))
+            file_id = self.db.execute(
+                'INSERT INTO files (location, version, first_time, '
+                'last_time, events) VALUES (?, ?, ?, ?, ?)',
+                (location, version, entry['first'], entry['last'],
+                 entry['events'])
+            ).lastrowid
+            self.db.executemany(
+                'INSERT INTO terms VALUES (?, ?, ?)',
+                [(file_id, field, value)
+                 for field, values in entry['terms'].items()
+                 for value in values]
+            )
+
+    def candidates(self, event_filter):
+        """indexed files that can hold events matching the filter"""
+        sql = 'SELECT location FROM files WHERE 1 = 1'
+        params = list()
+        if event_filter.start is not None:
+            sql += ' AND last_time >= ?'
+            params.append(event_filter.start)
+        if event_filter.end is not None:
+            sql += ' AND first_time < ?'
+            params.append(event_filter.end)
+        for field, values in event_filter.terms.items():
+            if values is None:
+                continue
+            sql += (
+                ' AND file_id IN (SELECT file_id FROM terms WHERE field = ? '
+                f"AND value IN ({', '.join('?' * len(values))}))")
+            params += [field] + sorted(values)
+        return {row[0] for row in self.db.execute(sql, params)}
+
+    def close(self):
+        self.db.close()
+
+
+class CloudTrailLogAnalyzer():
+    """
+    Queries the gzipped JSON log files CloudTrail delivers, from a local
+    directory or an s3://bucket/prefix. Files are decompressed and parsed
+    in parallel worker processes, each streaming its events instead of
+    loading the file, and only matching events come back to the caller.
+    Files the log path rules out (account, delivery day) are never opened.
+    With an index, files already indexed are only scanned when the index
+    says they can match, and new files are indexed while they are scanned.
+
+    Example usage:
+    analyzer = CloudTrailLogAnalyzer('logs/AWSLogs', index=True)
+    for event in analyzer.events(EventFilter(
+            event_names=['DeleteTrail', 'StopLogging'],
+            start=datetime(2024, 5, 1), end=datetime(2024, 5, 2))):
+        print(event['eventTime'], principal_arn(event))
+
+    Parameters:
+        source (str): Directory or s3://bucket/prefix of .json.gz log files
+        processes (int): Worker processes, defaults to the CPUs
+        index (bool): Use and maintain the TrailIndex
+        index_path (str): Where the index lives
+        session (boto3.Session): (Optional) Lists s3 sources
+    """
+
+    def __init__(self, source, processes=None, index=False,
+                 index_path=CLOUDTRAIL_INDEX, session=None):
+        self.source = source
+        self.processes = processes or os.cpu_count() or 1
+        self.index = TrailIndex(index_path) if index else None
+        self.session = session or boto3.Session()
+
+    def log_files(self):
+        """{location: version} of every log file under the source, the
+        version changes when the file does"""
+        if self.source.startswith('s3://'):
+            bucket, _, prefix = self.source[len('s3://'):].partition('/')
+            s3 = self.session.client('s3')
+            files = dict()
+            pgnt = s3.get_paginator('list_objects_v2')
+            for page in pgnt.paginate(Bucket=bucket, Prefix=prefix):
+                for o in page.get('Contents', []):
+                    if _is_log(o['Key']):
+                        files[f"s3://{bucket}/{o['Key']}"] = o['ETag']
+            return files
+
+        files = dict()
+        for directory, _, names in os.walk(self.source):
+            for name in names:
+                path = os.path.join(directory, name)
+                if _is_log(path):
+                    stat = os.stat(path)
+                    files[path] = f"{stat.st_size}:{stat.st_mtime_ns}"
+        return files
+
+    def build_index(self):
+        """indexes the files that are new or changed, returns how many"""
+        if self.index is None:
+            raise ValueError('CloudTrailLogAnalyzer was created without index')
+        indexed = 0
+        for _ in self.__scan(None, None, stale_only=True):
+            indexed += 1
+        return indexed
+
+    def events(self, event_filter=None, fields=None):
+        """
+        Yields the events matching the filter, file by file as the workers
+        finish them, in no particular order. fields limits every event to
+        those top-level keys, which also keeps the transfer from the
+        workers small.
+        """
+        for matches in self.__scan(event_filter, fields):
+            yield from matches
+
+    def __scan(self, event_filter, fields, stale_only=False):
+        """yields the matches of every file that has to be scanned"""
+        files = self.log_files()
+        if event_filter is not None:
+            files = {
+                location: version for location, version in files.items()
+                if event_filter.may_contain(location)
+            }
+
+        indexed = self.index.indexed() if self.index is not None else dict()
+        stale = {
+            location for location, version in files.items()
+            if indexed.get(location) != version
+        }
+        candidates = set(files)
+        if stale_only:
+            candidates = stale
+        elif self.index is not None and event_filter is not None:
+            candidates = (self.index.candidates(event_filter) & candidates) \
+                | stale
+        log.info(
+            f"Scanning {len(candidates)} of {len(files)} CloudTrail log "
+            f"files with {self.processes} processes")
+        if not candidates:
+            return
+
+        tasks = [
+            (location, event_filter, fields,
+             self.index is not None and location in stale, not stale_only)
+            for location in sorted(candidates)
+        ]
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(self.processes) as pool:
+            for location, matches, entry, error in pool.imap_unordered(
+                    _scan_file, tasks, chunksize=SCAN_CHUNKSIZE):
+                if error is not None:
+                    log.error(f"Could not read {location}: {error}")
+                    continue
+                if entry is not None:
+                    self.index.add(location, files[location], entry)
+                yield matches
@@ -0,0 +1,126 @@
+import boto3
+from app.acm_ops import ACMOps
+from app.boto_factory import BotoFactory
+from app.cfn_ops import CFNOps
+from app.cloudtrail_ops import CloudtrailOps
+from app.iam_ops import IAMOps
+from app.r53_ops import Route53Ops
+from app.vpc_ops import VPCOps
+
+DESIRED_PW_POLICY = {
+    "MinimumPasswordLength": 16,
+    "RequireNumbers": True,
+    "RequireUppercaseCharacters": True,
+    "RequireLowercaseCharacters": True,
+    "AllowUsersToChangePassword": True,
+    "ExpirePasswords": True,
+    "MaxPasswordAge": 90,
+    "PasswordReusePrevention": 10,
+    "HardExpiry": True
+}
+
+
+class Collector():
+    """
+    One inventory the JobRunner can collect. fetch(session, account_id,
+    region) returns the records of one unit, preferably as an iterator so
+    they are written as the pages arrive; region is None for collectors
+    that are not regional.
+
+    Parameters:
+        name (str): Name used on the command line and for the output files
+        fetch (function): Returns the records of one (account, region) unit
+        regional (bool): Whether the collector runs once per enabled region
+        service (str): (Optional) Only regions where this service exists
+        table (str): (Optional) InventoryStore table for the records
+        key (str): (Optional) Record field identifying a resource, enables
+            the incremental mode
+        signature (function): (Optional) signature(session, account_id,
+            region), cheap change signal for the incremental mode
+    """
+
+    def __init__(self, name, fetch, regional=True, service=None, table=None,
+                 key=None, signature=None):
+        self.name = name
+        self.fetch = fetch
+        self.regional = regional
+        self.service = service
+        self.table = table
+        self.key = key
+        self.signature = signature
+
+
+def _cfn_stacks(session, account_id, region):
+    return CFNOps(account_id).iter_stack_summaries(region)
+
+
+def _cfn_stacks_detail(session, account_id, region):
+    return CFNOps(account_id).iter_stacks(region)
+
+
+def _cfn_signature(session, account_id, region):
+    return CFNOps(account_id).stack_signature(region)
+
+
+def _subnets(session, account_id, region):
+    return VPCOps(account_id).iter_subnets(region)
+
+
+def _vpn_connections(session, account_id, region):
+    return VPCOps(account_id).iter_vpn_connections(region)
+
+
+def _acm_certificates(session, account_id, region):
+    return ACMOps(session, account_id, regions=[region]) \
+        .describe_certificates(region)
+
+
+def _hosted_zones(session, account_id, region):
+    r53_client = BotoFactory().get_capability(
+        boto3.client, session, 'route53', account_id=account_id
+    )
+    return Route53Ops(
+        client=r53_client, account_id=account_id).iter_hosted_zones()
+
+
+def _record_sets(session, account_id, region):
+    r53_client = BotoFactory().get_capability(
+        boto3.client, session, 'route53', account_id=account_id
+    )
+    return Route53Ops(client=r53_client).iter_record_sets()
+
+
+def _trails(session, account_id, region):
+    return CloudtrailOps().get_all_cloudtrails_list(session, account_id)
+
+
+def _pw_policy(session, account_id, region):
+    discrepancies = IAMOps(session, account_id).compare_pw_policy(
+        DESIRED_PW_POLICY)
+    return [{
+        'PolicyExists': discrepancies is not False,
+        'Compliant': discrepancies == dict(),
+        'Discrepancies': discrepancies or dict()
+    }]
+
+
+COLLECTORS = {c.name: c for c in [
+    Collector('cfn_stacks', _cfn_stacks, service='cloudformation',
+              table='stacks'),
+    Collector('cfn_stacks_detail', _cfn_stacks_detail,
+              service='cloudformation', table='stacks', key='StackId',
+              signature=_cfn_signature),
+    Collector('subnets', _subnets, service='ec2', table='subnets',
+              key='SubnetId'),
+    Collector('vpns', _vpn_connections, service='ec2',
+              table='vpn_connections', key='VpnConnectionId'),
+    Collector('acm_certificates', _acm_certificates, service='acm',
+              table='certificates', key='CertificateArn'),
+    Collector('hosted_zones', _hosted_zones, regional=False,
+              table='hosted_zones', key='Id'),
+    Collector('record_sets', _record_sets, regional=False,
+              table='record_sets'),
+    Collector('trails', _trails, regional=False, table='trails',
+              key='TrailARN'),
+    Collector('pw_policy', _pw_policy, regional=False)
+]}
@@ -1,10 +1,12 @@
-import csv
-import logging
-
-log = logging.getLogger()
+from app.export import ExportWriter
 
 
 class CSVWrite():
+    """
+    Kept for existing callers, both write through ExportWriter and so take
+    any iterable, flatten nested values and write atomically.
+    """
+
     def write_csv_from_list_of_dicts(
             self, input_listdict, fieldnames, filename):
         """
@@ -26,12 +28,7 @@ class CSVWrite():
         Row1,Row1
         Row2,Row2
         """
-        with open(filename, 'w') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            for i in input_listdict:
-                writer.writerow(i)
-        log.info(f"Wrote {filename}")
+        ExportWriter(filename, fieldnames=fieldnames).write(input_listdict)
 
     def write_csv_from_dict_list(self, input_dict, fieldnames, filename):
         """
@@ -57,12 +54,8 @@ class CSVWrite():
         Entry1,Row1,Row1
         Entry1,Row2,Row2
         """
-        with open(filename, 'w') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            for entry in input_dict:
-                row = input_dict[entry]
-                for r in row:
-                    r[fieldnames[0]] = entry
-                    writer.writerow(r)
-        log.info(f"Wrote {filename}")
+        rows = (
+            dict(r, **{fieldnames[0]: entry})
+            for entry, entry_rows in input_dict.items() for r in entry_rows
+        )
+        ExportWriter(filename, fieldnames=fieldnames).write(rows)
@@ -0,0 +1,195 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger('parseley')
+
+# reading the umask means setting it, so it is read once at import,
+# before any threads create files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+SAMPLE_SIZE = 1000
+LIST_SEPARATOR = ';'
+# how a nested value becomes columns
+FLATTEN = 'flatten'   # dicts: one column per key, Parent.Key
+TAGS = 'tags'         # [{Key, Value}]: one column per tag, Tags.<Key>
+JOIN = 'join'         # lists of scalars: one column, joined by ;
+JSON = 'json'         # one column holding the value as JSON
+DROP = 'drop'         # no column
+
+
+def _is_tag_list(value):
+    return bool(value) and all(
+        isinstance(v, dict) and set(v) == {'Key', 'Value'} for v in value)
+
+
+def _default_rule(value):
+    if isinstance(value, dict):
+        return FLATTEN
+    if _is_tag_list(value):
+        return TAGS
+    if all(not isinstance(v, (dict, list)) for v in value):
+        return JOIN
+    return JSON
+
+
+def flatten(record, rules=None, prefix='', keep=None):
+    """
+    One level of columns for a nested record. Nested dicts become
+    Parent.Key columns, tag lists Tags.<Key> columns, lists of scalars
+    are joined and anything else is kept as JSON. rules overrides that
+    per column, by its flattened name, and the columns in keep are always
+    one column, as JSON:
+
+    flatten(vpn, rules={'VgwTelemetry': JSON, 'Options': DROP})
+    """
+    rules = rules or dict()
+    keep = keep or set()
+    row = dict()
+    for key, value in record.items():
+        column = f"{prefix}{key}"
+        if not isinstance(value, (dict, list, tuple)):
+            row[column] = value
+            continue
+        rule = JSON if column in keep else \
+            rules.get(column) or _default_rule(value)
+        if rule == DROP:
+            continue
+        elif rule == FLATTEN and isinstance(value, dict):
+            row.update(flatten(value, rules, f"{column}.", keep))
+        elif rule == TAGS and _is_tag_list(value):
+            for tag in value:
+                row[f"{column}.{tag['Key']}"] = tag['Value']
+        elif rule == JOIN:
+            row[column] = LIST_SEPARATOR.join(str(v) for v in value)
+        else:
+            row[column] = json.dumps(value, default=str)
+    return row
+
+
+def _file_mode(path):
+    """mode for the file replacing path: the existing file's, or what
+    open() would give a new one"""
+    try:
+        return os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+
+def _open_compressed(path, compression):
+    """binary file object writing path with the compression"""
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError(
+                'zstd output needs zstandard: pip3 install zstandard')
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+class ExportWriter():
+    """
+    Writes records from any iterable to CSV or JSONL in constant memory.
+    The format and compression follow the file name: .csv or .jsonl, plus
+    .gz or .zst. The file appears only once it is complete, it is written
+    to a temporary file next to it and renamed.
+
+    CSV rows are flattened (see flatten). Without fieldnames the columns
+    are inferred from the first sample_size records, in the order they
+    first appear; columns only seen after the sample are left out and
+    logged. A nested value whose column is one of the given fieldnames is
+    written to that column as JSON instead of being flattened.
+
+    Example usage:
+    ExportWriter('out/subnets.csv.gz').write(
+        VPCOps(account_id).get_subnets(region))
+
+    Parameters:
+        filename (str): The file to write, e.g. out/subnets.csv.zst
+        fieldnames (list): (Optional) The columns, no inference
+        rules (dict): (Optional) Flatten rules by column, see flatten
+        sample_size (int): Records sampled for the columns
+    """
+
+    def __init__(self, filename, fieldnames=None, rules=None,
+                 sample_size=SAMPLE_SIZE):
+        self.filename = filename
+        self.fieldnames = list(fieldnames) if fieldnames else None
+        self.rules = rules
+        self.sample_size = sample_size
+        name = filename
+        self.compression = None
+        for extension, compression in (('.gz', 'gzip'), ('.zst', 'zstd')):
+            if name.endswith(extension):
+                self.compression = compression
+                name = name[:-len(extension)]
+        self.format = 'jsonl' if name.endswith('.jsonl') else 'csv'
+
+    def write(self, records):
+        """writes every record, returns how many"""
+        directory = os.path.dirname(self.filename) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(
+            dir=directory, prefix=f".{os.path.basename(self.filename)}-")
+        os.close(fd)
+        try:
+            with io.TextIOWrapper(
+                    _open_compressed(tmp, self.compression),
+                    encoding='utf-8', newline='') as f:
+                if self.format == 'jsonl':
+                    count = self.__write_jsonl(f, records)
+                else:
+                    count = self.__write_csv(f, records)
+            # mkstemp creates the file 0600
+            os.chmod(tmp, _file_mode(self.filename))
+            os.replace(tmp, self.filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        log.info(f"Wrote {count} records to {self.filename}")
+        return count
+
+    @staticmethod
+    def __write_jsonl(f, records):
+        count = 0
+        for record in records:
+            f.write(json.dumps(record, default=str) + '\n')
+            count += 1
+        return count
+
+    def __write_csv(self, f, records):
+        fieldnames = self.fieldnames
+        keep = set(fieldnames or [])
+        rows = (flatten(r, self.rules, keep=keep) for r in records)
+        sample = list()
+        if fieldnames is None:
+            sample = list(itertools.islice(rows, self.sample_size))
+            fieldnames = list(dict.fromkeys(
+                column for row in sample for column in row))
+        writer = csv.DictWriter(
+            f, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+
+        known = set(fieldnames)
+        unknown = set()
+        count = 0
+        for row in itertools.chain(sample, rows):
+            unknown.update(column for column in row if column not in known)
+            writer.writerow(row)
+            count += 1
+        if unknown:
+            log.warning(
+                f"{self.filename}: left out columns {sorted(unknown)[:20]}")
+        return count
@@ -1,8 +1,83 @@
 import boto3
+import csv
+import io
 import os
 import logging
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from app.boto_factory import BotoFactory
+from app.iam_snapshot import (
+    IAMSnapshot, decode_policy_document, trusts_account
+)
+from app.pagination import paginate, tagged
+
+REPORT_POLL_INTERVAL = 2
+REPORT_TIMEOUT = 300
+REPORT_MAX_WORKERS = 20
+ROOT_ACCOUNT_USER = '<root_account>'
+
+
+def parse_credential_report(content):
+    """
+    Parses the CSV of get_credential_report into one dict per user. 'true'
+    and 'false' become booleans and the report's placeholders for missing
+    values ('N/A', 'not_supported', 'no_information') become None.
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    values = {
+        'true': True, 'false': False,
+        'N/A': None, 'not_supported': None, 'no_information': None
+    }
+    return [
+        {k: values.get(v, v) for k, v in row.items()}
+        for row in csv.DictReader(io.StringIO(content))
+    ]
+
+
+def get_credential_reports(session, accounts, max_workers=REPORT_MAX_WORKERS,
+                           poll_interval=REPORT_POLL_INTERVAL,
+                           timeout=REPORT_TIMEOUT):
+    """
+    Fetches the credential report of many accounts at once. Report
+    generation is started in every account first and all of them are then
+    polled together, so the accounts' reports are generated in parallel.
+    Returns a dict of account ID to parsed report, accounts that failed or
+    timed out are left out.
+    """
+    pending = list(accounts)
+    reports = dict()
+    deadline = time.monotonic() + timeout
+
+    def poll(account_id):
+        iam_ops = IAMOps(session, account_id)
+        if iam_ops.iam.generate_credential_report()['State'] != 'COMPLETE':
+            return None
+        return iam_ops.get_credential_report(generate=False)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending:
+            futures = {a: executor.submit(poll, a) for a in pending}
+            pending = list()
+            for account_id, future in futures.items():
+                try:
+                    report = future.result()
+                except Exception as e:
+                    logging.error(
+                        f"{account_id}: no credential report, {e}")
+                    continue
+                if report is None:
+                    pending.append(account_id)
+                else:
+                    reports[account_id] = report
+            if pending:
+                if time.monotonic() > deadline:
+                    logging.error(
+                        f"Credential reports timed out for {pending}")
+                    break
+                time.sleep(poll_interval)
+    return reports
 
 
 class IAMOps():
@@ -12,6 +87,21 @@ class IAMOps():
         self.account_id = account_id
         self.iam = BotoFactory().get_capability(
             boto3.client, session, 'iam', account_id=account_id)
+        self.snapshot = None
+
+    def load_snapshot(self, max_age=None):
+        """
+        Pulls all users, groups, roles and policies of the account into an
+        IAMSnapshot that the read queries of this class answer from. With
+        max_age, a saved snapshot younger than max_age seconds is used
+        instead.
+        """
+        if max_age is not None:
+            self.snapshot = IAMSnapshot.load(self.account_id, max_age)
+        if self.snapshot is None:
+            self.snapshot = IAMSnapshot.from_client(self.iam, self.account_id)
+            self.snapshot.save()
+        return self.snapshot
 
     def delete_role(self, rolename):
         try:
@@ -34,6 +124,30 @@ class IAMOps():
             logging.info(e)
             logging.info(f"{self.account_id}: role {rolename} doesn't exist")
 
+    def get_role_policies(self, rolename):
+        """(attached policy ARNs, inline policy names) of a role"""
+        if self.snapshot is not None:
+            return self.snapshot.role_policies(rolename)
+
+        attached = [
+            p['PolicyArn'] for p in self.iam.get_paginator(
+                'list_attached_role_policies').paginate(
+                    RoleName=rolename).build_full_result()['AttachedPolicies']
+        ]
+        inline = self.iam.get_paginator('list_role_policies').paginate(
+            RoleName=rolename).build_full_result()['PolicyNames']
+        return attached, inline
+
+    def get_users_in_group(self, group_name):
+        if self.snapshot is not None:
+            return self.snapshot.users_in_group(group_name)
+
+        return [
+            u['UserName'] for u in self.iam.get_paginator(
+                'get_group').paginate(
+                    GroupName=group_name).build_full_result()['Users']
+        ]
+
     def remove_idp(self, idp_name):
         saml_arn = f"arn:aws:iam::{self.account_id}:saml-provider/{idp_name}"
         try:
@@ -44,6 +158,14 @@ class IAMOps():
         except self.iam.exceptions.NoSuchEntityException:
             logging.info(f"{self.account_id}: IdP {idp_name} doesn't exist")
 
+    def apply_action(self, action, params):
+        """calls an IAM client method, policy documents given as dict are
+        serialised to json"""
+        if isinstance(params.get('PolicyDocument'), dict):
+            params = dict(
+                params, PolicyDocument=json.dumps(params['PolicyDocument']))
+        return getattr(self.iam, action)(**params)
+
     def update_assume_role_policy(self, rolename, policy):
         """policy should be in dict-format to be translated to json"""
         try:
@@ -55,27 +177,67 @@ class IAMOps():
             logging.warning(e)
 
     def list_roles_with_trust(self, trusted_account):
+        if self.snapshot is not None:
+            return self.snapshot.roles_trusting(trusted_account)
+
         roles = list()
-        pgn = self.iam.get_paginator('list_roles')
-        itr = pgn.paginate()
-        for i in itr:
-            for r in i['Roles']:
-                policy_doc = r['AssumeRolePolicyDocument']
-                if trusted_account in json.dumps(policy_doc):
-                    roles.append((r['Arn']))
+        for r in paginate(self.iam, 'list_roles'):
+            policy_doc = decode_policy_document(r['AssumeRolePolicyDocument'])
+            if trusts_account(policy_doc, trusted_account):
+                roles.append((r['Arn']))
         print(roles)
         return roles
 
     def get_all_iam_users(self):
-        users = set()
-        pgnt = self.iam.get_paginator('list_users')
-        itr = pgnt.paginate()
-        for i in itr:
-            for user in i['Users']:
-                users.add(user['UserName'])
-        return users
-
-    def get_all_iam_users_with_pw(self):
+        if self.snapshot is not None:
+            return set(self.snapshot.users)
+
+        return {user['UserName'] for user in self.iter_users()}
+
+    def iter_users(self):
+        """yields the IAM users as their pages arrive, tagged with AccountId
+        and Region, from the snapshot when one is loaded"""
+        if self.snapshot is not None:
+            # authorization details are keyed by name, without UserName
+            users = (
+                dict(u, UserName=name)
+                for name, u in self.snapshot.users.items()
+            )
+        else:
+            users = paginate(self.iam, 'list_users')
+        return tagged(users, self.account_id)
+
+    def get_credential_report(self, generate=True,
+                              poll_interval=REPORT_POLL_INTERVAL,
+                              timeout=REPORT_TIMEOUT):
+        """
+        Returns the account's credential report as a list of dicts, one per
+        user including the root account: password, MFA, access key age and
+        last used data, in about two API calls. IAM reuses reports for up to
+        four hours, so the data may be that old.
+        """
+        if generate:
+            deadline = time.monotonic() + timeout
+            while self.iam.generate_credential_report()['State'] \
+                    != 'COMPLETE':
+                if time.monotonic() > deadline:
+                    raise TimeoutError(
+                        f"{self.account_id}: credential report not ready")
+                time.sleep(poll_interval)
+        return parse_credential_report(
+            self.iam.get_credential_report()['Content'])
+
+    def get_all_iam_users_with_pw(self, use_credential_report=False):
+        """
+        usernames with a login profile. With use_credential_report the
+        names come from the credential report instead of two calls per user
+        """
+        if use_credential_report:
+            return {
+                u['user'] for u in self.get_credential_report()
+                if u['password_enabled'] and u['user'] != ROOT_ACCOUNT_USER
+            }
+
         iam_resource = BotoFactory().get_capability(
             boto3.resource, self.session, 'iam', account_id=self.account_id)
 
@@ -0,0 +1,253 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app.iam_ops import IAMOps, ROOT_ACCOUNT_USER
+
+log = logging.getLogger('parseley')
+
+PLAN_MAX_WORKERS = 20
+
+# password policy keys that are reported but can't be set
+READ_ONLY_PW_KEYS = {'ExpirePasswords'}
+KEEP_STRONGER_PW_KEYS = ['MinimumPasswordLength', 'PasswordReusePrevention']
+
+_NOT_READ = object()
+
+
+class AccountState():
+    """
+    Current IAM state of one account, read once per plan and only when a
+    change needs it: the IAM snapshot, the password policy and the users
+    with a console password from the credential report.
+    """
+
+    def __init__(self, iam_ops):
+        self.iam_ops = iam_ops
+        self._snapshot = None
+        self._password_policy = _NOT_READ
+        self._console_users = None
+
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = self.iam_ops.load_snapshot()
+        return self._snapshot
+
+    @property
+    def password_policy(self):
+        """None when the account has no password policy"""
+        if self._password_policy is _NOT_READ:
+            iam = self.iam_ops.iam
+            try:
+                self._password_policy = iam.get_account_password_policy(
+                )['PasswordPolicy']
+            except iam.exceptions.NoSuchEntityException:
+                self._password_policy = None
+        return self._password_policy
+
+    @property
+    def console_users(self):
+        if self._console_users is None:
+            self._console_users = {
+                u['user'] for u in self.iam_ops.get_credential_report()
+                if u['password_enabled'] and u['user'] != ROOT_ACCOUNT_USER
+            }
+        return self._console_users
+
+
+class SetPasswordPolicy():
+    """sets the password policy, requirements in the account that are
+    stronger than the desired ones and settings the desired policy doesn't
+    mention are kept"""
+
+    def __init__(self, desired_pw_policy):
+        self.desired = desired_pw_policy
+
+    def describe(self):
+        return 'password policy'
+
+    def actions(self, state):
+        current = state.password_policy
+        # the update replaces the whole policy, so settings the desired
+        # policy doesn't mention are carried over
+        desired = {
+            k: v for k, v in (current or {}).items()
+            if k not in READ_ONLY_PW_KEYS
+        }
+        desired.update({
+            k: v for k, v in self.desired.items()
+            if k not in READ_ONLY_PW_KEYS
+        })
+        if current is not None:
+            for key in KEEP_STRONGER_PW_KEYS:
+                if key in desired and current.get(key, 0) > desired[key]:
+                    desired[key] = current[key]
+            if all(current.get(k) == v for k, v in desired.items()):
+                return list()
+        return [('update_account_password_policy', desired)]
+
+
+class AddConsoleUsersToGroup():
+    """adds every user with a console password to a group"""
+
+    def __init__(self, group_name):
+        self.group_name = group_name
+
+    def describe(self):
+        return f"console users in group {self.group_name}"
+
+    def actions(self, state):
+        return [
+            ('add_user_to_group',
+             {'GroupName': self.group_name, 'UserName': user})
+            for user in sorted(state.console_users)
+            if self.group_name not in state.snapshot.users.get(
+                user, {}).get('Groups', [])
+        ]
+
+
+class UpdateAssumeRolePolicy():
+    """replaces the trust policy of a role, policy is a dict"""
+
+    def __init__(self, rolename, policy):
+        self.rolename = rolename
+        self.policy = policy
+
+    def describe(self):
+        return f"trust policy of role {self.rolename}"
+
+    def actions(self, state):
+        role = state.snapshot.roles.get(self.rolename)
+        if role is None:
+            raise LookupError(f"role {self.rolename} doesn't exist")
+        if role['TrustPolicy'] == self.policy:
+            return list()
+        return [('update_assume_role_policy',
+                 {'RoleName': self.rolename,
+                  'PolicyDocument': self.policy})]
+
+
+class DeleteRole():
+    """deletes a role after detaching its managed policies, deleting its
+    inline policies and removing it from its instance profiles, which are
+    deleted as well"""
+
+    def __init__(self, rolename):
+        self.rolename = rolename
+
+    def describe(self):
+        return f"delete role {self.rolename}"
+
+    def actions(self, state):
+        role = state.snapshot.roles.get(self.rolename)
+        if role is None:
+            return list()
+        actions = list()
+        for policy_arn in role['AttachedPolicies']:
+            actions.append(('detach_role_policy',
+                            {'RoleName': self.rolename,
+                             'PolicyArn': policy_arn}))
+        for policy_name in role['InlinePolicies']:
+            actions.append(('delete_role_policy',
+                            {'RoleName': self.rolename,
+                             'PolicyName': policy_name}))
+        for profile in role['InstanceProfiles']:
+            actions.append(('remove_role_from_instance_profile',
+                            {'RoleName': self.rolename,
+                             'InstanceProfileName': profile}))
+            actions.append(('delete_instance_profile',
+                            {'InstanceProfileName': profile}))
+        actions.append(('delete_role', {'RoleName': self.rolename}))
+        return actions
+
+
+class IAMPlan():
+    """
+    Groups intended IAM changes by account, reads each account's state once,
+    skips changes that are already compliant and applies the rest, accounts
+    in parallel and the actions of one account in order. Without apply the
+    report shows what would be done.
+
+    Example usage:
+    plan = IAMPlan(session)
+    plan.add('123456789012', DeleteRole('OldDeployRole'))
+    plan.add('123456789012', SetPasswordPolicy(desired_pw_policy))
+    for row in plan.apply(dry_run=True):
+        print(row)
+
+    Report rows:
+    {
+        "AccountId": "123456789012",
+        "Change": "delete role OldDeployRole",
+        "Action": "detach_role_policy",
+        "Params": {"RoleName": "OldDeployRole", "PolicyArn": "arn:..."},
+        "Status": "planned"
+    }
+    Status is compliant, planned, applied or failed (with an Error).
+    """
+
+    def __init__(self, session, max_workers=PLAN_MAX_WORKERS):
+        self.session = session
+        self.max_workers = max_workers
+        self.changes = dict()
+
+    def add(self, account_id, change):
+        self.changes.setdefault(account_id, list()).append(change)
+
+    def apply(self, dry_run=True):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            reports = executor.map(
+                lambda a: self.__apply_account(a, dry_run), self.changes)
+            return [row for report in reports for row in report]
+
+    def __apply_account(self, account_id, dry_run):
+        report = list()
+        try:
+            iam_ops = IAMOps(self.session, account_id)
+            state = AccountState(iam_ops)
+        except Exception as e:
+            log.error(f"{account_id}: could not read IAM state, {e}")
+            return [self.__row(account_id, change, None, None, 'failed', e)
+                    for change in self.changes[account_id]]
+
+        for change in self.changes[account_id]:
+            try:
+                actions = change.actions(state)
+            except Exception as e:
+                report.append(
+                    self.__row(account_id, change, None, None, 'failed', e))
+                continue
+            if not actions:
+                report.append(
+                    self.__row(account_id, change, None, None, 'compliant'))
+                continue
+
+            for action, params in actions:
+                if dry_run:
+                    report.append(self.__row(
+                        account_id, change, action, params, 'planned'))
+                    continue
+                try:
+                    iam_ops.apply_action(action, params)
+                    log.info(f"{account_id}: {action} {params}")
+                    report.append(self.__row(
+                        account_id, change, action, params, 'applied'))
+                except Exception as e:
+                    log.error(f"{account_id}: {action} failed, {e}")
+                    report.append(self.__row(
+                        account_id, change, action, params, 'failed', e))
+                    # later actions of a change depend on the earlier ones
+                    break
+        return report
+
+    @staticmethod
+    def __row(account_id, change, action, params, status, error=None):
+        row = {
+            'AccountId': account_id,
+            'Change': change.describe(),
+            'Action': action,
+            'Params': params,
+            'Status': status
+        }
+        if error is not None:
+            row['Error'] = str(error)
+        return row
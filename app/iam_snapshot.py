@@ -0,0 +1,224 @@
+import json
+import logging
+from urllib.parse import unquote
+from app.json_cache import JSONCache
+
+log = logging.getLogger('parseley')
+
+
+def decode_policy_document(document):
+    """policy documents arrive URL-encoded JSON from the raw API and already
+    decoded from boto3, both end up as a dict"""
+    if isinstance(document, str):
+        return json.loads(unquote(document))
+    return document
+
+
+def _as_list(value):
+    if value is None:
+        return list()
+    return value if isinstance(value, list) else [value]
+
+
+def trusted_principals(document):
+    """
+    Flattens the Allow statements of a trust policy into one dict per
+    principal:
+
+    {
+        "Type": "AWS",
+        "Principal": "arn:aws:iam::123456789012:root",
+        "Actions": ["sts:AssumeRole"],
+        "Conditions": {"StringEquals": {"sts:ExternalId": "xyz"}}
+    }
+
+    Type is AWS, Service, Federated or CanonicalUser, and * for
+    "Principal": "*".
+    """
+    principals = list()
+    for statement in _as_list(document.get('Statement')):
+        if statement.get('Effect') != 'Allow':
+            continue
+        actions = _as_list(statement.get('Action'))
+        conditions = statement.get('Condition', {})
+        principal = statement.get('Principal', {})
+        if principal == '*':
+            principal = {'*': '*'}
+        for principal_type, values in principal.items():
+            for value in _as_list(values):
+                principals.append({
+                    'Type': principal_type,
+                    'Principal': value,
+                    'Actions': actions,
+                    'Conditions': conditions
+                })
+    return principals
+
+
+def principal_account(principal):
+    """account ID of an AWS principal, given as ID, root or role/user ARN"""
+    if principal.isdigit():
+        return principal
+    if principal.startswith('arn:'):
+        return principal.split(':')[4]
+    return None
+
+
+def trusts_account(document, account_id):
+    """whether a trust policy allows an AWS principal of the account"""
+    return any(
+        p['Type'] == 'AWS' and principal_account(p['Principal']) == account_id
+        for p in trusted_principals(document)
+    )
+
+
+class IAMSnapshot():
+    """
+    All users, groups, roles and customer managed policies of one account,
+    pulled from get_account_authorization_details in one paginated stream
+    and normalised, with every policy document decoded once. IAM read
+    queries can be answered from it without further API calls.
+
+    Example usage:
+    snapshot = IAMSnapshot.from_client(iam, '123456789012')
+    snapshot.roles_trusting('210987654321')
+
+    Structure:
+        users: {name: {Arn, UserId, Groups, AttachedPolicies,
+            InlinePolicies, Tags}}
+        groups: {name: {Arn, AttachedPolicies, InlinePolicies}}
+        roles: {name: {Arn, RoleId, TrustPolicy, AttachedPolicies,
+            InlinePolicies, InstanceProfiles, Tags, LastUsed}}
+        policies: {arn: {Name, DefaultVersionId, Document, AttachmentCount}}
+    AttachedPolicies are policy ARNs, InlinePolicies map names to documents.
+    """
+
+    def __init__(self, account_id, users=None, groups=None, roles=None,
+                 policies=None):
+        self.account_id = account_id
+        self.users = users or dict()
+        self.groups = groups or dict()
+        self.roles = roles or dict()
+        self.policies = policies or dict()
+
+    @classmethod
+    def from_client(cls, iam, account_id):
+        snapshot = cls(account_id)
+        pgnt = iam.get_paginator('get_account_authorization_details')
+        for page in pgnt.paginate(
+                Filter=['User', 'Group', 'Role', 'LocalManagedPolicy']):
+            for u in page.get('UserDetailList', []):
+                snapshot.users[u['UserName']] = {
+                    'Arn': u['Arn'],
+                    'UserId': u['UserId'],
+                    'Groups': u.get('GroupList', []),
+                    'AttachedPolicies': cls.__attached(u),
+                    'InlinePolicies': cls.__inline(u, 'UserPolicyList'),
+                    'Tags': u.get('Tags', [])
+                }
+            for g in page.get('GroupDetailList', []):
+                snapshot.groups[g['GroupName']] = {
+                    'Arn': g['Arn'],
+                    'AttachedPolicies': cls.__attached(g),
+                    'InlinePolicies': cls.__inline(g, 'GroupPolicyList')
+                }
+            for r in page.get('RoleDetailList', []):
+                snapshot.roles[r['RoleName']] = {
+                    'Arn': r['Arn'],
+                    'RoleId': r['RoleId'],
+                    'TrustPolicy': decode_policy_document(
+                        r['AssumeRolePolicyDocument']),
+                    'AttachedPolicies': cls.__attached(r),
+                    'InlinePolicies': cls.__inline(r, 'RolePolicyList'),
+                    'InstanceProfiles': [
+                        p['InstanceProfileName']
+                        for p in r.get('InstanceProfileList', [])
+                    ],
+                    'Tags': r.get('Tags', []),
+                    'LastUsed': r.get('RoleLastUsed', {}).get('LastUsedDate')
+                }
+            for p in page.get('Policies', []):
+                default = [
+                    v for v in p.get('PolicyVersionList', [])
+                    if v.get('IsDefaultVersion')
+                ]
+                snapshot.policies[p['Arn']] = {
+                    'Name': p['PolicyName'],
+                    'DefaultVersionId': p.get('DefaultVersionId'),
+                    'Document': decode_policy_document(
+                        default[0]['Document']) if default else None,
+                    'AttachmentCount': p.get('AttachmentCount')
+                }
+        log.info(
+            f"{account_id}: {len(snapshot.users)} users, "
+            f"{len(snapshot.groups)} groups, {len(snapshot.roles)} roles"
+        )
+        return snapshot
+
+    @staticmethod
+    def __attached(entity):
+        return [
+            p['PolicyArn'] for p in entity.get('AttachedManagedPolicies', [])
+        ]
+
+    @staticmethod
+    def __inline(entity, key):
+        return {
+            p['PolicyName']: decode_policy_document(p['PolicyDocument'])
+            for p in entity.get(key, [])
+        }
+
+    def to_dict(self):
+        return {
+            'AccountId': self.account_id,
+            'Users': self.users,
+            'Groups': self.groups,
+            'Roles': self.roles,
+            'Policies': self.policies
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['AccountId'], data['Users'], data['Groups'],
+                   data['Roles'], data['Policies'])
+
+    def save(self):
+        JSONCache(f"iam_snapshot_{self.account_id}").save(self.to_dict())
+
+    @classmethod
+    def load(cls, account_id, max_age=None):
+        """the saved snapshot of an account, None if there is none younger
+        than max_age seconds"""
+        data = JSONCache(f"iam_snapshot_{account_id}", ttl=max_age).load()
+        return cls.from_dict(data) if data is not None else None
+
+    def roles_trusting(self, trusted_account):
+        """ARNs of the roles whose trust policy allows an AWS principal of
+        the trusted account"""
+        return [
+            role['Arn'] for role in self.roles.values()
+            if trusts_account(role['TrustPolicy'], trusted_account)
+        ]
+
+    def users_in_group(self, group_name):
+        return [
+            name for name, user in self.users.items()
+            if group_name in user['Groups']
+        ]
+
+    def entities_with_policy(self, policy_arn):
+        """(type, name) of every user, group and role the managed policy is
+        attached to"""
+        entities = list()
+        for entity_type, entities_of_type in (
+                ('user', self.users), ('group', self.groups),
+                ('role', self.roles)):
+            for name, entity in entities_of_type.items():
+                if policy_arn in entity['AttachedPolicies']:
+                    entities.append((entity_type, name))
+        return entities
+
+    def role_policies(self, rolename):
+        """(attached policy ARNs, inline policy names) of a role"""
+        role = self.roles[rolename]
+        return role['AttachedPolicies'], list(role['InlinePolicies'])
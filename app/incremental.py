@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from app.json_cache import CACHE_DIR
+
+log = logging.getLogger('parseley')
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+def signature(items, fields):
+    """stable hash over the given fields of a list of dicts, independent of
+    their order"""
+    rows = sorted(
+        json.dumps([item.get(f) for f in fields], default=str)
+        for item in items
+    )
+    return hashlib.sha256('\n'.join(rows).encode()).hexdigest()
+
+
+def _record_hash(record):
+    return hashlib.sha256(
+        json.dumps(record, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class UnitSnapshotStore():
+    """
+    Keeps the signature and records of every (collector, account, region)
+    unit of the last run, in a SQLite database under CACHE_DIR so a unit can
+    be loaded and saved without holding the whole org in memory.
+    """
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'incremental.db')):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'collector TEXT, account_id TEXT, region TEXT, '
+                'signature TEXT, records TEXT, '
+                'PRIMARY KEY (collector, account_id, region))'
+            )
+
+    def load(self, collector, account_id, region):
+        """returns (signature, records) of the last run, (None, None) if the
+        unit was never collected"""
+        with self._lock:
+            row = self.db.execute(
+                'SELECT signature, records FROM units WHERE collector = ? '
+                'AND account_id = ? AND region = ?',
+                (collector, account_id, region)
+            ).fetchone()
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def save(self, collector, account_id, region, unit_signature, records):
+        with self._lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?)',
+                (collector, account_id, region, unit_signature,
+                 json.dumps(records, default=str))
+            )
+
+
+class IncrementalCollector():
+    """
+    Wraps a per-(account, region) collector so the expensive fetch only runs
+    when a cheap change signature differs from the previous run. Unchanged
+    units re-emit the records stored by the previous run. Every unit also
+    reports an added/removed/changed delta against the previous run, keyed
+    by one field of the records.
+
+    Example usage:
+    collector = IncrementalCollector(
+        'cfn_stacks', key='StackId',
+        fetch_fn=lambda a, r: CFNOps(a).describe_stacks_in_region(r),
+        signature_fn=lambda a, r: CFNOps(a).stack_signature(r)
+    )
+    collector.collect(account_id, region, sink, delta_sink)
+
+    Parameters:
+        name (str): Name of the collector in the snapshot store
+        fetch_fn (function): fetch_fn(account_id, region) returns the records
+        key (str): The record field identifying a resource, e.g. StackId
+        signature_fn (function): (Optional) signature_fn(account_id, region)
+            returns a string that changes when the unit changed. Without it
+            every unit is fetched and only the delta is incremental.
+        store (UnitSnapshotStore): (Optional) Where the previous run lives
+    """
+
+    def __init__(self, name, fetch_fn, key, signature_fn=None, store=None):
+        self.name = name
+        self.fetch_fn = fetch_fn
+        self.key = key
+        self.signature_fn = signature_fn
+        self.store = store if store is not None else UnitSnapshotStore()
+
+    def collect(self, account_id, region, sink=None, delta_sink=None):
+        """
+        Pushes the unit's records to sink and its delta to delta_sink, each
+        tagged with AccountId and Region. Returns the delta as a list.
+        """
+        old_signature, old_records = self.store.load(
+            self.name, account_id, region)
+
+        new_signature = None
+        if self.signature_fn is not None:
+            new_signature = self.signature_fn(account_id, region)
+            if old_signature is not None and new_signature == old_signature:
+                log.info(f"{self.name} {account_id}:{region} unchanged")
+                if sink is not None:
+                    sink.push_many(old_records)
+                return list()
+
+        records = [
+            dict(record, AccountId=account_id, Region=region)
+            for record in self.fetch_fn(account_id, region)
+        ]
+        delta = self.__delta(account_id, region, old_records or [], records)
+        self.store.save(
+            self.name, account_id, region, new_signature, records)
+
+        if sink is not None:
+            sink.push_many(records)
+        if delta_sink is not None:
+            delta_sink.push_many(delta)
+        return delta
+
+    def __delta(self, account_id, region, old_records, new_records):
+        old = {r[self.key]: r for r in old_records}
+        new = {r[self.key]: r for r in new_records}
+        delta = list()
+        for key, record in new.items():
+            if key not in old:
+                change = ADDED
+            elif _record_hash(old[key]) != _record_hash(record):
+                change = CHANGED
+            else:
+                continue
+            delta.append(self.__change(account_id, region, change, key,
+                                       record))
+        for key in old.keys() - new.keys():
+            delta.append(self.__change(account_id, region, REMOVED, key,
+                                       old[key]))
+        return delta
+
+    def __change(self, account_id, region, change, key, record):
+        return {
+            'Change': change,
+            'Collector': self.name,
+            'AccountId': account_id,
+            'Region': region,
+            'Key': key,
+            'Record': record
+        }
@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from app.sinks import RecordSink
+
+log = logging.getLogger('parseley')
+
+INVENTORY_DB = os.getenv('INVENTORY_DB', 'out/inventory.db')
+
+# table: [(column, type, key of the AWS record)], every table also gets a
+# run_id column. Records are the dicts the collectors push, tagged with
+# AccountId and Region.
+TABLES = {
+    'accounts': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('name', 'TEXT', 'Name'),
+        ('email', 'TEXT', 'Email'),
+        ('status', 'TEXT', 'Status'),
+        ('ou_id', 'TEXT', 'OuId'),
+        ('path', 'TEXT', 'Path')
+    ],
+    'stacks': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('region', 'TEXT', 'Region'),
+        ('stack_id', 'TEXT', 'StackId'),
+        ('stack_name', 'TEXT', 'StackName'),
+        ('status', 'TEXT', 'StackStatus'),
+        ('creation_time', 'TEXT', 'CreationTime'),
+        ('last_updated_time', 'TEXT', 'LastUpdatedTime'),
+        ('deletion_time', 'TEXT', 'DeletionTime')
+    ],
+    'subnets': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('region', 'TEXT', 'Region'),
+        ('subnet_id', 'TEXT', 'SubnetId'),
+        ('vpc_id', 'TEXT', 'VpcId'),
+        ('cidr_block', 'TEXT', 'CidrBlock'),
+        ('availability_zone', 'TEXT', 'AvailabilityZone'),
+        ('status', 'TEXT', 'State'),
+        ('available_ip_address_count', 'INTEGER', 'AvailableIpAddressCount'),
+        ('tags', 'TEXT', 'Tags')
+    ],
+    'vpn_connections': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('region', 'TEXT', 'Region'),
+        ('vpn_connection_id', 'TEXT', 'VpnConnectionId'),
+        ('status', 'TEXT', 'State'),
+        ('type', 'TEXT', 'Type'),
+        ('customer_gateway_id', 'TEXT', 'CustomerGatewayId'),
+        ('vpn_gateway_id', 'TEXT', 'VpnGatewayId'),
+        ('transit_gateway_id', 'TEXT', 'TransitGatewayId'),
+        ('tags', 'TEXT', 'Tags')
+    ],
+    'hosted_zones': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('zone_id', 'TEXT', 'Id'),
+        ('name', 'TEXT', 'Name'),
+        ('record_count', 'INTEGER', 'ResourceRecordSetCount')
+    ],
+    'record_sets': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('zone_id', 'TEXT', 'HostedZoneId'),
+        ('zone_name', 'TEXT', 'ZoneName'),
+        ('name', 'TEXT', 'Name'),
+        ('type', 'TEXT', 'Type'),
+        ('ttl', 'INTEGER', 'TTL'),
+        ('resource_records', 'TEXT', 'ResourceRecords'),
+        ('alias_target', 'TEXT', 'AliasTarget'),
+        ('set_identifier', 'TEXT', 'SetIdentifier')
+    ],
+    'trails': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('region', 'TEXT', 'HomeRegion'),
+        ('name', 'TEXT', 'Name'),
+        ('trail_arn', 'TEXT', 'TrailARN'),
+        ('s3_bucket_name', 'TEXT', 'S3BucketName'),
+        ('is_multi_region', 'INTEGER', 'IsMultiRegionTrail'),
+        ('is_organization_trail', 'INTEGER', 'IsOrganizationTrail')
+    ],
+    'certificates': [
+        ('account_id', 'TEXT', 'AccountId'),
+        ('region', 'TEXT', 'Region'),
+        ('certificate_arn', 'TEXT', 'CertificateArn'),
+        ('domain_name', 'TEXT', 'DomainName'),
+        ('status', 'TEXT', 'Status'),
+        ('validation_methods', 'TEXT', 'ValidationMethods')
+    ]
+}
+
+INDEXED_COLUMNS = ('account_id', 'region', 'status')
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return value
+
+
+class InventoryStore():
+    """
+    Local SQLite inventory with one typed table per resource type. Every row
+    carries the run_id of the scan that produced it, so runs can be compared
+    and questions answered without scanning again.
+
+    Example usage:
+    store = InventoryStore()
+    run_id = store.start_run('cfn_inventory')
+    store.insert('stacks', run_id, records)
+    store.finish_run(run_id)
+    store.query(
+        "SELECT account_id, region, stack_name FROM stacks "
+        "WHERE run_id = ? AND status = 'ROLLBACK_FAILED'",
+        (store.latest_run_id('cfn_inventory'),)
+    )
+    """
+
+    def __init__(self, path=INVENTORY_DB):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.__create_schema()
+
+    def __create_schema(self):
+        with self._lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                'run_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'name TEXT, started TEXT, finished TEXT)'
+            )
+            for table, columns in TABLES.items():
+                definition = ', '.join(
+                    f"{column} {column_type}"
+                    for column, column_type, _ in columns)
+                self.db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    f"(run_id INTEGER NOT NULL, {definition})"
+                )
+                self.db.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_run_id "
+                    f"ON {table} (run_id)"
+                )
+                for column, _, _ in columns:
+                    if column in INDEXED_COLUMNS:
+                        self.db.execute(
+                            f"CREATE INDEX IF NOT EXISTS {table}_{column} "
+                            f"ON {table} ({column}, run_id)"
+                        )
+
+    def start_run(self, name):
+        with self._lock, self.db:
+            cursor = self.db.execute(
+                'INSERT INTO runs (name, started) VALUES (?, ?)',
+                (name, datetime.now().isoformat())
+            )
+        return cursor.lastrowid
+
+    def finish_run(self, run_id):
+        with self._lock, self.db:
+            self.db.execute(
+                'UPDATE runs SET finished = ? WHERE run_id = ?',
+                (datetime.now().isoformat(), run_id)
+            )
+
+    def latest_run_id(self, name):
+        """the newest finished run with the given name, None if there is
+        none"""
+        row = self.query(
+            'SELECT MAX(run_id) AS run_id FROM runs '
+            'WHERE name = ? AND finished IS NOT NULL', (name,)
+        )[0]
+        return row['run_id']
+
+    def insert(self, table, run_id, records):
+        """bulk inserts records, keys without a column are ignored"""
+        columns = TABLES[table]
+        names = ', '.join(['run_id'] + [c[0] for c in columns])
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        rows = [
+            [run_id] + [_value(record.get(key)) for _, _, key in columns]
+            for record in records
+        ]
+        with self._lock, self.db:
+            self.db.executemany(
+                f"INSERT INTO {table} ({names}) VALUES ({placeholders})",
+                rows
+            )
+
+    def insert_accounts(self, run_id, snapshot):
+        """stores the accounts of an organization snapshot, see
+        OrganizationsOps.get_org_snapshot"""
+        self.insert('accounts', run_id, [
+            dict(account, AccountId=account_id)
+            for account_id, account in snapshot['Accounts'].items()
+        ])
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self.db.execute(sql, params)]
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteSink(RecordSink):
+    """
+    Sink that writes the records of a collector into one table of an
+    InventoryStore, in the same batches as the file sinks.
+
+    Example usage:
+    with SQLiteSink(store, 'stacks', run_id) as sink:
+        cloudformation_inventory_region(account_id, region, sink)
+    """
+
+    def __init__(self, store, table, run_id, **kwargs):
+        if table not in TABLES:
+            raise ValueError(f"Unknown inventory table {table}")
+        self.store = store
+        self.table = table
+        self.run_id = run_id
+        super().__init__(f"{store.path}:{table}", **kwargs)
+
+    @contextmanager
+    def _open(self):
+        yield self.store
+
+    def _write_batch(self, store, batch):
+        store.insert(self.table, self.run_id, batch)
+
+    def _sync(self, store):
+        pass
@@ -0,0 +1,236 @@
+import logging
+import os
+from functools import partial
+from app.boto_factory import BotoFactory, client_registry
+from app.collectors import COLLECTORS
+from app.incremental import IncrementalCollector
+from app.inventory_store import SQLiteSink
+from app.metrics import metrics
+from app.pagination import GLOBAL
+from app.region_ops import region_resolver
+from app.scheduler import FanOutScheduler
+from app.sinks import JSONLSink, TeeSink
+
+log = logging.getLogger('parseley')
+
+MAX_WORKERS = 20
+MAX_WORKERS_PER_ACCOUNT = 8
+
+
+def output_streams(collectors, incremental=False):
+    """names of the outputs the collectors write: one per collector and one
+    <collector>_delta per incremental collector"""
+    streams = list()
+    for c in collectors:
+        streams.append(c.name)
+        if incremental and c.key is not None:
+            streams.append(f"{c.name}_delta")
+    return streams
+
+
+def open_outputs(collectors, output_dir='out', store=None,
+                 incremental=False, journal=None):
+    """returns (sinks, run_ids), a sink per output stream writing
+    output_dir/<stream>.jsonl and the collector's inventory table, and the
+    inventory run of each collector. With a resumed journal the records of
+    its completed units are carried over from the interrupted run's
+    outputs."""
+    sinks = dict()
+    run_ids = dict()
+    previous = dict()
+    for stream in output_streams(collectors, incremental):
+        filename = os.path.join(output_dir, f"{stream}.jsonl")
+        if journal is not None and journal.resume:
+            previous[stream] = journal.set_aside(filename)
+        sinks[stream] = JSONLSink(filename)
+    for c in collectors:
+        if store is not None and c.table is not None:
+            run_ids[c.name] = store.start_run(c.name)
+            sinks[c.name] = TeeSink(
+                sinks[c.name], SQLiteSink(store, c.table, run_ids[c.name]))
+    for c in collectors:
+        for stream in output_streams([c], incremental):
+            if stream in previous:
+                journal.carry_over(
+                    c.name, previous[stream], sinks[stream],
+                    delta=stream != c.name)
+    return sinks, run_ids
+
+
+def close_outputs(sinks, run_ids, store=None):
+    for sink in sinks.values():
+        sink.close()
+    if store is not None:
+        for run_id in run_ids.values():
+            store.finish_run(run_id)
+
+
+class JobRunner():
+    """
+    Runs several collectors in a single pass over the organization. Every
+    account's credentials and enabled regions are resolved once and shared
+    by all collectors, each (account, region) unit runs every regional
+    collector for that region, and one (account, 'global') unit per account
+    runs the collectors that aren't regional. Each collector streams to its
+    own out/<collector>.jsonl and, with a store, to its inventory table.
+
+    Example usage:
+    runner = JobRunner(session, ['cfn_stacks', 'subnets', 'trails'])
+    failures = runner.run(accounts)
+
+    Parameters:
+        session (boto3.Session): The session that assumes into the accounts
+        collector_names (list): Names from app.collectors.COLLECTORS, or
+            Collector objects such as an OrgQuery's
+        output_dir (str): Where the JSONL outputs are written
+        max_workers (int): Concurrent units across the organization
+        max_per_account (int): Concurrent units per account
+        incremental (bool): Use IncrementalCollector for the collectors that
+            have a key, writing out/<collector>_delta.jsonl
+        journal (RunJournal): (Optional) Skip completed units and carry
+            over their records, journal the new ones
+        store (InventoryStore): (Optional) Also write to the inventory
+        sinks (dict): (Optional) Sink per output stream, as named by
+            output_streams(), instead of opening the files and tables. The
+            caller carries over a resumed journal's records and closes
+            them.
+        regions (dict): (Optional) Enabled regions per account, already
+            resolved by the caller
+        snapshots (UnitSnapshotStore): (Optional) Where the incremental
+            collectors keep the previous run, defaults to CACHE_DIR
+    """
+
+    def __init__(self, session, collector_names, output_dir='out',
+                 max_workers=MAX_WORKERS,
+                 max_per_account=MAX_WORKERS_PER_ACCOUNT, incremental=False,
+                 journal=None, store=None, sinks=None, regions=None,
+                 snapshots=None):
+        unknown = {
+            name for name in collector_names
+            if isinstance(name, str) and name not in COLLECTORS
+        }
+        if unknown:
+            raise ValueError(
+                f"Unknown collectors {sorted(unknown)}, "
+                f"choose from {sorted(COLLECTORS)}")
+        self.session = session
+        self.collectors = [
+            COLLECTORS[c] if isinstance(c, str) else c
+            for c in collector_names
+        ]
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.max_per_account = max_per_account
+        self.incremental = incremental
+        self.journal = journal
+        self.store = store
+        self.sinks = sinks
+        self.regions = regions
+        self.snapshots = snapshots
+
+    def run(self, accounts):
+        """collects every requested inventory, returns the failed units as
+        a list of (account, region, collector, exception). An account whose
+        role can't be assumed fails as a whole, region and collector None"""
+        accounts = list(accounts)
+        client_registry.set_max_pool_connections(self.max_workers)
+        unreachable = BotoFactory().prefetch_credentials(
+            self.session, accounts)
+        accounts = [a for a in accounts if a not in unreachable]
+        failures = [
+            (account, None, None, exc) for account, exc in unreachable.items()
+        ]
+
+        regional = [c for c in self.collectors if c.regional]
+        available = {
+            c.name: set(self.session.get_available_regions(c.service))
+            for c in regional if c.service is not None
+        }
+        enabled = dict()
+        if regional:
+            enabled = self.regions if self.regions is not None else \
+                region_resolver.resolve(self.session, accounts)
+        unit_collectors = dict()
+        for account in accounts:
+            for region in enabled.get(account, []):
+                collectors = [
+                    c for c in regional
+                    if c.service is None or region in available[c.name]
+                ]
+                if collectors:
+                    unit_collectors[(account, region)] = collectors
+            collectors = [c for c in self.collectors if not c.regional]
+            if collectors:
+                unit_collectors[(account, GLOBAL)] = collectors
+
+        if self.sinks is None:
+            sinks, run_ids = open_outputs(
+                self.collectors, self.output_dir, self.store,
+                self.incremental, self.journal)
+        else:
+            sinks, run_ids = self.sinks, dict()
+        try:
+            tasks = {
+                c.name: self.__task(c, sinks[c.name], sinks.get(
+                    f"{c.name}_delta"))
+                for c in self.collectors
+            }
+
+            def run_unit(account, region):
+                unit_failures = list()
+                for c in unit_collectors[(account, region)]:
+                    try:
+                        with metrics.unit(c.name, account, region):
+                            tasks[c.name](account, region)
+                    except Exception as e:
+                        log.error(f"{c.name} {account}:{region}: {e}")
+                        unit_failures.append((account, region, c.name, e))
+                return unit_failures
+
+            scheduler = FanOutScheduler(
+                max_workers=self.max_workers,
+                max_per_account=self.max_per_account
+            )
+            for unit, result, exc in scheduler.run(
+                    run_unit, list(unit_collectors)):
+                if exc is not None:
+                    failures.append(unit + (None, exc))
+                else:
+                    failures.extend(result)
+        finally:
+            if self.sinks is None:
+                close_outputs(sinks, run_ids, self.store)
+
+        log.info(
+            f"Collected {[c.name for c in self.collectors]} from "
+            f"{len(accounts)} accounts, {len(failures)} failed units")
+        return failures
+
+    def __task(self, collector, sink, delta_sink):
+        """fn(account_id, region) that collects one unit into sink"""
+        def fetch(account_id, region):
+            return collector.fetch(
+                self.session, account_id, None if region == GLOBAL else region)
+
+        if delta_sink is not None:
+            signature = None
+            if collector.signature is not None:
+                signature = partial(collector.signature, self.session)
+            incremental = IncrementalCollector(
+                collector.name, fetch, collector.key, signature_fn=signature,
+                store=self.snapshots)
+            if self.journal is not None:
+                return self.journal.wrap(
+                    collector.name, incremental.collect, sink,
+                    delta_sink=delta_sink)
+            collect = partial(incremental.collect, delta_sink=delta_sink)
+        else:
+            def collect(account_id, region, sink):
+                sink.push_many(
+                    dict(r, AccountId=account_id, Region=region)
+                    for r in fetch(account_id, region)
+                )
+
+        if self.journal is not None:
+            return self.journal.wrap(collector.name, collect, sink)
+        return partial(collect, sink=sink)
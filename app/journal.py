@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger('parseley')
+
+JOURNAL = os.getenv('JOURNAL', 'out/journal.jsonl')
+
+
+class _CountingSink():
+    """passes records on to sink and counts them"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.count = 0
+
+    def push(self, record):
+        self.sink.push(record)
+        self.count += 1
+
+    def push_many(self, records):
+        for record in records:
+            self.push(record)
+
+    def flush(self):
+        self.sink.flush()
+
+
+class RunJournal():
+    """
+    Append-only journal of the completed (task, account, region) units and
+    how many records each wrote. The records stream straight to the output
+    sinks, a unit is journaled once its sink has them on disk and every
+    entry is fsync'd. A run that dies halfway can be resumed: completed
+    units are skipped and their records are carried over from the previous
+    output, the records of units that were cut off are dropped.
+
+    Example usage:
+    journal = RunJournal('out/journal.jsonl', resume=True)
+    previous = journal.set_aside('out/cfn_stacks.jsonl')
+    sink = JSONLSink('out/cfn_stacks.jsonl')
+    journal.carry_over('cfn_inventory', previous, sink)
+    task = journal.wrap('cfn_inventory', cloudformation_inventory_region, sink)
+    scheduler.run(task, journal.pending('cfn_inventory', units))
+
+    Parameters:
+        path (str): The journal file
+        resume (bool): Keep the entries of the previous run instead of
+            starting a new journal
+    """
+
+    def __init__(self, path=JOURNAL, resume=False):
+        self.path = path
+        self.resume = resume
+        self._lock = threading.Lock()
+        self._done = set()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if resume:
+            for entry in self.entries():
+                self._done.add(
+                    (entry['Task'], entry['AccountId'], entry['Region']))
+            log.info(f"Resuming with {len(self._done)} completed units")
+        self._file = open(path, 'a' if resume else 'w')
+        if resume and self._file.tell() > 0:
+            # terminate a torn last line so new entries start clean
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def entries(self, task=None):
+        """yields the journal entries, optionally of one task only. A torn
+        last line from a crash is skipped."""
+        try:
+            f = open(self.path)
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning(f"Skipping incomplete line in {self.path}")
+                    continue
+                if task is None or entry['Task'] == task:
+                    yield entry
+
+    def is_done(self, task, account_id, region):
+        with self._lock:
+            return (task, account_id, region) in self._done
+
+    def pending(self, task, units):
+        """the (account, region) units of a task that are not done yet"""
+        for account_id, region in units:
+            if not self.is_done(task, account_id, region):
+                yield (account_id, region)
+
+    def record(self, task, account_id, region, records=0, delta=None):
+        entry = {
+            'Task': task,
+            'AccountId': account_id,
+            'Region': region,
+            'Records': records
+        }
+        if delta is not None:
+            entry['Delta'] = delta
+        line = json.dumps(entry)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._done.add((task, account_id, region))
+
+    def done_units(self, accounts=None):
+        """the completed (task, account, region) units, optionally of some
+        accounts only"""
+        with self._lock:
+            return {
+                unit for unit in self._done
+                if accounts is None or unit[1] in accounts
+            }
+
+    def set_aside(self, filename):
+        """
+        Moves the interrupted run's output out of the way of the new one and
+        returns where it is now, None if there is none. A set aside output
+        whose carry-over was itself cut off is kept, the new output only has
+        part of it.
+        """
+        previous = f"{filename}.resumed"
+        if os.path.exists(previous):
+            return previous
+        if os.path.exists(filename):
+            os.replace(filename, previous)
+            return previous
+        return None
+
+    def carry_over(self, task, previous, sink, delta=False):
+        """
+        Pushes the records of the completed units of a task from previous,
+        an output set aside by set_aside(), to sink and removes previous.
+        Records are matched to their unit by AccountId and Region; delta
+        picks the counts of the task's delta output.
+        """
+        if previous is None:
+            return 0
+        done = {(a, r) for t, a, r in self.done_units() if t == task}
+        expected = sum(
+            entry.get('Delta' if delta else 'Records') or 0
+            for entry in self.entries(task))
+        count = 0
+        with open(previous) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a batch torn by the crash, its unit wasn't journaled
+                    continue
+                if (record.get('AccountId'), record.get('Region')) in done:
+                    sink.push(record)
+                    count += 1
+        sink.flush()
+        os.unlink(previous)
+        if count != expected:
+            log.warning(
+                f"Carried over {count} records from {previous}, the journal "
+                f"has {expected}")
+        else:
+            log.info(f"Carried over {count} records from {previous}")
+        return count
+
+    def wrap(self, task, fn, sink, delta_sink=None):
+        """
+        Turns fn(account_id, region, sink=...) into fn(account_id, region)
+        that skips completed units. The records of new ones go straight to
+        sink, the unit is journaled with their count once sink has flushed
+        them. With delta_sink, fn also gets delta_sink=... and its count is
+        journaled as well.
+        """
+        def journaled(account_id, region):
+            if self.is_done(task, account_id, region):
+                return
+            counted = _CountingSink(sink)
+            if delta_sink is None:
+                fn(account_id, region, sink=counted)
+                counted.flush()
+                self.record(task, account_id, region, counted.count)
+            else:
+                delta = _CountingSink(delta_sink)
+                fn(account_id, region, sink=counted, delta_sink=delta)
+                counted.flush()
+                delta.flush()
+                self.record(task, account_id, region, counted.count,
+                            delta.count)
+        return journaled
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,57 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+log = logging.getLogger('parseley')
+
+CACHE_DIR = os.getenv('PARSELEY_CACHE_DIR', 'cache')
+
+
+class JSONCache():
+    """
+    A JSON document persisted under CACHE_DIR that survives between runs.
+    Writes are atomic, and documents older than ttl seconds are treated as
+    missing.
+
+    Example usage:
+    cache = JSONCache('org_snapshot', ttl=3600)
+    snapshot = cache.load()
+    if snapshot is None:
+        snapshot = build_snapshot()
+        cache.save(snapshot)
+    """
+
+    def __init__(self, name, ttl=None):
+        self.path = os.path.join(CACHE_DIR, f"{name}.json")
+        self.ttl = ttl
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                document = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            log.warning(f"Ignoring unreadable cache {self.path}: {e}")
+            return None
+
+        if self.ttl is not None and \
+                time.time() - document['created'] > self.ttl:
+            log.info(f"Cache {self.path} is older than {self.ttl}s")
+            return None
+        return document['data']
+
+    def save(self, data):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(
+                    {'created': time.time(), 'data': data}, f, default=str)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
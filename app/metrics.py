@@ -0,0 +1,308 @@
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from app.rate_limiter import THROTTLE_CODES
+
+log = logging.getLogger('parseley')
+
+METRICS_DIR = os.getenv('METRICS_DIR', 'out')
+# upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+CALL_LABELS = ('service', 'operation', 'account', 'region')
+UNIT_LABELS = ('collector', 'account', 'region')
+
+
+class Histogram():
+    """latency histogram with fixed LATENCY_BUCKETS"""
+
+    def __init__(self, counts=None, total=0.0):
+        self.counts = counts or [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),),
+                                self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+
+class _CallStats():
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+
+class MetricsRecorder():
+    """
+    Collects per-API-call metrics from boto3 clients through botocore
+    events, keyed by (service, operation, account, region): calls, errors,
+    retries, throttles, response bytes and a latency histogram of every
+    call with its retries. Latency is timed from sending each attempt to
+    its response, so time waiting for the rate limiter or between retries
+    is not counted. Work units are timed with unit(). At the end of a run
+    the numbers are written as a JSON summary, with every unit, and a
+    Prometheus textfile, with a unit duration histogram per collector.
+
+    Example usage:
+    metrics.attach(client, '123456789012', 'eu-west-1')
+    with metrics.unit('subnets', '123456789012', 'eu-west-1'):
+        ...
+    metrics.write()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+        self._units = dict()
+
+    def attach(self, client, account_id, region):
+        service = client.meta.service_model.service_name
+        key = partial(self.__key, service, account_id, region)
+        events = client.meta.events
+        # first, so other before-send handlers are not timed
+        events.register_first('before-send', self._on_before_send)
+        events.register('response-received', self._on_response_received)
+        events.register('needs-retry', partial(self._on_needs_retry, key))
+        events.register('after-call', partial(self._on_after_call, key))
+        events.register(
+            'after-call-error', partial(self._on_after_call_error, key))
+
+    @staticmethod
+    def __key(service, account_id, region, operation):
+        return (service, operation, str(account_id), region or 'global')
+
+    def __stats(self, key):
+        stats = self._calls.get(key)
+        if stats is None:
+            stats = self._calls[key] = _CallStats()
+        return stats
+
+    @staticmethod
+    def _on_before_send(request, **kwargs):
+        request.context['metrics_start'] = time.perf_counter()
+
+    @staticmethod
+    def _on_response_received(context, **kwargs):
+        """every attempt, retries included"""
+        start = context.pop('metrics_start', None)
+        if start is not None:
+            context['metrics_elapsed'] = context.get(
+                'metrics_elapsed', 0.0) + time.perf_counter() - start
+
+    def _on_needs_retry(self, key, operation, response=None, **kwargs):
+        if response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            with self._lock:
+                self.__stats(key(operation.name)).throttles += 1
+        return None
+
+    def _on_after_call(self, key, model, http_response, parsed, context,
+                       **kwargs):
+        elapsed = context.get('metrics_elapsed', 0.0)
+        # the body is already read unless the output streams
+        body = getattr(http_response, '_content', None)
+        size = len(body) if isinstance(body, bytes) else int(
+            http_response.headers.get('content-length', 0))
+        with self._lock:
+            stats = self.__stats(key(model.name))
+            stats.calls += 1
+            stats.latency.observe(elapsed)
+            stats.bytes += size
+            stats.retries += parsed.get(
+                'ResponseMetadata', {}).get('RetryAttempts', 0)
+            if http_response.status_code >= 300:
+                stats.errors += 1
+
+    def _on_after_call_error(self, key, event_name, context, **kwargs):
+        """connection errors and the like, there was no response"""
+        elapsed = context.get('metrics_elapsed', 0.0)
+        with self._lock:
+            stats = self.__stats(key(event_name.split('.')[-1]))
+            stats.calls += 1
+            stats.errors += 1
+            stats.latency.observe(elapsed)
+
+    @contextmanager
+    def unit(self, collector, account_id, region):
+        """times one work unit, failed units included"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._units[(collector, account_id, region)] = \
+                    time.perf_counter() - start
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._units.clear()
+
+    def summary(self):
+        """JSON friendly summary of everything recorded"""
+        with self._lock:
+            calls = [
+                dict(zip(CALL_LABELS, key), **{
+                    'calls': s.calls,
+                    'errors': s.errors,
+                    'retries': s.retries,
+                    'throttles': s.throttles,
+                    'bytes': s.bytes,
+                    'latency_sum': round(s.latency.total, 6),
+                    'latency_p50': s.latency.quantile(0.5),
+                    'latency_p99': s.latency.quantile(0.99),
+                    'latency_buckets': list(s.latency.counts)
+                }) for key, s in sorted(self._calls.items())
+            ]
+            units = [
+                dict(zip(UNIT_LABELS, key), seconds=round(seconds, 3))
+                for key, seconds in sorted(
+                    self._units.items(), key=lambda i: -i[1])
+            ]
+        return {
+            'latency_buckets': list(LATENCY_BUCKETS),
+            'totals': {
+                name: sum(c[name] for c in calls) for name in
+                ('calls', 'errors', 'retries', 'throttles', 'bytes')
+            },
+            'calls': calls,
+            'units': units
+        }
+
+    def merge(self, summary):
+        """adds a summary from another process, e.g. a shard"""
+        with self._lock:
+            for row in summary['calls']:
+                stats = self.__stats(tuple(row[k] for k in CALL_LABELS))
+                stats.calls += row['calls']
+                stats.errors += row['errors']
+                stats.retries += row['retries']
+                stats.throttles += row['throttles']
+                stats.bytes += row['bytes']
+                stats.latency.merge(Histogram(
+                    row['latency_buckets'], row['latency_sum']))
+            for row in summary['units']:
+                self._units[tuple(row[k] for k in UNIT_LABELS)] = \
+                    row['seconds']
+
+    def prometheus(self, summary=None):
+        """the summary in the Prometheus text exposition format"""
+        if summary is None:
+            summary = self.summary()
+        lines = list()
+        counters = [
+            ('calls', 'parseley_api_calls_total', 'API calls'),
+            ('errors', 'parseley_api_errors_total', 'Failed API calls'),
+            ('retries', 'parseley_api_retries_total', 'Retried attempts'),
+            ('throttles', 'parseley_api_throttles_total',
+             'Throttled attempts'),
+            ('bytes', 'parseley_api_response_bytes_total',
+             'Response body bytes')
+        ]
+        for field, name, help_text in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [
+                f"{name}{{{_labels(row, CALL_LABELS)}}} {row[field]}"
+                for row in summary['calls']
+            ]
+
+        name = 'parseley_api_call_duration_seconds'
+        lines += [f"# HELP {name} API call latency, every attempt on the wire",
+                  f"# TYPE {name} histogram"]
+        for row in summary['calls']:
+            labels = _labels(row, CALL_LABELS)
+            cumulative = 0
+            for bound, count in zip(
+                    summary['latency_buckets'] + ['+Inf'],
+                    row['latency_buckets']):
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket{{{labels},le=\"{bound}\"}} {cumulative}")
+            lines.append(f"{name}_sum{{{labels}}} {row['latency_sum']}")
+            lines.append(f"{name}_count{{{labels}}} {cumulative}")
+
+        # one series per collector, a label per account and region would
+        # grow with the organization
+        units = dict()
+        for row in summary['units']:
+            units.setdefault(row['collector'], Histogram()).observe(
+                row['seconds'])
+        name = 'parseley_unit_duration_seconds'
+        lines += [f"# HELP {name} Wall time of the work units",
+                  f"# TYPE {name} histogram"]
+        for collector, histogram in sorted(units.items()):
+            labels = _labels({'collector': collector}, ('collector',))
+            cumulative = 0
+            for bound, count in zip(
+                    summary['latency_buckets'] + ['+Inf'],
+                    histogram.counts):
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket{{{labels},le=\"{bound}\"}} {cumulative}")
+            lines.append(
+                f"{name}_sum{{{labels}}} {round(histogram.total, 6)}")
+            lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory=METRICS_DIR):
+        """writes metrics.json and metrics.prom, atomically so a textfile
+        collector never reads half a file"""
+        summary = self.summary()
+        _write_atomic(os.path.join(directory, 'metrics.json'),
+                      json.dumps(summary, indent=4))
+        _write_atomic(os.path.join(directory, 'metrics.prom'),
+                      self.prometheus(summary))
+        log.info(f"API metrics: {summary['totals']}")
+
+
+def _labels(row, names):
+    return ','.join(
+        f"{name}=\"{str(row[name]).replace(chr(34), '')}\"" for name in names)
+
+
+def _write_atomic(path, content):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+metrics = MetricsRecorder()
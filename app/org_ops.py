@@ -1,11 +1,16 @@
 import boto3
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from app.boto_factory import BotoFactory
+from app.json_cache import JSONCache
 
 log = logging.getLogger('parseley')
 log.setLevel(os.environ.get('LOGLEVEL'))
 
+ORG_MAX_WORKERS = 4
+ORG_SNAPSHOT_TTL = int(os.getenv('ORG_SNAPSHOT_TTL', 12 * 3600))
+
 
 class OrganizationsOps():
 
@@ -19,8 +24,14 @@ class OrganizationsOps():
             )
             self.blocklist = set()
 
-        self.org = BotoFactory().get_capability(
-            boto3.client, session, 'organizations'
+        self.session = session
+
+    @property
+    def org(self):
+        """created on first use, so snapshot hits don't assume a role"""
+        return BotoFactory().get_capability(
+            boto3.client, self.session, 'organizations',
+            account_id=os.getenv('ORG_ACCOUNT', '')
         )
 
     def get_all_children_ou(self, parent_ou):
@@ -56,7 +67,103 @@ class OrganizationsOps():
         return accounts
 
     def get_accounts_from_root(self):
+        """active accounts in the OUs below root, blocklisted OUs excluded"""
+        snapshot = self.get_org_snapshot()
+        return [
+            account_id for account_id, account in
+            snapshot['Accounts'].items() if
+            account['Status'] == 'ACTIVE' and
+            account['OuId'] != snapshot['RootId']
+        ]
+
+    def get_org_snapshot(self, refresh=False):
+        """
+        Returns the organization structure, from the local snapshot if it is
+        younger than ORG_SNAPSHOT_TTL seconds:
+
+        {
+            "RootId": "r-xxxx",
+            "Blocklist": ["ou-xxxx-xxxxxxxx"],
+            "OUs": {
+                "ou-xxxx-xxxxxxxx": {
+                    "Name": "Workloads",
+                    "ParentId": "r-xxxx",
+                    "Path": "/Workloads/"
+                }
+            },
+            "Accounts": {
+                "123456789012": {
+                    "Name": "prod",
+                    "Email": "prod@example.com",
+                    "Status": "ACTIVE",
+                    "OuId": "ou-xxxx-xxxxxxxx",
+                    "Path": "/Workloads/"
+                }
+            }
+        }
+        """
+        cache = JSONCache('org_snapshot', ttl=ORG_SNAPSHOT_TTL)
+        if not refresh:
+            snapshot = cache.load()
+            if snapshot is not None and \
+                    snapshot['Blocklist'] == sorted(self.blocklist):
+                log.info(f"Using organization snapshot {cache.path}")
+                return snapshot
+
+        snapshot = self.build_org_snapshot()
+        cache.save(snapshot)
+        return snapshot
+
+    def build_org_snapshot(self):
+        """walks the OU tree breadth first, listing each level concurrently"""
         root_ou = self.org.list_roots()['Roots'][0]['Id']
-        return self.get_active_accounts_from_ous(
-            self.get_all_children_ou(root_ou)
-        )
+        ous = {root_ou: {'Name': 'Root', 'ParentId': None, 'Path': '/'}}
+        accounts = dict()
+
+        level = [root_ou]
+        with ThreadPoolExecutor(max_workers=ORG_MAX_WORKERS) as executor:
+            while level:
+                log.info(f"Listing {len(level)} OUs")
+                children = executor.map(self.__list_children_ou, level)
+                members = executor.map(self.__list_accounts_for_ou, level)
+                next_level = list()
+                for parent, child_ous, ou_accounts in \
+                        zip(level, children, members):
+                    path = ous[parent]['Path']
+                    for ou in child_ous:
+                        if ou['Id'] in self.blocklist:
+                            continue
+                        ous[ou['Id']] = {
+                            'Name': ou['Name'],
+                            'ParentId': parent,
+                            'Path': f"{path}{ou['Name']}/"
+                        }
+                        next_level.append(ou['Id'])
+                    for account in ou_accounts:
+                        accounts[account['Id']] = {
+                            'Name': account['Name'],
+                            'Email': account['Email'],
+                            'Status': account['Status'],
+                            'OuId': parent,
+                            'Path': path
+                        }
+                level = next_level
+
+        return {
+            'RootId': root_ou,
+            'Blocklist': sorted(self.blocklist),
+            'OUs': ous,
+            'Accounts': accounts
+        }
+
+    def __list_children_ou(self, parent_ou):
+        pgnt = self.org.get_paginator('list_organizational_units_for_parent')
+        return pgnt.paginate(
+            ParentId=parent_ou
+        ).build_full_result()['OrganizationalUnits']
+
+    def __list_accounts_for_ou(self, parent_ou):
+        pgnt = self.org.get_paginator('list_accounts_for_parent')
+        return pgnt.paginate(
+            ParentId=parent_ou
+        ).build_full_result()['Accounts']
@@ -0,0 +1,26 @@
+GLOBAL = 'global'
+
+
+def paginate(client, operation, result_key=None, **kwargs):
+    """
+    Yields the items of every page of a paginated operation, one page
+    requested at a time, so a consumer that stops early never pays for the
+    remaining pages. result_key defaults to the operation's first result
+    key, e.g. Subnets for describe_subnets.
+
+    Example usage:
+    for subnet in paginate(ec2, 'describe_subnets'):
+        print(subnet['SubnetId'])
+    """
+    paginator = client.get_paginator(operation)
+    if result_key is None:
+        result_key = paginator.result_keys[0].expression
+    for page in paginator.paginate(**kwargs):
+        yield from page.get(result_key) or []
+
+
+def tagged(items, account_id, region=None):
+    """the items as new dicts with AccountId and Region, global services
+    get Region 'global'"""
+    for item in items:
+        yield dict(item, AccountId=account_id, Region=region or GLOBAL)
@@ -0,0 +1,212 @@
+import boto3
+import copy
+import jmespath
+import logging
+from app.boto_factory import BotoFactory
+from app.collectors import Collector
+from app.pagination import tagged
+
+log = logging.getLogger('parseley')
+
+READ_ONLY_PREFIXES = ('describe_', 'list_', 'get_', 'search_', 'lookup_')
+TAG_PREFIX = 'tag:'
+# match fields the API can filter on itself, per (service, operation):
+# field: (parameter, EC2 filter name) or (parameter, None) for a parameter
+# that takes the list of values directly. Matching is still checked on the
+# results, the pushdown only saves transferring what can't match.
+PUSHDOWN = {
+    ('ec2', 'describe_subnets'): {
+        'VpcId': ('Filters', 'vpc-id'),
+        'State': ('Filters', 'state'),
+        'AvailabilityZone': ('Filters', 'availability-zone'),
+        'CidrBlock': ('Filters', 'cidr-block'),
+        'DefaultForAz': ('Filters', 'default-for-az'),
+        'MapPublicIpOnLaunch': ('Filters', 'map-public-ip-on-launch')
+    },
+    ('ec2', 'describe_security_groups'): {
+        'GroupName': ('Filters', 'group-name'),
+        'VpcId': ('Filters', 'vpc-id'),
+        'IpPermissions[].IpRanges[].CidrIp': ('Filters', 'ip-permission.cidr'),
+        'IpPermissions[].FromPort': ('Filters', 'ip-permission.from-port'),
+        'IpPermissions[].ToPort': ('Filters', 'ip-permission.to-port')
+    },
+    ('ec2', 'describe_vpcs'): {
+        'CidrBlock': ('Filters', 'cidr'),
+        'IsDefault': ('Filters', 'is-default'),
+        'State': ('Filters', 'state')
+    },
+    ('ec2', 'describe_volumes'): {
+        'State': ('Filters', 'status'),
+        'Encrypted': ('Filters', 'encrypted'),
+        'VolumeType': ('Filters', 'volume-type'),
+        'AvailabilityZone': ('Filters', 'availability-zone')
+    },
+    ('ec2', 'describe_vpn_connections'): {
+        'State': ('Filters', 'state'),
+        'Type': ('Filters', 'type'),
+        'VpnGatewayId': ('Filters', 'vpn-gateway-id'),
+        'CustomerGatewayId': ('Filters', 'customer-gateway-id')
+    },
+    ('cloudformation', 'list_stacks'): {
+        'StackStatus': ('StackStatusFilter', None)
+    },
+    ('acm', 'list_certificates'): {
+        'Status': ('CertificateStatuses', None)
+    }
+}
+
+
+def _value(value):
+    """values as the API filters and the command line spell them"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+class OrgQuery():
+    """
+    Runs one read-only boto3 operation in every account and region and
+    keeps only what was asked for. match conditions the API can evaluate
+    are pushed down into its own parameters (EC2 Filters, list_stacks
+    StackStatusFilter, ...), so less is transferred; where is a JMESPath
+    predicate checked on every item, and select a JMESPath projection
+    applied as the items arrive, so only the projected fields are kept
+    and written.
+
+    Example usage:
+    query = OrgQuery(
+        'ec2', 'describe_security_groups',
+        match={'IpPermissions[].IpRanges[].CidrIp': ['0.0.0.0/0']},
+        select='{GroupId: GroupId, GroupName: GroupName, VpcId: VpcId}')
+    JobRunner(session, [query.collector()]).run(accounts)
+
+    Parameters:
+        service (str): boto3 service name, e.g. ec2
+        operation (str): A describe_/list_/get_ operation of the service
+        params (dict): (Optional) Parameters passed to every call
+        match (dict): (Optional) JMESPath field: list of accepted values,
+            tag:<Key> matches a tag value
+        where (str): (Optional) JMESPath predicate, e.g. '!Tags'
+        select (str): (Optional) JMESPath projection of every item
+        result_key (str): (Optional) Result key of the pages, defaults to
+            the operation's first one
+        name (str): (Optional) Output name, defaults to query_<operation>
+    """
+
+    def __init__(self, service, operation, params=None, match=None,
+                 where=None, select=None, result_key=None, name=None):
+        if not operation.startswith(READ_ONLY_PREFIXES):
+            raise ValueError(
+                f"{operation} is not a read-only operation, queries run "
+                f"{', '.join(p + '*' for p in READ_ONLY_PREFIXES)}")
+        self.service = service
+        self.operation = operation
+        self.result_key = result_key
+        self.name = name or f"query_{operation}"
+        self.match = {
+            field: {_value(v) for v in (
+                values if isinstance(values, (list, tuple, set))
+                else [values])}
+            for field, values in (match or dict()).items()
+        }
+        self._fields = {
+            field: jmespath.compile(field) for field in self.match
+            if not field.startswith(TAG_PREFIX)
+        }
+        self._where = jmespath.compile(where) if where else None
+        self._select = jmespath.compile(select) if select else None
+        self.params, self.pushed = self.__push_down(
+            copy.deepcopy(params or dict()))
+        if self.pushed:
+            log.info(f"{self.name}: pushed down {sorted(self.pushed)}")
+
+    def __push_down(self, params):
+        """params with the pushed down match conditions, and the fields
+        that were pushed"""
+        pushdown = PUSHDOWN.get((self.service, self.operation), dict())
+        # every EC2 describe with Filters takes tag:<Key>
+        tags = self.service == 'ec2' and self.operation.startswith(
+            'describe_')
+        pushed = set()
+        for field, values in self.match.items():
+            if field.startswith(TAG_PREFIX) and tags:
+                parameter, filter_name = 'Filters', field
+            elif field in pushdown:
+                parameter, filter_name = pushdown[field]
+            else:
+                continue
+            if filter_name is None:
+                params[parameter] = sorted(values)
+            else:
+                params.setdefault(parameter, []).append(
+                    {'Name': filter_name, 'Values': sorted(values)})
+            pushed.add(field)
+        return params, pushed
+
+    def matches(self, item):
+        for field, values in self.match.items():
+            if field.startswith(TAG_PREFIX):
+                key = field[len(TAG_PREFIX):]
+                found = [
+                    t.get('Value') for t in item.get('Tags') or []
+                    if t.get('Key') == key
+                ]
+            else:
+                found = self._fields[field].search(item)
+            if not isinstance(found, list):
+                found = [found]
+            if not any(_value(v) in values for v in found if v is not None):
+                return False
+        if self._where is not None and not self._where.search(item):
+            return False
+        return True
+
+    def project(self, item):
+        if self._select is None:
+            return item
+        projected = self._select.search(item)
+        if isinstance(projected, dict):
+            return projected
+        return {'Value': projected}
+
+    def items(self, client):
+        """the matching, projected items of one client's account and
+        region, page by page"""
+        if client.can_paginate(self.operation):
+            paginator = client.get_paginator(self.operation)
+            result_key = self.result_key or \
+                paginator.result_keys[0].expression
+            # every unit gets its own copy, handlers may change the params
+            pages = paginator.paginate(**copy.deepcopy(self.params))
+        else:
+            result_key = self.result_key
+            pages = [getattr(client, self.operation)(
+                **copy.deepcopy(self.params))]
+        for page in pages:
+            if result_key is None:
+                result_key = next(
+                    k for k in page if k != 'ResponseMetadata')
+            items = page.get(result_key) or []
+            # singleton results such as get_account_password_policy's
+            if not isinstance(items, list):
+                items = [items]
+            for item in items:
+                if self.matches(item):
+                    yield self.project(item)
+
+    def fetch(self, session, account_id, region):
+        client = BotoFactory().get_capability(
+            boto3.client, session, self.service, account_id=account_id,
+            region=region or ''
+        )
+        return tagged(self.items(client), account_id, region)
+
+    def collector(self, session=None):
+        """the query as a Collector for the JobRunner, global services
+        run once per account"""
+        session = session or boto3.Session()
+        return Collector(
+            self.name, self.fetch,
+            regional=bool(session.get_available_regions(self.service)),
+            service=self.service
+        )
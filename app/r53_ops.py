@@ -1,4 +1,18 @@
 import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.json_cache import JSONCache
+from app.pagination import paginate, tagged
+
+R53_MAX_WORKERS = 5
+RECORD_SET_CACHE_TTL = int(os.getenv('RECORD_SET_CACHE_TTL', 24 * 3600))
+# larger zones are streamed page by page and never cached
+RECORD_SET_CACHE_MAX = 10000
+PAGE_QUEUE_TIMEOUT = 1
+
+_ZONE_DONE = object()
 
 
 class Route53Ops():
@@ -6,17 +20,116 @@ class Route53Ops():
     Class for running Route 53 specific operations
     """
 
-    def __init__(self, client=''):
+    def __init__(self, client='', account_id=None):
         if client == '':
             raise AttributeError('No Route53 client specified')
         self.route53cl = client
+        self.account_id = account_id
 
     def get_all_hosted_zones(self):
+        return [str(z.get('Name')) for z in self.iter_hosted_zones()]
+
+    def list_hosted_zones(self):
+        """returns the full list_hosted_zones entries"""
         hosted_zones_list = list()
-        pgnt = self.route53cl.get_paginator('list_hosted_zones')
-        itr = pgnt.paginate()
-        for i in itr:
-            for z in i.get('HostedZones'):
-                logging.info(f"{z.get('Id')}:{z.get('Name')}")
-                hosted_zones_list.append(str(z.get('Name')))
+        for z in paginate(self.route53cl, 'list_hosted_zones'):
+            logging.info(f"{z.get('Id')}:{z.get('Name')}")
+            hosted_zones_list.append(z)
         return hosted_zones_list
+
+    def iter_hosted_zones(self):
+        """yields the hosted zones as their pages arrive, tagged with the
+        AccountId given to the constructor and Region global"""
+        return tagged(paginate(self.route53cl, 'list_hosted_zones'),
+                      self.account_id)
+
+    def iter_record_sets(self, max_workers=R53_MAX_WORKERS,
+                         cache_ttl=RECORD_SET_CACHE_TTL):
+        """
+        Yields every record set of every hosted zone, tagged with
+        HostedZoneId and ZoneName, page by page as they arrive. Zones are
+        paged concurrently by max_workers threads, the client's rate limiter
+        keeps them within the per-account Route 53 limit. A zone whose
+        ResourceRecordSetCount didn't change since it was last listed, less
+        than cache_ttl seconds ago, is read from the cache instead; zones
+        above RECORD_SET_CACHE_MAX record sets are not cached.
+
+        Example usage:
+        sink.push_many(Route53Ops(client=r53_client).iter_record_sets())
+        """
+        zones = self.list_hosted_zones()
+        pages = queue.Queue(maxsize=max_workers * 2)
+        stop = threading.Event()
+        errors = list()
+
+        def put(item):
+            # gives up once the consumer went away
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=PAGE_QUEUE_TIMEOUT)
+                    return
+                except queue.Full:
+                    continue
+
+        def list_zone(zone):
+            try:
+                for page in self.__record_set_pages(zone, cache_ttl):
+                    put(page)
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                logging.error(f"Listing record sets of {zone['Id']}: {e}")
+                errors.append(e)
+            finally:
+                put(_ZONE_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = list()
+        try:
+            for zone in zones:
+                futures.append(executor.submit(list_zone, zone))
+            remaining = len(zones)
+            while remaining:
+                page = pages.get()
+                if page is _ZONE_DONE:
+                    remaining -= 1
+                    continue
+                yield from page
+        finally:
+            stop.set()
+            # a consumer that stopped early doesn't wait for queued zones,
+            # cancelled by hand as shutdown() only cancels them from 3.9
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+        if errors:
+            raise RuntimeError(
+                f"{len(errors)} of {len(zones)} zones failed, "
+                f"first error: {errors[0]}")
+
+    def __record_set_pages(self, zone, cache_ttl):
+        zone_id = zone['Id'].split('/')[-1]
+        count = zone.get('ResourceRecordSetCount')
+        cache = JSONCache(f"route53_records_{zone_id}", ttl=cache_ttl)
+        cached = cache.load()
+        if cached is not None and cached['ResourceRecordSetCount'] == count:
+            yield self.__tag(zone, cached['RecordSets'])
+            return
+
+        cacheable = count is not None and count <= RECORD_SET_CACHE_MAX
+        record_sets = list()
+        pgnt = self.route53cl.get_paginator('list_resource_record_sets')
+        for page in pgnt.paginate(HostedZoneId=zone['Id']):
+            if cacheable:
+                record_sets += page['ResourceRecordSets']
+            yield self.__tag(zone, page['ResourceRecordSets'])
+        if cacheable:
+            cache.save({'ResourceRecordSetCount': count,
+                        'RecordSets': record_sets})
+
+    @staticmethod
+    def __tag(zone, record_sets):
+        return [
+            dict(r, HostedZoneId=zone['Id'], ZoneName=zone['Name'])
+            for r in record_sets
+        ]
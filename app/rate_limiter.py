@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+from functools import partial
+
+log = logging.getLogger('parseley')
+
+THROTTLE_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'PriorRequestNotComplete',
+    'SlowDown'
+}
+
+# starting requests per second of every bucket of a service, the buckets
+# adapt from here
+DEFAULT_RATES = {
+    'organizations': 2,
+    'sts': 5,
+    'iam': 5,
+    'route53': 5,
+    'cloudtrail': 5,
+    'acm': 10,
+    'cloudformation': 10,
+    'ec2': 50
+}
+DEFAULT_RATE = 10
+# services whose limit is shared by every operation of an account in every
+# region, they get one bucket per account
+ACCOUNT_WIDE = {'route53'}
+MIN_RATE = 0.5
+MAX_RATE = 200
+DECREASE_FACTOR = 0.5
+
+
+class TokenBucket():
+    """
+    Token bucket with an additive-increase/multiplicative-decrease rate. Every
+    successful call raises the rate so it grows by roughly one request per
+    second each second, every throttling error halves it.
+    """
+
+    def __init__(self, rate, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """blocks until a request may be sent"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                max(self.rate, 1.0),
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+        log.debug(f"Throttled, rate lowered to {self.rate:.2f}/s")
+
+
+class AdaptiveRateLimiter():
+    """
+    Keeps one TokenBucket per (service, operation, account, region), or per
+    (service, account) for the ACCOUNT_WIDE services, and hooks them into
+    boto3 clients through botocore events. Every attempt, retries
+    included, takes a token; throttling errors shrink the rate of their
+    bucket and successful calls grow it again.
+
+    Example usage:
+    rate_limiter.attach(client, '123456789012', 'eu-west-1')
+    """
+
+    def __init__(self, rates=None, default_rate=DEFAULT_RATE):
+        self.rates = dict(DEFAULT_RATES if rates is None else rates)
+        self.default_rate = default_rate
+        self._lock = threading.Lock()
+        self._buckets = dict()
+
+    def bucket(self, service, operation, account_id, region):
+        if service in ACCOUNT_WIDE:
+            operation, region = None, None
+        key = (service, operation, account_id, region)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(
+                    self.rates.get(service, self.default_rate))
+                self._buckets[key] = bucket
+        return bucket
+
+    def rates_snapshot(self):
+        """current rate of every bucket, useful for tuning DEFAULT_RATES"""
+        with self._lock:
+            return {key: bucket.rate for key, bucket in self._buckets.items()}
+
+    def attach(self, client, account_id, region):
+        service = client.meta.service_model.service_name
+        bucket = partial(self.bucket, service, account_id=account_id,
+                         region=region)
+        events = client.meta.events
+        events.register('request-created', partial(self._on_request, bucket))
+        events.register('needs-retry', partial(self._on_needs_retry, bucket))
+        events.register('after-call', partial(self._on_after_call, bucket))
+
+    @staticmethod
+    def _on_request(bucket, operation_name=None, **kwargs):
+        if operation_name is not None:
+            bucket(operation_name).acquire()
+
+    @staticmethod
+    def _on_needs_retry(bucket, operation, response=None, **kwargs):
+        if response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            bucket(operation.name).on_throttle()
+        return None
+
+    @staticmethod
+    def _on_after_call(bucket, model, http_response, **kwargs):
+        if http_response.status_code < 300:
+            bucket(model.name).on_success()
+
+
+rate_limiter = AdaptiveRateLimiter()
@@ -0,0 +1,90 @@
+import boto3
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.boto_factory import BotoFactory
+from app.json_cache import JSONCache
+
+log = logging.getLogger('parseley')
+
+REGIONS_TTL = int(os.getenv('REGIONS_TTL', 7 * 24 * 3600))
+MAX_REGION_WORKERS = 20
+
+
+class RegionResolver():
+    """
+    Finds the regions that are enabled in each account by calling
+    describe_regions in the account itself, so disabled opt-in regions are
+    never scheduled. Results are cached across runs for REGIONS_TTL seconds
+    and can be narrowed down to the regions a service is available in.
+
+    Example usage:
+    region_resolver.enabled_regions(session, '123456789012', 'acm')
+    region_resolver.resolve(session, accounts, 'cloudformation')
+    """
+
+    def __init__(self, ttl=REGIONS_TTL):
+        self.ttl = ttl
+        self._cache = JSONCache('enabled_regions')
+        self._lock = threading.Lock()
+        self._regions = None
+
+    def enabled_regions(self, session, account_id, service=None, save=True):
+        """returns the sorted regions enabled in the account, an empty list
+        if the account can't be reached"""
+        with self._lock:
+            self.__load()
+            entry = self._regions.get(account_id)
+        if entry is None or time.time() - entry['Fetched'] > self.ttl:
+            try:
+                regions = self.__describe_regions(session, account_id)
+            except Exception as e:
+                log.error(f"Could not list regions of {account_id}: {e}")
+                return list()
+            entry = {'Regions': regions, 'Fetched': time.time()}
+            with self._lock:
+                self._regions[account_id] = entry
+            if save:
+                self.save()
+
+        regions = entry['Regions']
+        if service is not None:
+            available = set(session.get_available_regions(service))
+            regions = [r for r in regions if r in available]
+        return regions
+
+    def resolve(self, session, accounts, service=None,
+                max_workers=MAX_REGION_WORKERS):
+        """dict of account ID to its enabled regions, for FanOutScheduler.
+        Accounts that are not cached yet are looked up in parallel."""
+        accounts = list(accounts)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            regions = list(executor.map(
+                lambda a: self.enabled_regions(
+                    session, a, service, save=False),
+                accounts
+            ))
+        self.save()
+        return dict(zip(accounts, regions))
+
+    def save(self):
+        with self._lock:
+            if self._regions is not None:
+                self._cache.save(self._regions)
+
+    def __load(self):
+        if self._regions is None:
+            self._regions = self._cache.load() or dict()
+
+    def __describe_regions(self, session, account_id):
+        ec2 = BotoFactory().get_capability(
+            boto3.client, session, 'ec2', account_id=account_id
+        )
+        return sorted(
+            r['RegionName'] for r in ec2.describe_regions()['Regions']
+        )
+
+
+region_resolver = RegionResolver()
@@ -0,0 +1,106 @@
+import logging
+import queue
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('parseley')
+
+
+class FanOutScheduler():
+    """
+    Runs a function over (account, region) work units under one global
+    concurrency bound, so a scan is not limited by the slowest account's
+    serial region loop. Optional per-account and per-region caps keep a
+    single account or region from taking all workers.
+
+    Example usage:
+    scheduler = FanOutScheduler(max_workers=40, max_per_account=4)
+    units = FanOutScheduler.units(accounts, regions)
+    for unit, result, exc in scheduler.run(fn, units):
+        ...
+
+    Parameters:
+        max_workers (int): The global number of concurrent work units
+        max_per_account (int): (Optional) Concurrent work units per account
+        max_per_region (int): (Optional) Concurrent work units per region
+    """
+
+    def __init__(self, max_workers=20, max_per_account=None,
+                 max_per_region=None):
+        self.max_workers = max_workers
+        self.max_per_account = max_per_account
+        self.max_per_region = max_per_region
+
+    @staticmethod
+    def units(accounts, regions):
+        """every (account, region) pair, regions can be a list shared by all
+        accounts or a dict of account ID to its own region list"""
+        for account in accounts:
+            account_regions = regions[account] \
+                if isinstance(regions, dict) else regions
+            for region in account_regions:
+                yield (account, region)
+
+    def run(self, fn, units):
+        """
+        Calls fn(account_id, region) for every unit and yields
+        (unit, result, exception) as the units complete. Exactly one of result
+        and exception is set.
+        """
+        pending = OrderedDict()
+        for account, region in units:
+            pending.setdefault(account, deque()).append(region)
+
+        running_accounts = dict()
+        running_regions = dict()
+        running = 0
+        done = queue.Queue()
+
+        def on_done(unit, future):
+            done.put((unit, future))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                while running < self.max_workers:
+                    unit = self.__next_unit(
+                        pending, running_accounts, running_regions)
+                    if unit is None:
+                        break
+                    account, region = unit
+                    running += 1
+                    running_accounts[account] = \
+                        running_accounts.get(account, 0) + 1
+                    running_regions[region] = \
+                        running_regions.get(region, 0) + 1
+                    future = executor.submit(fn, account, region)
+                    future.add_done_callback(
+                        lambda f, unit=unit: on_done(unit, f))
+
+                unit, future = done.get()
+                account, region = unit
+                running -= 1
+                running_accounts[account] -= 1
+                running_regions[region] -= 1
+
+                exc = future.exception()
+                if exc is not None:
+                    log.error(f"{account}:{region}: {exc}")
+                    yield (unit, None, exc)
+                else:
+                    yield (unit, future.result(), None)
+
+    def __next_unit(self, pending, running_accounts, running_regions):
+        for account in pending:
+            if self.max_per_account is not None and \
+                    running_accounts.get(account, 0) >= self.max_per_account:
+                continue
+            regions = pending[account]
+            for region in regions:
+                if self.max_per_region is not None and \
+                        running_regions.get(region, 0) >= self.max_per_region:
+                    continue
+                regions.remove(region)
+                if not regions:
+                    del pending[account]
+                return (account, region)
+        return None
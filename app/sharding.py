@@ -0,0 +1,292 @@
+import boto3
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from app.collectors import COLLECTORS
+from app.incremental import UnitSnapshotStore
+from app.job_runner import (
+    JobRunner, MAX_WORKERS, MAX_WORKERS_PER_ACCOUNT, close_outputs,
+    open_outputs, output_streams
+)
+from app.journal import RunJournal
+from app.metrics import metrics
+from app.region_ops import region_resolver
+
+log = logging.getLogger('parseley')
+
+SHARDS = int(os.getenv('SHARDS', os.cpu_count() or 1))
+QUEUE_BATCH = 200
+MAX_QUEUED_BATCHES = 100
+POLL_INTERVAL = 1
+
+
+def shard_of(account_id, shards):
+    """the shard of an account, stable across runs and processes unlike
+    hash() so a resumed run gives every shard the same accounts"""
+    digest = hashlib.sha1(account_id.encode()).hexdigest()
+    return int(digest, 16) % shards
+
+
+def shard_accounts(accounts, shards):
+    """splits the accounts into a list of shards lists"""
+    sharded = [list() for _ in range(shards)]
+    for account_id in accounts:
+        sharded[shard_of(account_id, shards)].append(account_id)
+    return sharded
+
+
+class _QueueSink():
+    """sink of one output stream in a shard process, sends the records to
+    the parent in batches"""
+
+    def __init__(self, results, stream):
+        self.results = results
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._batch = list()
+
+    def push(self, record):
+        self.push_many([record])
+
+    def push_many(self, records):
+        with self._lock:
+            self._batch.extend(records)
+            if len(self._batch) >= QUEUE_BATCH:
+                self.__send()
+
+    def flush(self):
+        with self._lock:
+            self.__send()
+
+    def close(self):
+        self.flush()
+
+    def __send(self):
+        if self._batch:
+            self.results.put(('records', self.stream, self._batch))
+            self._batch = list()
+
+
+class _QueueJournal(RunJournal):
+    """journal of a shard process. The parent keeps the journal, a
+    completed unit is sent to it behind its records and journaled once the
+    parent's sinks have them."""
+
+    def __init__(self, results, done):
+        # no file of its own
+        self.results = results
+        self.resume = False
+        self._lock = threading.Lock()
+        self._done = set(done)
+
+    def record(self, task, account_id, region, records=0, delta=None):
+        with self._lock:
+            self._done.add((task, account_id, region))
+        self.results.put(('unit', task, account_id, region, records, delta))
+
+    def close(self):
+        pass
+
+
+class _QueueSnapshotStore(UnitSnapshotStore):
+    """snapshot store of a shard process, reads the shared database and
+    sends the saves to the parent, its only writer"""
+
+    def __init__(self, results):
+        super().__init__()
+        self.results = results
+
+    def save(self, collector, account_id, region, unit_signature, records):
+        self.results.put(('snapshot', collector, account_id, region,
+                          unit_signature, records))
+
+
+def _run_shard(shard, accounts, regions, collector_names, session_info,
+               options, results):
+    """entry point of a shard process, runs a JobRunner with its own
+    session, credential and client caches over the shard's accounts and
+    the regions the parent resolved for them"""
+    failures = list()
+    try:
+        session = boto3.Session(**session_info)
+        collectors = [COLLECTORS[name] for name in collector_names]
+        sinks = {
+            stream: _QueueSink(results, stream)
+            for stream in output_streams(collectors, options['incremental'])
+        }
+        journal = None
+        if options['done'] is not None:
+            journal = _QueueJournal(results, options['done'])
+        snapshots = None
+        if options['incremental']:
+            snapshots = _QueueSnapshotStore(results)
+        try:
+            runner = JobRunner(
+                session, collector_names,
+                max_workers=options['max_workers'],
+                max_per_account=options['max_per_account'],
+                incremental=options['incremental'], journal=journal,
+                sinks=sinks, regions=regions, snapshots=snapshots
+            )
+            for account, region, collector, exc in runner.run(accounts):
+                failures.append((account, region, collector, str(exc)))
+        finally:
+            for sink in sinks.values():
+                sink.close()
+    except Exception as e:
+        log.error(f"Shard {shard} failed: {e}")
+        failures.append((None, None, None, f"shard {shard}: {e}"))
+    results.put(('done', shard, failures, metrics.summary()))
+
+
+class ShardedRunner():
+    """
+    Runs a JobRunner per shard in its own process, so parsing responses is
+    not bound by one interpreter's GIL. Accounts are sharded by a hash of
+    their ID, each shard has its own thread pool, credential cache, client
+    registry, rate limiter and metrics, and streams its records back to the
+    parent, which is the only writer of the output files, the inventory,
+    the journal and the incremental snapshots.
+
+    Example usage:
+    runner = ShardedRunner(SESSION_INFO, ['cfn_stacks', 'subnets'], shards=16)
+    failures = runner.run(accounts)
+
+    Parameters:
+        session_info (dict): boto3.Session arguments, every process builds
+            its own session from them
+        collector_names (list): Names from app.collectors.COLLECTORS
+        shards (int): Number of processes, defaults to SHARDS or the CPUs
+        output_dir (str): Where the JSONL outputs are written
+        max_workers (int): Concurrent units per shard
+        max_per_account (int): Concurrent units per account
+        incremental (bool): See JobRunner
+        journal (RunJournal): (Optional) Skip completed units and carry
+            over their records, journal the new ones. Only the parent
+            writes it.
+        store (InventoryStore): (Optional) Also write to the inventory
+    """
+
+    def __init__(self, session_info, collector_names, shards=SHARDS,
+                 output_dir='out', max_workers=MAX_WORKERS,
+                 max_per_account=MAX_WORKERS_PER_ACCOUNT, incremental=False,
+                 journal=None, store=None):
+        unknown = set(collector_names) - set(COLLECTORS)
+        if unknown:
+            raise ValueError(
+                f"Unknown collectors {sorted(unknown)}, "
+                f"choose from {sorted(COLLECTORS)}")
+        self.session_info = session_info
+        self.collector_names = list(collector_names)
+        self.collectors = [COLLECTORS[name] for name in collector_names]
+        self.shards = shards
+        self.output_dir = output_dir
+        self.store = store
+        self.journal = journal
+        self.options = {
+            'shards': shards,
+            'max_workers': max_workers,
+            'max_per_account': max_per_account,
+            'incremental': incremental
+        }
+
+    def run(self, accounts):
+        """collects every requested inventory, returns the failed units as
+        a list of (account, region, collector, error message)"""
+        accounts = list(accounts)
+        enabled = dict()
+        if any(c.regional for c in self.collectors):
+            # resolved once here and handed to the shards, which would
+            # otherwise race to rewrite the region cache
+            enabled = region_resolver.resolve(
+                boto3.Session(**self.session_info), accounts)
+
+        snapshots = None
+        if self.options['incremental']:
+            # created before the shards, which only read it
+            snapshots = UnitSnapshotStore()
+
+        # spawn, not fork, the parent runs sink writer threads
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue(maxsize=MAX_QUEUED_BATCHES)
+        processes = dict()
+        for shard, members in enumerate(
+                shard_accounts(accounts, self.shards)):
+            if not members:
+                continue
+            options = dict(self.options, done=None)
+            if self.journal is not None:
+                options['done'] = self.journal.done_units(set(members))
+            processes[shard] = context.Process(
+                target=_run_shard, name=f"shard-{shard}",
+                args=(shard, members,
+                      {a: enabled.get(a, []) for a in members},
+                      self.collector_names, self.session_info, options,
+                      results)
+            )
+        log.info(
+            f"Collecting {len(accounts)} accounts in {len(processes)} shards")
+
+        sinks, run_ids = open_outputs(
+            self.collectors, self.output_dir, self.store,
+            self.options['incremental'], self.journal)
+        failures = list()
+        running = set(processes)
+        try:
+            for process in processes.values():
+                process.start()
+
+            def handle(message):
+                if message[0] == 'records':
+                    sinks[message[1]].push_many(message[2])
+                elif message[0] == 'unit':
+                    task, account, region, records, delta = message[1:]
+                    for stream in (task, f"{task}_delta"):
+                        if stream in sinks:
+                            sinks[stream].flush()
+                    self.journal.record(task, account, region, records, delta)
+                elif message[0] == 'snapshot':
+                    snapshots.save(*message[1:])
+                else:
+                    running.discard(message[1])
+                    failures.extend(message[2])
+                    metrics.merge(message[3])
+
+            while running:
+                try:
+                    handle(results.get(timeout=POLL_INTERVAL))
+                    continue
+                except queue.Empty:
+                    pass
+                exited = [
+                    s for s in running if processes[s].exitcode is not None]
+                if not exited:
+                    continue
+                # a process flushes its queue before it exits, drain what
+                # it sent before deciding it died without reporting
+                try:
+                    while True:
+                        handle(results.get_nowait())
+                except queue.Empty:
+                    pass
+                for shard in exited:
+                    if shard in running:
+                        log.error(
+                            f"Shard {shard} exited with "
+                            f"{processes[shard].exitcode}")
+                        failures.append((None, None, None,
+                                         f"shard {shard} died"))
+                        running.discard(shard)
+        finally:
+            # shards that reported are finishing on their own, the rest are
+            # left over from an interrupted run
+            for shard, process in processes.items():
+                if shard in running and process.is_alive():
+                    process.terminate()
+                if process.pid is not None:
+                    process.join()
+            close_outputs(sinks, run_ids, self.store)
+        return failures
@@ -0,0 +1,203 @@
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+
+log = logging.getLogger('parseley')
+
+BATCH_SIZE = 500
+MAX_BUFFERED = 10000
+FLUSH_INTERVAL = 5
+
+_CLOSE = object()
+
+
+class _Flush():
+    """queued behind the records a flush() waits for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class RecordSink():
+    """
+    Streams records to a file while a scan is running. Any thread can push
+    records; they are buffered in a bounded queue, so memory stays flat, and
+    a single writer thread writes them in batches that are fsync'd to disk.
+    A crash loses at most the last batch.
+
+    Example usage:
+    with JSONLSink('out/subnets.jsonl') as sink:
+        sink.push({'AccountId': '123456789012', 'SubnetId': 'subnet-1'})
+
+    Parameters:
+        filename (str): The file to write, it is truncated when the sink opens
+        batch_size (int): Records written per fsync'd batch
+        max_buffered (int): Records buffered before push() blocks
+        flush_interval (int): Seconds after which a partial batch is flushed
+    """
+
+    def __init__(self, filename, batch_size=BATCH_SIZE,
+                 max_buffered=MAX_BUFFERED, flush_interval=FLUSH_INTERVAL):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.count = 0
+        self._queue = queue.Queue(maxsize=max_buffered)
+        self._error = None
+        self._closed = False
+        self._writer = threading.Thread(
+            target=self.__write_loop, name=f"sink-{filename}", daemon=True)
+        self._writer.start()
+
+    def push(self, record):
+        """queues one record, blocks while the buffer is full"""
+        if self._error is not None:
+            raise self._error
+        self._queue.put(record)
+
+    def push_many(self, records):
+        for record in records:
+            self.push(record)
+
+    def flush(self):
+        """blocks until every record pushed so far is written and synced"""
+        if self._closed:
+            return
+        request = _Flush()
+        self._queue.put(request)
+        request.done.wait()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """writes everything still buffered and closes the file"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._writer.join()
+        if self._error is not None:
+            raise self._error
+        log.info(f"Wrote {self.count} records to {self.filename}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self):
+        """called by the writer thread, returns the context manager that
+        _write_batch and _sync get"""
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return open(self.filename, 'w', newline='')
+
+    def _write_batch(self, f, batch):
+        raise NotImplementedError
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def __write_loop(self):
+        closing = False
+        flush = None
+        try:
+            with self._open() as f:
+                batch = list()
+                while not closing:
+                    flush = None
+                    try:
+                        record = self._queue.get(timeout=self.flush_interval)
+                        if record is _CLOSE:
+                            closing = True
+                        elif isinstance(record, _Flush):
+                            flush = record
+                        else:
+                            batch.append(record)
+                            if len(batch) < self.batch_size:
+                                continue
+                    except queue.Empty:
+                        pass
+                    if batch:
+                        self._write_batch(f, batch)
+                        self._sync(f)
+                        self.count += len(batch)
+                        batch = list()
+                    if flush is not None:
+                        flush.done.set()
+        except Exception as e:
+            log.error(f"Writing {self.filename} failed: {e}")
+            self._error = e
+            if flush is not None:
+                flush.done.set()
+            # keep draining so producers blocked on a full queue or a flush
+            # wake up
+            while not closing:
+                record = self._queue.get()
+                if isinstance(record, _Flush):
+                    record.done.set()
+                closing = record is _CLOSE
+
+
+class JSONLSink(RecordSink):
+    """one JSON document per line"""
+
+    def _write_batch(self, f, batch):
+        f.write(''.join(
+            json.dumps(record, default=str) + '\n' for record in batch))
+
+
+class CSVSink(RecordSink):
+    """
+    CSV with a header row. Without fieldnames the keys of the first record
+    become the columns, keys missing from it are dropped.
+    """
+
+    def __init__(self, filename, fieldnames=None, **kwargs):
+        self.fieldnames = fieldnames
+        self._csv = None
+        super().__init__(filename, **kwargs)
+
+    def _write_batch(self, f, batch):
+        if self._csv is None:
+            if self.fieldnames is None:
+                self.fieldnames = list(batch[0])
+            self._csv = csv.DictWriter(
+                f, fieldnames=self.fieldnames, extrasaction='ignore')
+            self._csv.writeheader()
+        self._csv.writerows(batch)
+
+
+class TeeSink():
+    """pushes every record to several sinks"""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def push(self, record):
+        for sink in self.sinks:
+            sink.push(record)
+
+    def push_many(self, records):
+        for record in records:
+            self.push(record)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
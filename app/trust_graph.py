@@ -0,0 +1,132 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app.iam_ops import IAMOps
+from app.iam_snapshot import trusted_principals, principal_account
+from app.json_cache import JSONCache
+
+log = logging.getLogger('parseley')
+
+TRUST_GRAPH_MAX_WORKERS = 20
+
+
+def build_trust_graph(session, accounts, max_age=None,
+                      max_workers=TRUST_GRAPH_MAX_WORKERS):
+    """
+    Builds the TrustGraph of the accounts from their IAM snapshots, loaded
+    in parallel. Saved snapshots younger than max_age seconds are reused.
+    """
+    graph = TrustGraph()
+
+    def snapshot(account_id):
+        return IAMOps(session, account_id).load_snapshot(max_age)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {a: executor.submit(snapshot, a) for a in accounts}
+    for account_id, future in futures.items():
+        try:
+            graph.add_snapshot(future.result())
+        except Exception as e:
+            log.error(f"{account_id}: no IAM snapshot, {e}")
+    return graph
+
+
+class TrustGraph():
+    """
+    Index of every trust relationship in the organization: one edge per
+    (trusting role, trusted principal) from the parsed
+    AssumeRolePolicyDocuments, conditions included. Edges are indexed by
+    principal, principal account, service and federated identity provider
+    so questions are answered without scanning accounts again.
+
+    Example usage:
+    graph = build_trust_graph(session, accounts)
+    graph.save()
+    graph.roles_trusting_account('123456789012')
+    graph.external_trusts(org_accounts, target_accounts=prod_accounts)
+
+    Edge:
+    {
+        "RoleArn": "arn:aws:iam::123456789012:role/Deploy",
+        "AccountId": "123456789012",
+        "Type": "AWS",
+        "Principal": "arn:aws:iam::210987654321:root",
+        "PrincipalAccount": "210987654321",
+        "Actions": ["sts:AssumeRole"],
+        "Conditions": {}
+    }
+    """
+
+    def __init__(self, edges=None):
+        self.edges = list()
+        self._index = dict()
+        for edge in edges or []:
+            self.__add_edge(edge)
+
+    def add_snapshot(self, snapshot):
+        for role in snapshot.roles.values():
+            for p in trusted_principals(role['TrustPolicy']):
+                self.__add_edge({
+                    'RoleArn': role['Arn'],
+                    'AccountId': snapshot.account_id,
+                    'Type': p['Type'],
+                    'Principal': p['Principal'],
+                    'PrincipalAccount': principal_account(p['Principal'])
+                    if p['Type'] == 'AWS' else None,
+                    'Actions': p['Actions'],
+                    'Conditions': p['Conditions']
+                })
+
+    def __add_edge(self, edge):
+        self.edges.append(edge)
+        keys = [('principal', edge['Type'], edge['Principal'])]
+        if edge['PrincipalAccount'] is not None:
+            keys.append(('account', edge['PrincipalAccount']))
+        for key in keys:
+            self._index.setdefault(key, list()).append(edge)
+
+    def save(self, name='trust_graph'):
+        JSONCache(name).save(self.edges)
+
+    @classmethod
+    def load(cls, name='trust_graph', max_age=None):
+        """the saved graph, None if there is none younger than max_age
+        seconds"""
+        edges = JSONCache(name, ttl=max_age).load()
+        return cls(edges) if edges is not None else None
+
+    def trusting_roles(self, principal_type, principal):
+        """edges trusting exactly this principal, e.g.
+        ('Service', 'ec2.amazonaws.com') or
+        ('AWS', 'arn:aws:iam::123456789012:role/CI')"""
+        return self._index.get(('principal', principal_type, principal), [])
+
+    def roles_trusting_account(self, account_id):
+        """edges trusting the account's root or any of its principals"""
+        return self._index.get(('account', account_id), [])
+
+    def roles_trusting_service(self, service):
+        return self.trusting_roles('Service', service)
+
+    def roles_trusting_idp(self, idp_arn):
+        return self.trusting_roles('Federated', idp_arn)
+
+    def external_trusts(self, org_accounts, target_accounts=None,
+                        include_federated=False):
+        """
+        Edges that let principals from outside the organization assume a
+        role: AWS principals of accounts not in org_accounts, anonymous "*"
+        principals and, with include_federated, federated identity
+        providers. target_accounts limits the trusting side, e.g. to prod.
+        """
+        org_accounts = set(org_accounts)
+        targets = set(target_accounts) if target_accounts else None
+        external = list()
+        for edge in self.edges:
+            if targets is not None and edge['AccountId'] not in targets:
+                continue
+            if edge['Type'] == '*' or \
+                    (edge['Type'] == 'AWS' and
+                     edge['PrincipalAccount'] not in org_accounts) or \
+                    (include_federated and edge['Type'] == 'Federated'):
+                external.append(edge)
+        return external
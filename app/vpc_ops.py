@@ -1,6 +1,8 @@
 import boto3
 import logging
 from app.boto_factory import BotoFactory
+from app.pagination import paginate, tagged
+from app.region_ops import region_resolver
 
 
 logging.basicConfig(level=logging.INFO)
@@ -12,54 +14,50 @@ class VPCOps():
         self.account_id = account_id
 
     def get_all_vpn_connections(self):
-        self.vpns = list()
-        regions = self.__get_all_regions()
-        for r in regions:
-            self.vpns += self.__get_vpn_connections(r)
+        self.vpns = list(self.iter_all_vpn_connections())
         return self.vpns
 
-    def __get_vpn_connections(self, region):
-        ec2 = BotoFactory().get_capability(
-            boto3.client, self.session, 'ec2', account_id=self.account_id,
-            region=region
-            )
-        result = ec2.describe_vpn_connections().get('VpnConnections')
-        return result
+    def iter_all_vpn_connections(self):
+        """yields the VPN connections of every enabled region, tagged with
+        AccountId and Region"""
+        for r in self.get_all_regions():
+            yield from self.iter_vpn_connections(r)
+
+    def get_vpn_connections(self, region):
+        return self.__ec2(region).describe_vpn_connections().get(
+            'VpnConnections')
+
+    def iter_vpn_connections(self, region):
+        """describe_vpn_connections is not paginated, one call per region"""
+        return tagged(self.get_vpn_connections(region), self.account_id,
+                      region)
 
     def get_all_subnets(self):
-        self.subnets = list()
-        regions = self.__get_all_regions()
-        for r in regions:
-            self.subnets += self.__get_subnets(r)
+        self.subnets = list(self.iter_all_subnets())
         return self.subnets
 
-    def __get_all_regions(self):
-        ec2 = self.session.client('ec2')
-        regions = set()
-        for r in ec2.describe_regions().get('Regions'):
-            regions.add(r.get('RegionName'))
-        return regions
+    def iter_all_subnets(self):
+        """yields the subnets of every enabled region as their pages
+        arrive, tagged with AccountId and Region"""
+        for r in self.get_all_regions():
+            yield from self.iter_subnets(r)
 
-    def __get_subnets(self, region):
-        ec2 = BotoFactory().get_capability(
+    def get_all_regions(self):
+        """regions enabled in the account, not in the management account"""
+        return region_resolver.enabled_regions(
+            self.session, self.account_id, 'ec2')
+
+    def get_subnets(self, region):
+        result = list(paginate(self.__ec2(region), 'describe_subnets'))
+        logging.info(f"{self.account_id}:{region}:{result}")
+        return result
+
+    def iter_subnets(self, region):
+        return tagged(paginate(self.__ec2(region), 'describe_subnets'),
+                      self.account_id, region)
+
+    def __ec2(self, region):
+        return BotoFactory().get_capability(
             boto3.client, self.session, 'ec2', account_id=self.account_id,
             region=region
             )
-        pgnt = ec2.get_paginator('describe_subnets')
-        itr = pgnt.paginate()
-        for i in itr:
-            result = i.get('Subnets')
-            logging.info(f"{self.account_id}:{region}:{result}")
-        return result
-
-    def __paginate(self, method, **kwargs):
-        """ example use:
-        s3 = session.client('s3')
-        for key in __paginate(s3.list_objects_v2, Bucket='bucket'):
-            print(key)
-        """
-        client = method.__self__
-        paginator = client.get_paginator(method.__name__)
-        for page in paginator.paginate(**kwargs).result_key_iters():
-            for result in page:
-                yield result
@@ -0,0 +1,169 @@
+"""
+Offline benchmarks against a simulated organization, no AWS access needed.
+Every scenario runs in its own process so peak RSS and the caches are not
+shared between scenarios.
+
+python -m bench --accounts 200 --regions 4 --resources 50 --latency 0.05
+python -m bench --output bench.json --baseline bench_baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIO_NAMES = [
+    'cfn_inventory', 'subnet_inventory', 'multi_inventory',
+    'record_set_inventory', 'subnet_query', 'trust_scan'
+]
+REGRESSION_KEYS = ['wall_time', 'api_calls', 'assume_roles']
+ORG_ARGS = [
+    'accounts', 'regions', 'resources', 'latency', 'throttle_rate',
+    'error_rate', 'failure_rate', 'page_size', 'seed'
+]
+
+
+def run_scenario(name, args):
+    """runs one scenario in this process and returns its measurements"""
+    workdir = tempfile.mkdtemp(prefix='parseley-bench-')
+    # read when the app modules are imported, so set before importing them
+    os.environ.update({
+        'LOGLEVEL': 'WARNING',
+        'PARSELEY_CACHE_DIR': os.path.join(workdir, 'cache'),
+        'INVENTORY_DB': os.path.join(workdir, 'inventory.db'),
+        'JOURNAL': os.path.join(workdir, 'journal.jsonl'),
+        'DEFAULT_REGION': 'us-east-1',
+        'DEFAULT_ROLE': 'OrganizationsAccount',
+        'ORG_ACCOUNT': '100000000000',
+        'OU_BLOCKLIST': 'ou-bench-blocked',
+        # what a configured profile provides, sessions the ops classes
+        # create on their own find it
+        'AWS_ACCESS_KEY_ID': 'BENCH100000000000',
+        'AWS_SECRET_ACCESS_KEY': 'bench'
+    })
+    # some ops modules log every record at INFO
+    logging.disable(logging.INFO)
+    import boto3
+    from bench.fake_aws import FakeAWS, FakeOrganization
+    from bench.scenarios import SCENARIOS
+
+    org = FakeOrganization(
+        accounts=args.accounts, regions=args.regions,
+        resources=args.resources, failure_rate=args.failure_rate,
+        seed=args.seed
+    )
+    fake = FakeAWS(
+        org, latency=args.latency, throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate, page_size=args.page_size, seed=args.seed
+    )
+    fake.install()
+    session = boto3.Session(region_name='us-east-1')
+
+    try:
+        start = time.perf_counter()
+        # every scenario reports the records it emitted and its failed units
+        records, failures = SCENARIOS[name](
+            session, os.path.join(workdir, 'out'))
+        wall_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return dict({
+        'scenario': name,
+        'wall_time': round(wall_time, 3),
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'records': records,
+        'failures': failures
+    }, **fake.summary())
+
+
+def compare(results, baseline, tolerance):
+    """regressions against a previous output, as readable lines"""
+    previous = {r['scenario']: r for r in baseline['scenarios']}
+    regressions = list()
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None:
+            continue
+        for key in REGRESSION_KEYS:
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append(
+                    f"{result['scenario']} {key}: {before[key]} -> "
+                    f"{result[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks against a simulated AWS organization')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIO_NAMES,
+                        choices=SCENARIO_NAMES)
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--regions', type=int, default=4,
+                        help='enabled regions per account, at most 16')
+    parser.add_argument('--resources', type=int, default=20,
+                        help='stacks, subnets, roles... per region')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='mean seconds per request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='share of requests throttled')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests failing with a 500')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='share of accounts where AssumeRole is denied')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline',
+                        help='fail if a scenario regressed against this '
+                             'earlier --output')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed regression, 0.25 is 25%%')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args)))
+        return
+
+    org_args = list()
+    for name in ORG_ARGS:
+        org_args += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    results = list()
+    for name in args.scenarios:
+        output = subprocess.run(
+            [sys.executable, '-m', 'bench', '--child', name] + org_args,
+            stdout=subprocess.PIPE, check=True, universal_newlines=True
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+
+    print(f"{'scenario':<22}{'wall s':>9}{'api calls':>11}"
+          f"{'assume':>8}{'throttled':>11}{'rss MB':>9}{'records':>9}"
+          f"{'failed':>8}")
+    for r in results:
+        print(f"{r['scenario']:<22}{r['wall_time']:>9}{r['api_calls']:>11}"
+              f"{r['assume_roles']:>8}{r['throttled']:>11}"
+              f"{r['peak_rss_mb']:>9}{r['records']:>9}{r['failures']:>8}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'parameters': {name: getattr(args, name) for name in ORG_ARGS},
+                'scenarios': results
+            }, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Regression {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
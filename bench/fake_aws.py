@@ -0,0 +1,581 @@
+import base64
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+import botocore.session
+from botocore.awsrequest import AWSResponse
+
+log = logging.getLogger('parseley')
+
+MANAGEMENT_ACCOUNT = '100000000000'
+MANAGEMENT_ACCESS_KEY = f"BENCH{MANAGEMENT_ACCOUNT}"
+EXTERNAL_ACCOUNT = '999999999999'
+# real region names, endpoints are resolved before the fake answers
+REGIONS = [
+    'us-east-1', 'eu-west-1', 'us-west-2', 'eu-central-1', 'ap-southeast-2',
+    'us-east-2', 'eu-west-2', 'ap-northeast-1', 'ca-central-1', 'sa-east-1',
+    'eu-north-1', 'ap-south-1', 'us-west-1', 'eu-west-3', 'ap-southeast-1',
+    'ap-northeast-2'
+]
+DEFAULT_PAGE_SIZE = 100
+CREATED = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+_CREDENTIAL = re.compile(r'Credential=([^/]+)/[^/]+/([^/]+)/')
+_THROTTLE_CODES = {
+    'query': 'Throttling',
+    'ec2': 'RequestLimitExceeded',
+    'rest-xml': 'Throttling',
+    'json': 'ThrottlingException'
+}
+
+
+class _RawResponse():
+    """the raw body botocore reads an AWSResponse from"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class FakeError(Exception):
+
+    def __init__(self, status, code, message=''):
+        super().__init__(f"{code}: {message}")
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeOrganization():
+    """
+    A deterministic organization of accounts x regions x resources per
+    region. Every resource is derived from its (account, region, index), so
+    nothing is held in memory and every run sees the same organization.
+
+    Parameters:
+        accounts (int): Member accounts, spread over the OUs
+        regions (int): Enabled regions per account
+        resources (int): Stacks, subnets, certificates... per region
+        ous (int): OUs directly under the root
+        failure_rate (float): Share of accounts where AssumeRole is denied
+        external_trust_rate (float): Share of roles trusting an account
+            outside the organization
+        seed (int): Seed of everything random in the organization
+    """
+
+    def __init__(self, accounts=50, regions=4, resources=20, ous=5,
+                 failure_rate=0.0, external_trust_rate=0.05, seed=0):
+        self.account_ids = [str(200000000000 + i) for i in range(accounts)]
+        self.regions = REGIONS[:regions]
+        self.resources = resources
+        self.ous = [f"ou-bench-{i:08d}" for i in range(ous)]
+        self.external_trust_rate = external_trust_rate
+        self.seed = seed
+        rng = random.Random(seed)
+        self.denied = {
+            a for a in self.account_ids if rng.random() < failure_rate
+        }
+
+    def rng(self, *parts):
+        return random.Random('-'.join(str(p) for p in (self.seed,) + parts))
+
+    def ou_accounts(self, ou):
+        index = self.ous.index(ou)
+        return self.account_ids[index::len(self.ous)]
+
+    # sts
+    def AssumeRole(self, account_id, region, params):
+        target = params['RoleArn'].split(':')[4]
+        if target in self.denied or target not in self.account_ids + [
+                MANAGEMENT_ACCOUNT]:
+            raise FakeError(403, 'AccessDenied', 'not authorized')
+        return {
+            'Credentials': {
+                'AccessKeyId': f"BENCH{target}",
+                'SecretAccessKey': 'bench',
+                'SessionToken': 'bench',
+                'Expiration': datetime.now(timezone.utc) + timedelta(
+                    seconds=params.get('DurationSeconds', 3600))
+            },
+            'AssumedRoleUser': {
+                'AssumedRoleId': f"AROABENCH:{params['RoleSessionName']}",
+                'Arn': f"arn:aws:sts::{target}:assumed-role/bench/"
+                       f"{params['RoleSessionName']}"
+            }
+        }
+
+    def GetCallerIdentity(self, account_id, region, params):
+        return {'Account': account_id, 'UserId': 'bench',
+                'Arn': f"arn:aws:iam::{account_id}:user/bench"}
+
+    # organizations
+    def ListRoots(self, account_id, region, params):
+        return {'Roots': [{'Id': 'r-bench', 'Name': 'Root'}]}
+
+    def ListOrganizationalUnitsForParent(self, account_id, region, params):
+        if params['ParentId'] != 'r-bench':
+            return {'OrganizationalUnits': []}
+        return {'OrganizationalUnits': [
+            {'Id': ou, 'Name': f"bench-{i}"} for i, ou in enumerate(self.ous)
+        ]}
+
+    def ListAccountsForParent(self, account_id, region, params):
+        if params['ParentId'] not in self.ous:
+            return {'Accounts': []}
+        return {'Accounts': [
+            self.__account(a) for a in self.ou_accounts(params['ParentId'])
+        ]}
+
+    def ListAccounts(self, account_id, region, params):
+        return {'Accounts': [self.__account(a) for a in self.account_ids]}
+
+    def __account(self, account_id):
+        return {
+            'Id': account_id,
+            'Arn': f"arn:aws:organizations::{MANAGEMENT_ACCOUNT}:account/"
+                   f"o-bench/{account_id}",
+            'Name': f"bench-{account_id}",
+            'Email': f"{account_id}@bench.invalid",
+            'Status': 'ACTIVE'
+        }
+
+    # ec2
+    def DescribeRegions(self, account_id, region, params):
+        return {'Regions': [
+            {'RegionName': r, 'Endpoint': f"ec2.{r}.amazonaws.com",
+             'OptInStatus': 'opt-in-not-required'} for r in self.regions
+        ]}
+
+    def DescribeSubnets(self, account_id, region, params):
+        return {'Subnets': [
+            {
+                'SubnetId': f"subnet-{account_id[-6:]}{i:05d}",
+                'VpcId': f"vpc-{account_id[-6:]}{i // 4:05d}",
+                'CidrBlock': f"10.{i // 256 % 256}.{i % 256}.0/24",
+                'AvailabilityZone': f"{region}a",
+                'State': 'available',
+                'OwnerId': account_id
+            } for i in range(self.resources)
+        ]}
+
+    def DescribeVpnConnections(self, account_id, region, params):
+        count = self.rng(account_id, region, 'vpn').randint(0, 2)
+        return {'VpnConnections': [
+            {
+                'VpnConnectionId': f"vpn-{account_id[-6:]}{i:05d}",
+                'State': 'available',
+                'Type': 'ipsec.1',
+                'CustomerGatewayId': f"cgw-{account_id[-6:]}{i:05d}"
+            } for i in range(count)
+        ]}
+
+    # cloudformation
+    def ListStacks(self, account_id, region, params):
+        return {'StackSummaries': [
+            {
+                'StackId': self.__stack_id(account_id, region, i),
+                'StackName': f"bench-{i}",
+                'CreationTime': CREATED,
+                'StackStatus': 'CREATE_COMPLETE'
+            } for i in range(self.resources)
+        ]}
+
+    def DescribeStacks(self, account_id, region, params):
+        return {'Stacks': [
+            {
+                'StackId': self.__stack_id(account_id, region, i),
+                'StackName': f"bench-{i}",
+                'CreationTime': CREATED,
+                'StackStatus': 'CREATE_COMPLETE',
+                'Parameters': [
+                    {'ParameterKey': 'Env', 'ParameterValue': 'bench'}
+                ],
+                'Tags': [{'Key': 'team', 'Value': f"team-{i % 7}"}]
+            } for i in range(self.resources)
+        ]}
+
+    @staticmethod
+    def __stack_id(account_id, region, i):
+        return f"arn:aws:cloudformation:{region}:{account_id}:stack/" \
+               f"bench-{i}/{i:08d}-0000-0000-0000-000000000000"
+
+    # iam
+    def GetAccountAuthorizationDetails(self, account_id, region, params):
+        rng = self.rng(account_id, 'iam')
+        roles = list()
+        for i in range(self.resources):
+            if i % 5 == 0:
+                principal = {'Service': 'ec2.amazonaws.com'}
+            elif rng.random() < self.external_trust_rate:
+                principal = {'AWS': f"arn:aws:iam::{EXTERNAL_ACCOUNT}:root"}
+            else:
+                principal = {'AWS': f"arn:aws:iam::"
+                                    f"{rng.choice(self.account_ids)}:root"}
+            document = {
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Effect': 'Allow',
+                    'Principal': principal,
+                    'Action': 'sts:AssumeRole'
+                }]
+            }
+            roles.append({
+                'RoleName': f"bench-role-{i}",
+                'RoleId': f"AROABENCH{i:08d}",
+                'Arn': f"arn:aws:iam::{account_id}:role/bench-role-{i}",
+                'Path': '/',
+                'CreateDate': CREATED,
+                'AssumeRolePolicyDocument': quote(json.dumps(document)),
+                'InstanceProfileList': [],
+                'RolePolicyList': [],
+                'AttachedManagedPolicies': [{
+                    'PolicyName': 'ReadOnlyAccess',
+                    'PolicyArn': 'arn:aws:iam::aws:policy/ReadOnlyAccess'
+                }]
+            })
+        users = [
+            {
+                'UserName': f"bench-user-{i}",
+                'UserId': f"AIDABENCH{i:08d}",
+                'Arn': f"arn:aws:iam::{account_id}:user/bench-user-{i}",
+                'Path': '/',
+                'CreateDate': CREATED,
+                'GroupList': ['bench-group'],
+                'AttachedManagedPolicies': []
+            } for i in range(max(1, self.resources // 10))
+        ]
+        return {
+            'UserDetailList': users,
+            'GroupDetailList': [{
+                'GroupName': 'bench-group',
+                'GroupId': 'AGPABENCH',
+                'Arn': f"arn:aws:iam::{account_id}:group/bench-group",
+                'Path': '/',
+                'CreateDate': CREATED,
+                'AttachedManagedPolicies': []
+            }],
+            'RoleDetailList': roles,
+            'Policies': []
+        }
+
+    def ListRoles(self, account_id, region, params):
+        details = self.GetAccountAuthorizationDetails(
+            account_id, region, params)
+        return {'Roles': details['RoleDetailList']}
+
+    def GetAccountPasswordPolicy(self, account_id, region, params):
+        return {'PasswordPolicy': {
+            'MinimumPasswordLength': 14,
+            'RequireNumbers': True,
+            'ExpirePasswords': False
+        }}
+
+    # acm
+    def ListCertificates(self, account_id, region, params):
+        return {'CertificateSummaryList': [
+            {
+                'CertificateArn': self.__certificate_arn(
+                    account_id, region, i),
+                'DomainName': f"bench-{i}.example.com",
+                'Status': 'ISSUED',
+                'InUse': True,
+                'NotAfter': CREATED + timedelta(days=365)
+            } for i in range(max(1, self.resources // 4))
+        ]}
+
+    def DescribeCertificate(self, account_id, region, params):
+        arn = params['CertificateArn']
+        return {'Certificate': {
+            'CertificateArn': arn,
+            'DomainName': f"{arn.rsplit('/', 1)[-1]}.example.com",
+            'Status': 'ISSUED',
+            'Type': 'AMAZON_ISSUED',
+            'DomainValidationOptions': [{
+                'DomainName': 'example.com',
+                'ValidationMethod': 'DNS'
+            }],
+            'NotAfter': CREATED + timedelta(days=365)
+        }}
+
+    @staticmethod
+    def __certificate_arn(account_id, region, i):
+        return f"arn:aws:acm:{region}:{account_id}:certificate/bench-{i}"
+
+    # route53
+    def ListHostedZones(self, account_id, region, params):
+        return {'HostedZones': [
+            {
+                'Id': f"/hostedzone/Z{account_id}{i:04d}",
+                'Name': f"bench-{i}.{account_id}.example.com.",
+                'CallerReference': f"bench-{i}",
+                'Config': {'PrivateZone': False},
+                'ResourceRecordSetCount': self.resources * 10
+            } for i in range(max(1, self.resources // 10))
+        ], 'IsTruncated': False, 'MaxItems': '100', 'Marker': ''}
+
+    def ListResourceRecordSets(self, account_id, region, params):
+        zone = params['HostedZoneId'].split('/')[-1]
+        return {'ResourceRecordSets': [
+            {
+                'Name': f"host-{i}.{zone.lower()}.example.com.",
+                'Type': 'A',
+                'TTL': 300,
+                'ResourceRecords': [
+                    {'Value': f"10.0.{i // 256 % 256}.{i % 256}"}
+                ]
+            } for i in range(self.resources * 10)
+        ], 'IsTruncated': False, 'MaxItems': '300'}
+
+    # cloudtrail
+    def DescribeTrails(self, account_id, region, params):
+        return {'trailList': [{
+            'Name': 'bench',
+            'TrailARN': f"arn:aws:cloudtrail:us-east-1:{account_id}:"
+                        f"trail/bench",
+            'S3BucketName': 'bench-trails',
+            'IsMultiRegionTrail': True,
+            'HomeRegion': 'us-east-1'
+        }]}
+
+
+class FakeAWS():
+    """
+    Answers every request of every boto3 client with the FakeOrganization,
+    through the botocore before-send event. Requests
+    are serialized, signed, retried and their responses parsed exactly as
+    against AWS, so BotoFactory, the rate limiter and the retries are part
+    of what is measured. Account and region are read from the credential
+    scope of the signed request.
+
+    Example usage:
+    fake = FakeAWS(FakeOrganization(accounts=200), latency=0.05)
+    fake.install()
+
+    Parameters:
+        org (FakeOrganization): The organization that answers
+        latency (float): Mean seconds per request, +-50% jitter
+        throttle_rate (float): Share of requests throttled
+        error_rate (float): Share of requests failing with a retryable 500
+        page_size (int): Items per page of paginated operations
+    """
+
+    def __init__(self, org, latency=0.0, throttle_rate=0.0, error_rate=0.0,
+                 page_size=DEFAULT_PAGE_SIZE, seed=0):
+        self.org = org
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.calls = Counter()
+        self.throttled = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._paginators = dict()
+
+    def install(self):
+        """answers the requests of every client created from now on, the
+        ops classes build clients from sessions of their own"""
+        create_client = botocore.session.Session.create_client
+        fake = self
+
+        def create_fake_client(self, *args, **kwargs):
+            client = create_client(self, *args, **kwargs)
+            client.meta.events.register(
+                'provide-client-params', fake._on_params)
+            client.meta.events.register('before-send', fake._on_send)
+            return client
+        botocore.session.Session.create_client = create_fake_client
+
+    @staticmethod
+    def _on_params(params, model, context, **kwargs):
+        context['bench'] = (model, dict(params))
+
+    def _on_send(self, request, **kwargs):
+        model, params = request.context['bench']
+        service = model.service_model.service_name
+        protocol = model.service_model.protocol
+        authorization = request.headers.get('Authorization', '')
+        if isinstance(authorization, bytes):
+            authorization = authorization.decode()
+        match = _CREDENTIAL.search(authorization)
+        access_key, region = match.groups() if match else ('', '')
+        account_id = access_key[len('BENCH'):]
+
+        with self._lock:
+            self.calls[(service, model.name)] += 1
+            roll = self._rng.random()
+            jitter = self._rng.uniform(0.5, 1.5)
+        if self.latency:
+            time.sleep(self.latency * jitter)
+
+        try:
+            if roll < self.throttle_rate:
+                with self._lock:
+                    self.throttled += 1
+                raise FakeError(
+                    400, _THROTTLE_CODES[protocol], 'Rate exceeded')
+            if roll < self.throttle_rate + self.error_rate:
+                with self._lock:
+                    self.errors += 1
+                raise FakeError(500, 'InternalFailure', 'injected')
+            if account_id != MANAGEMENT_ACCOUNT and \
+                    account_id not in self.org.account_ids:
+                raise FakeError(403, 'InvalidClientTokenId', access_key)
+            handler = getattr(self.org, model.name, None)
+            if handler is None:
+                raise FakeError(
+                    400, 'InvalidAction', f"{service} {model.name}")
+            parsed = self.__page(
+                service, model.name, handler(account_id, region, params),
+                params)
+        except FakeError as e:
+            return self.__response(
+                request, e.status, _error_body(protocol, e), protocol)
+        return self.__response(
+            request, 200, _body(protocol, model, parsed), protocol)
+
+    def __page(self, service, operation, parsed, params):
+        """slices the result lists of paginated operations, tokens are the
+        index of the next item"""
+        config = self.__paginator(service, operation)
+        if config is None:
+            return parsed
+        result_keys = config['result_key']
+        if isinstance(result_keys, str):
+            result_keys = [result_keys]
+        start = int(params.get(config['input_token']) or 0)
+        size = int(params.get(config.get('limit_key')) or self.page_size)
+        more = False
+        for key in result_keys:
+            items = parsed.get(key, [])
+            parsed[key] = items[start:start + size]
+            more = more or len(items) > start + size
+        output_token = config['output_token']
+        if more:
+            parsed[output_token] = str(start + size)
+        else:
+            parsed.pop(output_token, None)
+        if 'more_results' in config:
+            parsed[config['more_results']] = more
+        return parsed
+
+    def __paginator(self, service, operation):
+        if service not in self._paginators:
+            try:
+                model = botocore.session.get_session().get_paginator_model(
+                    service)
+                self._paginators[service] = model._paginator_config
+            except Exception:
+                self._paginators[service] = dict()
+        config = self._paginators[service].get(operation)
+        # only simple paginators, multi-token ones are answered in one page
+        if config is None or not isinstance(config['input_token'], str):
+            return None
+        return config
+
+    @staticmethod
+    def __response(request, status, body, protocol):
+        content_type = 'application/x-amz-json-1.1' \
+            if protocol == 'json' else 'text/xml'
+        return AWSResponse(
+            request.url, status,
+            {'Content-Type': content_type, 'x-amzn-RequestId': 'bench'},
+            _RawResponse(body.encode())
+        )
+
+    def summary(self):
+        return {
+            'api_calls': sum(self.calls.values()),
+            'assume_roles': self.calls[('sts', 'AssumeRole')],
+            'throttled': self.throttled,
+            'errors': self.errors,
+            'calls': {
+                f"{service}.{operation}": count
+                for (service, operation), count in sorted(self.calls.items())
+            }
+        }
+
+
+def _body(protocol, model, parsed):
+    shape = model.output_shape
+    if protocol == 'json':
+        return json.dumps(parsed, default=_epoch)
+    members = _xml_members(shape, parsed) if shape is not None else ''
+    if protocol == 'ec2':
+        return f"<{model.name}Response><requestId>bench</requestId>" \
+               f"{members}</{model.name}Response>"
+    if protocol == 'query':
+        wrapper = shape.serialization.get('resultWrapper') \
+            if shape is not None else None
+        if wrapper:
+            members = f"<{wrapper}>{members}</{wrapper}>"
+        return f"<{model.name}Response>{members}<ResponseMetadata>" \
+               f"<RequestId>bench</RequestId></ResponseMetadata>" \
+               f"</{model.name}Response>"
+    return f"<{model.name}Response>{members}</{model.name}Response>"
+
+
+def _error_body(protocol, error):
+    if protocol == 'json':
+        return json.dumps({'__type': error.code, 'message': error.message})
+    if protocol == 'ec2':
+        return f"<Response><Errors><Error><Code>{error.code}</Code>" \
+               f"<Message>{escape(error.message)}</Message></Error>" \
+               f"</Errors><RequestID>bench</RequestID></Response>"
+    return f"<ErrorResponse><Error><Type>Sender</Type>" \
+           f"<Code>{error.code}</Code><Message>{escape(error.message)}" \
+           f"</Message></Error><RequestId>bench</RequestId></ErrorResponse>"
+
+
+def _epoch(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def _xml_members(shape, value):
+    return ''.join(
+        _xml(member, value[name], member.serialization.get('name', name))
+        for name, member in shape.members.items()
+        if name in value and 'location' not in member.serialization
+    )
+
+
+def _xml(shape, value, name):
+    """serializes a value of an output shape the way the XML protocols
+    return it"""
+    if shape.type_name == 'structure':
+        inner = _xml_members(shape, value)
+    elif shape.type_name == 'list':
+        member_name = shape.member.serialization.get('name', 'member')
+        if shape.serialization.get('flattened'):
+            return ''.join(_xml(shape.member, v, name) for v in value)
+        inner = ''.join(_xml(shape.member, v, member_name) for v in value)
+    elif shape.type_name == 'map':
+        key_name = shape.key.serialization.get('name', 'key')
+        value_name = shape.value.serialization.get('name', 'value')
+        inner = ''.join(
+            f"<entry>{_xml(shape.key, k, key_name)}"
+            f"{_xml(shape.value, v, value_name)}</entry>"
+            for k, v in value.items()
+        )
+    elif shape.type_name == 'timestamp':
+        inner = value.astimezone(timezone.utc).strftime(
+            '%Y-%m-%dT%H:%M:%S.000Z')
+    elif shape.type_name == 'boolean':
+        inner = 'true' if value else 'false'
+    elif shape.type_name == 'blob':
+        inner = base64.b64encode(value).decode()
+    else:
+        inner = escape(str(value))
+    return f"<{name}>{inner}</{name}>"
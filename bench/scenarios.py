@@ -0,0 +1,70 @@
+import os
+from app.job_runner import JobRunner
+from app.org_ops import OrganizationsOps
+from app.query import OrgQuery
+from app.trust_graph import build_trust_graph
+
+
+def _accounts(session):
+    return OrganizationsOps(session).get_accounts_from_root()
+
+
+def _inventory(session, collectors, output_dir):
+    """runs a JobRunner, returns (records written, failed units)"""
+    failures = JobRunner(
+        session, collectors, output_dir=output_dir).run(_accounts(session))
+    records = 0
+    for name in os.listdir(output_dir):
+        if name.endswith('.jsonl'):
+            with open(os.path.join(output_dir, name)) as f:
+                records += sum(1 for _ in f)
+    return records, len(failures)
+
+
+def cfn_inventory(session, output_dir):
+    """list_stacks of every account and enabled region"""
+    return _inventory(session, ['cfn_stacks'], output_dir)
+
+
+def subnet_inventory(session, output_dir):
+    """describe_subnets of every account and enabled region"""
+    return _inventory(session, ['subnets'], output_dir)
+
+
+def multi_inventory(session, output_dir):
+    """the regional and global collectors together in one pass"""
+    return _inventory(
+        session, ['cfn_stacks', 'subnets', 'vpns', 'hosted_zones', 'trails'],
+        output_dir)
+
+
+def record_set_inventory(session, output_dir):
+    """every record set of every hosted zone"""
+    return _inventory(session, ['record_sets'], output_dir)
+
+
+def subnet_query(session, output_dir):
+    """an OrgQuery with a pushed down match and a projection"""
+    query = OrgQuery(
+        'ec2', 'describe_subnets', match={'State': ['available']},
+        where="starts_with(CidrBlock, '10.0.')",
+        select='{SubnetId: SubnetId, VpcId: VpcId}'
+    )
+    return _inventory(session, [query.collector(session)], output_dir)
+
+
+def trust_scan(session, output_dir):
+    """IAM snapshots of every account and the org-wide trust graph"""
+    accounts = _accounts(session)
+    graph = build_trust_graph(session, accounts)
+    return len(graph.external_trusts(accounts)), 0
+
+
+SCENARIOS = {
+    'cfn_inventory': cfn_inventory,
+    'subnet_inventory': subnet_inventory,
+    'multi_inventory': multi_inventory,
+    'record_set_inventory': record_set_inventory,
+    'subnet_query': subnet_query,
+    'trust_scan': trust_scan
+}
@@ -1,110 +1,115 @@
+import argparse
 import boto3
 import logging
 import json
 import os
-import csv
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
-from dotenv import load_dotenv
+# loads .env, before the app modules read their settings at import
+import settings  # noqa: F401
 from app.boto_factory import BotoFactory
 from app.cfn_ops import CFNOps
 from app.cloudtrail_ops import CloudtrailOps
-from app.iam_ops import IAMOps
+from app.cloudtrail_logs import CloudTrailLogAnalyzer, EventFilter
+from app.iam_ops import IAMOps, get_credential_reports
+from app.iam_plan import (
+    IAMPlan, AddConsoleUsersToGroup, DeleteRole, SetPasswordPolicy
+)
 from app.r53_ops import Route53Ops
 from app.acm_ops import ACMOps
 from app.vpc_ops import VPCOps
 from app.org_ops import OrganizationsOps
+from app.trust_graph import TrustGraph, build_trust_graph
+from app.export import ExportWriter
+from app.inventory_store import InventoryStore
+from app.journal import RunJournal, JOURNAL
+from app.collectors import COLLECTORS
+from app.job_runner import JobRunner
+from app.query import OrgQuery
+from app.sharding import ShardedRunner, SHARDS
+from app.aio_ops import ASYNC_COLLECTORS, AsyncJobRunner
+from app.metrics import metrics
 
-load_dotenv()
-
-# set up logging to file - see previous section for more details
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-    datefmt='%y-%m-%d %H:%M',
-    filename=f"log/{datetime.now()}.log",
-    filemode='w'
-    )
 log = logging.getLogger('parseley')
 # log.addHandler(logging.StreamHandler())
 
 account_list = list()
 MAX_THREADS = 20
+MAX_THREADS_PER_ACCOUNT = 8
 SESSION_INFO = {
     # 'profile_name': os.getenv('DEFAULT_CLI_PROFILE'),
     'region_name': os.getenv('DEFAULT_REGION')
 }
 
-arn_list = list()
-hosted_zone_dict = dict()
-cloudtrails_dict = dict()
-subnets = list()
-vpns = list()
-pw_policy_inventory = dict()
-
 
 def __json_print(inp):
     print(json.dumps(inp, indent=4, default=str))
 
 
 def __write_csv(filename, fieldnames, input_list):
-    """expects a list of dicts"""
-    with open(filename, 'w') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for i in input_list:
-            writer.writerow(i)
+    """expects an iterable of dicts, fieldnames None infers the columns"""
+    ExportWriter(filename, fieldnames=fieldnames).write(input_list)
 
 
 def get_active_accounts(session):
     """
-    Fetches all active account IDs from an Organization. To get accounts from
-    an OU structure, refer to OrganizationsOps class instead, app/org_ops.py
+    Fetches all active accounts from the organization snapshot, blocklisted
+    OUs excluded. To get accounts from an OU structure, refer to
+    OrganizationsOps class instead, app/org_ops.py
     """
-    org = BotoFactory().get_capability(
-        boto3.client, session, 'organizations', os.getenv('ORG_ACCOUNT'),
-        os.getenv('DEFAULT_ROLE')
-    )
-    accounts = dict()
-    paginator = org.get_paginator('list_accounts')
-    itr = paginator.paginate()
-    for i in itr:
-        for account in i['Accounts']:
-            if account['Status'] == 'ACTIVE':
-                accounts[account['Id']] = account
-    return accounts
-
-
-def fetch_role_arn(session, account_id, rolename):
-    global arn_list
+    snapshot = OrganizationsOps(session).get_org_snapshot()
+    return {
+        account_id: account for account_id, account in
+        snapshot['Accounts'].items() if account['Status'] == 'ACTIVE'
+    }
+
+
+def fetch_role_arn(session, account_id, rolename, sink):
     iam = BotoFactory().get_capability(
         boto3.resource, session, 'iam', account_id=account_id
     )
     try:
         role = iam.Role(rolename)
         print(role.arn)
-        arn_list.append(role.arn)
+        sink.push({'AccountId': account_id, 'Arn': role.arn})
     except iam.meta.client.exceptions.NoSuchEntityException as e:
         log.warn(f"not found in {account_id}, {e}")
 
 
-def fetch_roles_with_trust(session, account_id, trusted_account_id):
-    global arn_list
+def fetch_roles_with_trust(session, account_id, trusted_account_id, sink):
     arns = IAMOps(session, account_id).list_roles_with_trust(
         trusted_account_id)
-    arn_list += arns
+    for arn in arns:
+        sink.push({'AccountId': account_id, 'Arn': arn})
+
+
+def fetch_roles_with_trust_org(session, accounts, trusted_account_id, sink,
+                               max_age=24 * 3600):
+    """
+    roles of all accounts that trust trusted_account_id, answered from the
+    saved trust graph when it is younger than max_age seconds
+    """
+    graph = TrustGraph.load(max_age=max_age)
+    if graph is None:
+        graph = build_trust_graph(session, accounts, max_age=max_age)
+        graph.save()
+    sink.push_many(graph.roles_trusting_account(trusted_account_id))
 
 
-def delete_role_from_arn(session, arn):
-    # must have official full ARN for role, e.g.
-    # arn:aws:iam::123456789012:role/OrganizationAccountAccessRole
-    print(f"Deleting {arn}")
-    account_id = arn[13:25]
-    rolename = arn[31:]
-    IAMOps(session, account_id).delete_role(rolename)
+def delete_roles_from_arns(session, arns, dry_run=True):
+    """
+    deletes roles together with their policies and instance profiles, one
+    state read per account. Must have official full ARNs for the roles, e.g.
+    arn:aws:iam::123456789012:role/OrganizationAccountAccessRole
+    """
+    plan = IAMPlan(session)
+    for arn in arns:
+        account_id = arn.split(':')[4]
+        rolename = arn.split('/')[-1]
+        plan.add(account_id, DeleteRole(rolename))
+    return __report_plan(plan, dry_run)
 
 
-def set_minimum_pw_policy(session, account_id):
+def set_minimum_pw_policy(session, accounts, dry_run=True):
     desired_pw_policy = {
         "MinimumPasswordLength": 16,
         "RequireNumbers": True,
@@ -115,13 +120,22 @@ def set_minimum_pw_policy(session, account_id):
         "PasswordReusePrevention": 10,
         "HardExpiry": True
     }
-    log.info(IAMOps(session, account_id).set_minimum_pw_policy(
-        desired_pw_policy
-    ))
+    plan = IAMPlan(session)
+    for account_id in accounts:
+        plan.add(account_id, SetPasswordPolicy(desired_pw_policy))
+    return __report_plan(plan, dry_run)
+
+
+def __report_plan(plan, dry_run):
+    report = plan.apply(dry_run=dry_run)
+    for row in report:
+        log.info(row)
+    print(f"{'Planned' if dry_run else 'Applied'} {len(report)} actions:")
+    __json_print(report)
+    return report
 
 
-def get_iam_pw_policy_inventory(session, account_id):
-    global pw_policy_inventory
+def get_iam_pw_policy_inventory(session, account_id, sink):
     iam_ops = IAMOps(session, account_id)
     desired_policy = {
             "MinimumPasswordLength": 16,
@@ -134,46 +148,52 @@ def get_iam_pw_policy_inventory(session, account_id):
             "PasswordReusePrevention": 10,
             "HardExpiry": True
     }
-    pw_policy_inventory[account_id] = iam_ops.compare_pw_policy(desired_policy)
+    sink.push({
+        'AccountId': account_id,
+        'Discrepancies': iam_ops.compare_pw_policy(desired_policy)
+    })
 
 
-def add_console_users_to_group(session, account_id, group_name):
+def add_console_users_to_group(session, accounts, group_name, dry_run=True):
     """
     adds all users with password (login profile) active to a specified group
     """
-    users_w_pw = IAMOps().get_all_iam_users_with_pw(session, account_id)
-    iam = BotoFactory().get_capability(
-        boto3.client, session, 'iam', account_id=account_id
-    )
-    for user in users_w_pw:
-        iam.add_user_to_group(
-            GroupName='RequireMFA',
-            UserName=user
-        )
-        log.info(f"Added {account_id}:{user} to {group_name}")
-        print(f"Added {account_id}:{user} to {group_name}")
+    plan = IAMPlan(session)
+    for account_id in accounts:
+        plan.add(account_id, AddConsoleUsersToGroup(group_name))
+    return __report_plan(plan, dry_run)
+
+
+def get_credential_report_inventory(session, accounts, sink):
+    """
+    password, MFA and access key data of every IAM user in the accounts, from
+    one credential report per account
+    """
+    reports = get_credential_reports(session, accounts)
+    for account_id, report in reports.items():
+        for user in report:
+            sink.push(dict(user, AccountId=account_id))
 
 
-def get_all_hosted_zones(session, account_id):
+def get_all_hosted_zones(session, account_id, sink):
     """
     get all HZ from a given account
     """
-    global hosted_zone_dict
     r53_client = BotoFactory().get_capability(
         boto3.client, session, 'route53', account_id=account_id
     )
-    hz = Route53Ops(client=r53_client).get_all_hosted_zones()
-    log.info(f"{account_id}: {hz}")
-    print(f"{account_id}: {hz}")
-    if len(hz) > 0:
-        hosted_zone_dict[account_id] = hz
+    hz = Route53Ops(client=r53_client).list_hosted_zones()
+    log.info(f"{account_id}: {[z['Name'] for z in hz]}")
+    print(f"{account_id}: {[z['Name'] for z in hz]}")
+    for zone in hz:
+        sink.push(dict(zone, AccountId=account_id))
 
 
-def get_all_cloudtrails(session, account_id):
+def get_all_cloudtrails(session, account_id, sink):
     """get all cloudtrails from an account"""
-    global cloudtrails_dict
-    cloudtrails_dict[account_id] = CloudtrailOps().get_all_cloudtrails_list(
-        session, account_id)
+    trails = CloudtrailOps().get_all_cloudtrails_list(session, account_id)
+    for trail in trails:
+        sink.push(dict(trail, AccountId=account_id))
 
 
 def delete_cloudtrail(session, account_id, region, ct_name):
@@ -183,70 +203,214 @@ def delete_cloudtrail(session, account_id, region, ct_name):
     )
 
 
+def analyze_cloudtrail_logs(source, sink, index=True, fields=None,
+                            **filters):
+    """
+    CloudTrail events from the log files under source, a directory or
+    s3://bucket/prefix, matching the EventFilter arguments, e.g.
+    analyze_cloudtrail_logs('logs', sink, event_names=['DeleteTrail'])
+    """
+    analyzer = CloudTrailLogAnalyzer(source, index=index)
+    sink.push_many(analyzer.events(EventFilter(**filters), fields=fields))
+
+
 def get_all_iam_users(session, account_id):
     return IAMOps(session, account_id).get_all_iam_users()
 
 
-def get_acm_email_validations(session, account_id, certificate_statuses):
+def get_acm_email_validations(session, account_id, certificate_statuses,
+                              sink):
     acm = ACMOps(session, account_id, certificate_status=certificate_statuses)
-    arn_list.extend(acm.get_all_email_validated_certs())
+    for arn in acm.get_all_email_validated_certs():
+        sink.push({'AccountId': account_id, 'CertificateArn': arn})
+
+
+def get_acm_certificates_region(session, account_id, region, sink):
+    acm = ACMOps(session, account_id, regions=[region])
+    sink.push_many(acm.describe_certificates(region))
+
+
+def get_subnets_region(account_id, region, sink):
+    for subnet in VPCOps(account_id).get_subnets(region):
+        sink.push(dict(subnet, AccountId=account_id, Region=region))
 
 
-def get_all_subnets_all_regions(session, account_id):
-    global subnets
-    result = VPCOps(session, account_id).get_all_subnets()
-    __json_print(result)
-    subnets += result
+def get_all_subnets_all_regions(account_id, sink):
+    vpc_ops = VPCOps(account_id)
+    for region in vpc_ops.get_all_regions():
+        get_subnets_region(account_id, region, sink)
 
 
-def get_all_vpn_connections_all_regions(account_id):
-    global vpns
-    result = VPCOps(account_id).get_all_vpn_connections()
-    if result is not None:
-        for r in result:
-            r['OwnerId'] = account_id
-        vpns += result
-        __json_print(result)
+def get_vpn_connections_region(account_id, region, sink):
+    for vpn in VPCOps(account_id).get_vpn_connections(region):
+        sink.push(dict(vpn, AccountId=account_id, Region=region))
 
 
-def cloudformation_inventory_all_regions(account_id):
-    global arn_list
-    cfn = CFNOps(account_id)
-    arn_list.extend(cfn.all_stacks_all_regions())
+def get_all_vpn_connections_all_regions(account_id, sink):
+    vpc_ops = VPCOps(account_id)
+    for region in vpc_ops.get_all_regions():
+        get_vpn_connections_region(account_id, region, sink)
+
+
+def cloudformation_inventory_all_regions(account_id, sink):
+    for region in CFNOps(account_id).get_all_regions():
+        cloudformation_inventory_region(account_id, region, sink)
+
+
+def cloudformation_inventory_region(account_id, region, sink):
+    for stack in CFNOps(account_id).stack_summaries_in_region(region):
+        sink.push(dict(stack, AccountId=account_id, Region=region))
 
 
 # --------------------------------------------------------------
 def main():
+    parser = argparse.ArgumentParser(
+        description='Inventory of every account and region of the '
+                    'organization, several collectors in one pass')
+    parser.add_argument(
+        '--collectors', nargs='+', default=['cfn_stacks'],
+        choices=sorted(COLLECTORS), metavar='COLLECTOR',
+        help=f"collectors to run, any of {', '.join(sorted(COLLECTORS))}, "
+             f"each writes out/<collector>.jsonl")
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='only re-describe what changed since the last run and write '
+             'the delta to out/<collector>_delta.jsonl')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='skip the (account, region) units completed by the previous, '
+             'interrupted run and keep their records, needs its journal')
+    parser.add_argument(
+        '--journal', nargs='?', const=JOURNAL, default=None,
+        help=f"journal the completed units so an interrupted run can be "
+             f"resumed, defaults to {JOURNAL}. Off unless given or resuming")
+    parser.add_argument(
+        '--output-dir', default='out',
+        help='directory of the JSONL outputs, defaults to out')
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help=f"number of worker processes to split the accounts between, "
+             f"each with its own thread pool and AWS clients, for "
+             f"organizations too large for one process. Defaults to 1, no "
+             f"worker processes; SHARDS ({SHARDS}) is one per CPU")
+    parser.add_argument(
+        '--async', dest='use_async', action='store_true',
+        help='run the collectors on one event loop with aiobotocore, for '
+             'thousands of requests in flight')
+    parser.add_argument(
+        '--query', nargs=2, metavar=('SERVICE', 'OPERATION'),
+        help='instead of the collectors, run one read-only operation in '
+             'every account and region, e.g. --query ec2 describe_subnets, '
+             'writes out/query_<operation>.jsonl')
+    parser.add_argument(
+        '--match', action='append', default=[], metavar='FIELD=VALUES',
+        help='keep items whose JMESPath FIELD (or tag:<Key>) is one of the '
+             'comma separated VALUES, pushed down to the API\'s Filters '
+             'where it supports them; repeat for several fields')
+    parser.add_argument(
+        '--where', help='JMESPath predicate the items must satisfy, '
+                        'e.g. "!Tags"')
+    parser.add_argument(
+        '--select', help='JMESPath projection of the items, e.g. '
+                         '"{Id: SubnetId, Vpc: VpcId}"')
+    parser.add_argument(
+        '--params', type=json.loads, default=None,
+        help='JSON parameters passed to every call of the query')
+    args = parser.parse_args()
+    if args.use_async and (args.incremental or args.resume or args.journal
+                           or args.processes > 1):
+        parser.error('--async runs without --incremental, --resume, '
+                     '--journal and --processes')
+    no_async = sorted(set(args.collectors) - set(ASYNC_COLLECTORS))
+    if args.use_async and no_async:
+        parser.error(
+            f"--async has no {', '.join(no_async)} collector, it runs "
+            f"{', '.join(sorted(ASYNC_COLLECTORS))}")
+    if args.query and (args.use_async or args.incremental or args.resume or
+                       args.journal or args.processes > 1):
+        parser.error('--query runs without --async, --incremental, '
+                     '--resume, --journal and --processes')
+    if args.resume and args.journal is None:
+        args.journal = JOURNAL
+    if any('=' not in m for m in args.match):
+        parser.error('--match takes FIELD=VALUES')
 
     session = boto3.Session(**SESSION_INFO)
-    accounts = OrganizationsOps(session).get_accounts_from_root()
+    org_ops = OrganizationsOps(session)
+    accounts = org_ops.get_accounts_from_root()
+
+    if args.query:
+        """one ad hoc question across the organization, e.g. every
+        security group open to the world"""
+        query = OrgQuery(
+            *args.query, params=args.params, where=args.where,
+            select=args.select, match={
+                field: values.split(',') for field, values in
+                (m.split('=', 1) for m in args.match)
+            }
+        )
+        failures = JobRunner(
+            session, [query.collector(session)], output_dir=args.output_dir,
+            max_workers=MAX_THREADS, max_per_account=MAX_THREADS_PER_ACCOUNT
+        ).run(accounts)
+        for account, region, collector, exc in failures:
+            print(f"Exception {collector} {account}:{region}: {str(exc)}")
+        metrics.write(args.output_dir)
+        return
 
     """use this for non-threaded testing since ThreadPoolExecutor is wonky
     with exceptions"""
-    # for account in account_set:
-    #     print(f"Processing account {account}")
-    #     get_all_vpn_connections_all_regions(account)
-
-    """run ThreadPoolExecutor"""
-    futures = dict()
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        for account in accounts:
-            log.info(f"Processing account {account}")
-            futures[account] = executor.submit(
-                cloudformation_inventory_all_regions, account
+    # with JSONLSink('out/vpns.jsonl') as sink:
+    #     for account in accounts:
+    #         print(f"Processing account {account}")
+    #         get_all_vpn_connections_all_regions(account, sink)
+
+    """every account is visited once, its credentials and enabled regions
+    are shared by all collectors"""
+    store = InventoryStore()
+    run_id = store.start_run('accounts')
+    store.insert_accounts(run_id, org_ops.get_org_snapshot())
+    store.finish_run(run_id)
+    journal = None
+    if args.journal is not None:
+        journal = RunJournal(args.journal, resume=args.resume)
+    try:
+        if args.use_async:
+            runner = AsyncJobRunner(
+                session, args.collectors, output_dir=args.output_dir,
+                store=store)
+        elif args.processes > 1:
+            runner = ShardedRunner(
+                SESSION_INFO, args.collectors, shards=args.processes,
+                output_dir=args.output_dir, max_workers=MAX_THREADS,
+                max_per_account=MAX_THREADS_PER_ACCOUNT,
+                incremental=args.incremental, journal=journal, store=store
             )
-
-    for a in futures:
-        try:
-            futures[a].result()
-        except Exception as e:
-            print(f"Exception {a}: {str(e)}")
-
-    global arn_list
-    with open('out/cfn_inventory.txt', 'w') as f:
-        for a in arn_list:
-            f.write(f"{a}\n")
+        else:
+            runner = JobRunner(
+                session, args.collectors, output_dir=args.output_dir,
+                max_workers=MAX_THREADS,
+                max_per_account=MAX_THREADS_PER_ACCOUNT,
+                incremental=args.incremental, journal=journal, store=store
+            )
+        failures = runner.run(accounts)
+    finally:
+        if journal is not None:
+            journal.close()
+    for account, region, collector, exc in failures:
+        print(f"Exception {collector} {account}:{region}: {str(exc)}")
+    # out/metrics.json and the out/metrics.prom textfile
+    metrics.write(args.output_dir)
 
 
 if __name__ == '__main__':
+    # set up logging to file - see previous section for more details. Only
+    # here, shard processes import this module and must not open a log
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        datefmt='%y-%m-%d %H:%M',
+        filename=f"log/{datetime.now()}.log",
+        filemode='w'
+        )
     main()
@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+from app.acm_ops import CertificateCache
+
+ARN = 'arn:aws:acm:eu-west-1:123456789012:certificate/1'
+IMPORTED = datetime(2024, 1, 1, tzinfo=timezone.utc)
+NOT_AFTER = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def certificate(**kwargs):
+    return dict({
+        'CertificateArn': ARN, 'DomainName': 'example.com',
+        'Type': 'IMPORTED', 'ImportedAt': IMPORTED, 'NotAfter': NOT_AFTER
+    }, **kwargs)
+
+
+def test_reimported_certificates_are_not_cached(tmp_path):
+    cache = CertificateCache(str(tmp_path / 'acm.jsonl'))
+    cache.put(certificate())
+
+    summary = {'CertificateArn': ARN, 'ImportedAt': IMPORTED,
+               'NotAfter': NOT_AFTER}
+    assert cache.get(ARN, summary)['DomainName'] == 'example.com'
+    assert cache.get(ARN, dict(
+        summary, ImportedAt=datetime(2024, 6, 1, tzinfo=timezone.utc))) \
+        is None
+    assert cache.get(ARN, dict(
+        summary, NotAfter=datetime(2026, 1, 1, tzinfo=timezone.utc))) is None
+
+
+def test_save_appends_only_new_entries(tmp_path):
+    path = tmp_path / 'acm.jsonl'
+    cache = CertificateCache(str(path))
+    cache.put(certificate())
+    cache.save()
+    cache.save()
+    cache.put(certificate(DomainName='example.org', ImportedAt=NOT_AFTER))
+    cache.save()
+
+    assert len(path.read_text().splitlines()) == 2
+    reloaded = CertificateCache(str(path))
+    assert reloaded.get(ARN)['DomainName'] == 'example.org'
+    assert reloaded.get(ARN, {'ImportedAt': IMPORTED,
+                              'NotAfter': NOT_AFTER}) is None
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from app import aio_ops
+from app.aio_ops import AsyncBotoFactory, InFlightLimiter
+
+
+def test_in_flight_limiter_bounds_the_run_and_every_account():
+    in_flight = {'total': 0, 'max': 0}
+    per_account = dict()
+
+    async def request(limiter, account_id):
+        async with limiter.slot(account_id):
+            in_flight['total'] += 1
+            per_account[account_id] = per_account.get(account_id, 0) + 1
+            in_flight['max'] = max(in_flight['max'], in_flight['total'])
+            assert per_account[account_id] <= 2
+            await asyncio.sleep(0.01)
+            per_account[account_id] -= 1
+            in_flight['total'] -= 1
+
+    async def run():
+        limiter = InFlightLimiter(max_in_flight=3, max_per_account=2)
+        await asyncio.gather(*[
+            request(limiter, account_id)
+            for account_id in ['1', '2', '3'] for _ in range(4)])
+
+    asyncio.run(run())
+
+    assert in_flight['max'] == 3
+
+
+def test_clients_are_set_up_a_few_at_a_time(monkeypatch):
+    pytest.importorskip('aiobotocore')
+    connecting = {'now': 0, 'max': 0}
+
+    class Client():
+        async def __aenter__(self):
+            connecting['now'] += 1
+            connecting['max'] = max(connecting['max'], connecting['now'])
+            await asyncio.sleep(0.01)
+            connecting['now'] -= 1
+            return self
+
+        async def __aexit__(self, *exc_info):
+            pass
+
+    monkeypatch.setattr(
+        aio_ops.credential_cache, 'get',
+        lambda session, account_id, rolename: {
+            'AccessKeyId': f"AKIA{account_id}", 'SecretAccessKey': 'test',
+            'SessionToken': 'test'})
+    monkeypatch.setattr(aio_ops.metrics, 'attach', lambda *args: None)
+
+    async def run():
+        factory = AsyncBotoFactory(None, max_connecting=2)
+        monkeypatch.setattr(
+            factory._aio_session, 'create_client',
+            lambda *args, **kwargs: Client())
+        clients = await asyncio.gather(*[
+            factory.client('ec2', str(account_id), 'Role', 'eu-west-1')
+            for account_id in range(6)])
+        await factory.close()
+        return clients
+
+    assert len(asyncio.run(run())) == 6
+    assert connecting['max'] == 2
@@ -0,0 +1,96 @@
+import csv
+import gzip
+import json
+import os
+import pytest
+from app.export import DROP, JSON, ExportWriter, flatten
+
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_flatten_nested_values():
+    record = {
+        'Id': 'vpn-1',
+        'Options': {'StaticRoutesOnly': True, 'Tunnel': {'Cidr': '10.0.0.0'}},
+        'Tags': [{'Key': 'Name', 'Value': 'office'}],
+        'Routes': ['10.1.0.0/16', '10.2.0.0/16'],
+        'Telemetry': [{'Status': 'UP'}]
+    }
+
+    assert flatten(record) == {
+        'Id': 'vpn-1',
+        'Options.StaticRoutesOnly': True,
+        'Options.Tunnel.Cidr': '10.0.0.0',
+        'Tags.Name': 'office',
+        'Routes': '10.1.0.0/16;10.2.0.0/16',
+        'Telemetry': '[{"Status": "UP"}]'
+    }
+    assert flatten(record, rules={'Options': JSON, 'Telemetry': DROP}) == {
+        'Id': 'vpn-1',
+        'Options': '{"StaticRoutesOnly": true, "Tunnel": {"Cidr": '
+                   '"10.0.0.0"}}',
+        'Tags.Name': 'office',
+        'Routes': '10.1.0.0/16;10.2.0.0/16'
+    }
+
+
+def test_csv_columns_are_inferred_from_the_sample(tmp_path):
+    path = str(tmp_path / 'subnets.csv')
+    records = [
+        {'SubnetId': 'subnet-1', 'Tags': [{'Key': 'Name', 'Value': 'a'}]},
+        {'SubnetId': 'subnet-2', 'VpcId': 'vpc-1'},
+        {'SubnetId': 'subnet-3', 'Late': 'left out'}
+    ]
+
+    assert ExportWriter(path, sample_size=2).write(iter(records)) == 3
+
+    rows = read_csv(path)
+    assert list(rows[0]) == ['SubnetId', 'Tags.Name', 'VpcId']
+    assert [r['SubnetId'] for r in rows] == [
+        'subnet-1', 'subnet-2', 'subnet-3']
+    assert rows[0]['Tags.Name'] == 'a'
+
+
+def test_csv_keeps_nested_values_of_explicit_fieldnames(tmp_path):
+    path = str(tmp_path / 'a.csv')
+    ExportWriter(path, fieldnames=['Id', 'Tags', 'Cfg']).write([{
+        'Id': 1,
+        'Tags': [{'Key': 'Name', 'Value': 'a'}],
+        'Cfg': {'a': 1}
+    }])
+
+    row = read_csv(path)[0]
+    assert row['Id'] == '1'
+    assert json.loads(row['Tags']) == [{'Key': 'Name', 'Value': 'a'}]
+    assert json.loads(row['Cfg']) == {'a': 1}
+
+
+def test_jsonl_gzip(tmp_path):
+    path = str(tmp_path / 'stacks.jsonl.gz')
+    ExportWriter(path).write({'StackId': str(n)} for n in range(3))
+
+    with gzip.open(path, 'rt') as f:
+        assert [json.loads(line)['StackId'] for line in f] == ['0', '1', '2']
+
+
+def test_failed_write_leaves_the_previous_file(tmp_path):
+    path = str(tmp_path / 'stacks.csv')
+    ExportWriter(path).write([{'StackId': 'old'}])
+    os.chmod(path, 0o640)
+
+    def records():
+        yield {'StackId': 'new'}
+        raise RuntimeError('interrupted')
+
+    with pytest.raises(RuntimeError):
+        ExportWriter(path).write(records())
+
+    assert read_csv(path) == [{'StackId': 'old'}]
+    assert os.listdir(str(tmp_path)) == ['stacks.csv']
+
+    ExportWriter(path).write([{'StackId': 'new'}])
+    assert read_csv(path) == [{'StackId': 'new'}]
+    assert os.stat(path).st_mode & 0o777 == 0o640
@@ -0,0 +1,94 @@
+import boto3
+import json
+from urllib.parse import quote
+from botocore.stub import Stubber
+from app.iam_ops import IAMOps
+from app.iam_snapshot import IAMSnapshot
+
+
+def iam_ops(monkeypatch, iam=None):
+    monkeypatch.setattr(
+        'app.iam_ops.BotoFactory.get_capability',
+        lambda self, *args, **kwargs: iam)
+    return IAMOps(None, '123456789012')
+
+
+def test_iter_users_from_snapshot_has_user_name(monkeypatch):
+    ops = iam_ops(monkeypatch)
+    ops.snapshot = IAMSnapshot('123456789012', users={
+        'alice': {'Arn': 'arn:aws:iam::123456789012:user/alice'},
+        'bob': {'Arn': 'arn:aws:iam::123456789012:user/bob'}
+    })
+
+    users = list(ops.iter_users())
+
+    assert sorted(u['UserName'] for u in users) == ['alice', 'bob']
+    assert all(u['AccountId'] == '123456789012' for u in users)
+    assert ops.get_all_iam_users() == {'alice', 'bob'}
+
+
+def test_iter_users_pages_list_users(monkeypatch):
+    iam = boto3.client(
+        'iam', region_name='us-east-1', aws_access_key_id='test',
+        aws_secret_access_key='test')
+    user = {
+        'Path': '/', 'UserId': 'AIDAEXAMPLE0000000001',
+        'Arn': 'arn:aws:iam::123456789012:user/alice',
+        'CreateDate': '2024-01-01T00:00:00Z'
+    }
+    with Stubber(iam) as stubber:
+        stubber.add_response('list_users', {
+            'Users': [dict(user, UserName='alice')],
+            'IsTruncated': True, 'Marker': 'm'})
+        stubber.add_response('list_users', {
+            'Users': [dict(user, UserName='bob')], 'IsTruncated': False},
+            {'Marker': 'm'})
+        ops = iam_ops(monkeypatch, iam)
+
+        assert [u['UserName'] for u in ops.iter_users()] == ['alice', 'bob']
+
+
+def test_list_roles_with_trust_compares_principals(monkeypatch):
+    iam = boto3.client(
+        'iam', region_name='us-east-1', aws_access_key_id='test',
+        aws_secret_access_key='test')
+
+    def role(name, statement):
+        return {
+            'Path': '/', 'RoleName': name, 'RoleId': 'AROAEXAMPLE0000000001',
+            'Arn': f"arn:aws:iam::123456789012:role/{name}",
+            'CreateDate': '2024-01-01T00:00:00Z',
+            # URL-encoded, as the API returns it
+            'AssumeRolePolicyDocument': quote(json.dumps({
+                'Version': '2012-10-17', 'Statement': [statement]}))
+        }
+
+    roles = [
+        role('trusted', {
+            'Effect': 'Allow', 'Action': 'sts:AssumeRole',
+            'Principal': {'AWS': 'arn:aws:iam::210987654321:root'}}),
+        role('by_id', {
+            'Effect': 'Allow', 'Action': 'sts:AssumeRole',
+            'Principal': {'AWS': ['210987654321']}}),
+        # the account only appears in a condition
+        role('condition', {
+            'Effect': 'Allow', 'Action': 'sts:AssumeRole',
+            'Principal': {'Service': 'ec2.amazonaws.com'},
+            'Condition': {'StringEquals': {
+                'aws:SourceAccount': '210987654321'}}}),
+        role('denied', {
+            'Effect': 'Deny', 'Action': 'sts:AssumeRole',
+            'Principal': {'AWS': 'arn:aws:iam::210987654321:root'}}),
+        role('longer_id', {
+            'Effect': 'Allow', 'Action': 'sts:AssumeRole',
+            'Principal': {'AWS': 'arn:aws:iam::2109876543210:root'}})
+    ]
+    with Stubber(iam) as stubber:
+        stubber.add_response(
+            'list_roles', {'Roles': roles, 'IsTruncated': False})
+        ops = iam_ops(monkeypatch, iam)
+
+        assert ops.list_roles_with_trust('210987654321') == [
+            'arn:aws:iam::123456789012:role/trusted',
+            'arn:aws:iam::123456789012:role/by_id'
+        ]
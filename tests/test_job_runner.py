@@ -0,0 +1,55 @@
+from botocore.exceptions import ClientError
+from app.collectors import Collector
+from app.job_runner import JobRunner
+
+
+class ListSink():
+    def __init__(self):
+        self.records = list()
+
+    def push(self, record):
+        self.records.append(record)
+
+    def push_many(self, records):
+        self.records.extend(records)
+
+    def flush(self):
+        pass
+
+
+def test_unreachable_accounts_are_failures(monkeypatch):
+    denied = ClientError(
+        {'Error': {'Code': 'AccessDenied', 'Message': 'denied'}},
+        'AssumeRole')
+    monkeypatch.setattr(
+        'app.job_runner.BotoFactory.prefetch_credentials',
+        lambda self, session, accounts: {
+            a: denied for a in accounts if a == '222222222222'})
+    collector = Collector(
+        'zones', lambda session, account_id, region: [{'Id': 'zone'}],
+        regional=False)
+    sinks = {'zones': ListSink()}
+
+    failures = JobRunner(None, [collector], sinks=sinks).run(
+        ['111111111111', '222222222222'])
+
+    assert failures == [('222222222222', None, None, denied)]
+    assert sinks['zones'].records == [
+        {'Id': 'zone', 'AccountId': '111111111111', 'Region': 'global'}]
+
+
+def test_collector_errors_are_failures(monkeypatch):
+    monkeypatch.setattr(
+        'app.job_runner.BotoFactory.prefetch_credentials',
+        lambda self, session, accounts: dict())
+    error = RuntimeError('boom')
+
+    def fetch(session, account_id, region):
+        raise error
+
+    failures = JobRunner(
+        None, [Collector('zones', fetch, regional=False)],
+        sinks={'zones': ListSink()}
+    ).run(['111111111111'])
+
+    assert failures == [('111111111111', 'global', 'zones', error)]
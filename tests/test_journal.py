@@ -0,0 +1,81 @@
+import json
+import pytest
+from app.collectors import Collector
+from app.job_runner import close_outputs, open_outputs
+from app.journal import RunJournal
+from app.sinks import JSONLSink
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def stacks(account_id, region, sink, fail=False):
+    for n in range(3):
+        sink.push({'StackId': f"{account_id}-{region}-{n}",
+                   'AccountId': account_id, 'Region': region})
+        if fail and n == 1:
+            raise RuntimeError('interrupted')
+
+
+def test_wrap_journals_the_count_and_skips_completed_units(tmp_path):
+    calls = list()
+
+    def fetch(account_id, region, sink):
+        calls.append((account_id, region))
+        stacks(account_id, region, sink)
+
+    with RunJournal(str(tmp_path / 'journal.jsonl')) as journal, \
+            JSONLSink(str(tmp_path / 'stacks.jsonl')) as sink:
+        task = journal.wrap('cfn_stacks', fetch, sink)
+        task('111111111111', 'eu-west-1')
+        task('111111111111', 'eu-west-1')
+        # the records are on disk before the unit is journaled
+        assert len(read_jsonl(tmp_path / 'stacks.jsonl')) == 3
+
+    assert calls == [('111111111111', 'eu-west-1')]
+    assert list(journal.entries()) == [{
+        'Task': 'cfn_stacks', 'AccountId': '111111111111',
+        'Region': 'eu-west-1', 'Records': 3
+    }]
+
+
+def test_resume_keeps_completed_units_and_redoes_the_rest(tmp_path):
+    collectors = [Collector('cfn_stacks', None)]
+    path = str(tmp_path / 'journal.jsonl')
+    output = tmp_path / 'cfn_stacks.jsonl'
+
+    with RunJournal(path) as journal:
+        sinks, run_ids = open_outputs(collectors, str(tmp_path),
+                                      journal=journal)
+        task = journal.wrap('cfn_stacks', stacks, sinks['cfn_stacks'])
+        task('111111111111', 'eu-west-1')
+        with pytest.raises(RuntimeError):
+            journal.wrap('cfn_stacks', lambda a, r, sink: stacks(
+                a, r, sink, fail=True), sinks['cfn_stacks'])(
+                    '222222222222', 'eu-west-1')
+        close_outputs(sinks, run_ids)
+    # the cut off unit's first records made it to the output
+    assert len(read_jsonl(output)) == 5
+
+    calls = list()
+
+    def fetch(account_id, region, sink):
+        calls.append(account_id)
+        stacks(account_id, region, sink)
+
+    with RunJournal(path, resume=True) as journal:
+        sinks, run_ids = open_outputs(collectors, str(tmp_path),
+                                      journal=journal)
+        task = journal.wrap('cfn_stacks', fetch, sinks['cfn_stacks'])
+        task('111111111111', 'eu-west-1')
+        task('222222222222', 'eu-west-1')
+        close_outputs(sinks, run_ids)
+
+    assert calls == ['222222222222']
+    ids = [r['StackId'] for r in read_jsonl(output)]
+    assert sorted(ids) == sorted(
+        f"{a}-eu-west-1-{n}" for a in ('111111111111', '222222222222')
+        for n in range(3))
+    assert not (tmp_path / 'cfn_stacks.jsonl.resumed').exists()
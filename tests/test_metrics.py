@@ -0,0 +1,55 @@
+import time
+import boto3
+from botocore.awsrequest import AWSResponse
+from app.metrics import MetricsRecorder
+
+
+class Raw():
+    def stream(self, **kwargs):
+        yield b''
+
+
+def test_latency_leaves_out_the_rate_limiter_wait():
+    recorder = MetricsRecorder()
+    sts = boto3.client(
+        'sts', region_name='us-east-1', aws_access_key_id='test',
+        aws_secret_access_key='test')
+    body = (
+        b'<GetCallerIdentityResponse><GetCallerIdentityResult>'
+        b'<Account>123456789012</Account></GetCallerIdentityResult>'
+        b'</GetCallerIdentityResponse>')
+
+    def send(request, **kwargs):
+        time.sleep(0.02)
+        response = AWSResponse(request.url, 200, {}, Raw())
+        response._content = body
+        return response
+
+    # the rate limiter takes its token when the request is created
+    sts.meta.events.register(
+        'request-created', lambda **kwargs: time.sleep(0.3))
+    sts.meta.events.register('before-send', send)
+    recorder.attach(sts, '123456789012', 'us-east-1')
+
+    assert sts.get_caller_identity()['Account'] == '123456789012'
+
+    call = recorder.summary()['calls'][0]
+    assert call['calls'] == 1
+    assert 0.02 <= call['latency_sum'] < 0.3
+
+
+def test_unit_durations_are_one_series_per_collector():
+    recorder = MetricsRecorder()
+    for account_id in ('111111111111', '222222222222'):
+        for region in ('eu-west-1', 'us-east-1'):
+            with recorder.unit('subnets', account_id, region):
+                pass
+
+    assert len(recorder.summary()['units']) == 4
+    lines = [
+        line for line in recorder.prometheus().splitlines()
+        if line.startswith('parseley_unit_duration_seconds')
+    ]
+    assert 'parseley_unit_duration_seconds_count{collector="subnets"} 4' \
+        in lines
+    assert not any('account' in line for line in lines)
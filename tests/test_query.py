@@ -0,0 +1,100 @@
+import boto3
+import pytest
+from botocore.stub import Stubber
+from app.query import OrgQuery
+
+
+def ec2_client():
+    return boto3.client(
+        'ec2', region_name='eu-west-1', aws_access_key_id='test',
+        aws_secret_access_key='test')
+
+
+def test_read_only_operations_only():
+    with pytest.raises(ValueError):
+        OrgQuery('ec2', 'delete_subnet')
+
+
+def test_match_is_pushed_down_into_filters():
+    params = {'Filters': [{'Name': 'owner-id', 'Values': ['123456789012']}]}
+    query = OrgQuery(
+        'ec2', 'describe_subnets', params=params,
+        match={'VpcId': 'vpc-1', 'tag:Team': ['b', 'a'],
+               'Ipv6Native': False})
+
+    assert query.pushed == {'VpcId', 'tag:Team'}
+    assert query.params['Filters'] == [
+        {'Name': 'owner-id', 'Values': ['123456789012']},
+        {'Name': 'vpc-id', 'Values': ['vpc-1']},
+        {'Name': 'tag:Team', 'Values': ['a', 'b']}
+    ]
+    # the caller's params are left alone
+    assert len(params['Filters']) == 1
+
+
+def test_list_parameters_take_the_values():
+    query = OrgQuery('cloudformation', 'list_stacks',
+                     match={'StackStatus': ['CREATE_COMPLETE']})
+
+    assert query.params == {'StackStatusFilter': ['CREATE_COMPLETE']}
+
+
+def test_matches_fields_tags_and_where():
+    query = OrgQuery(
+        'ec2', 'describe_security_groups',
+        match={'IpPermissions[].IpRanges[].CidrIp': ['0.0.0.0/0'],
+               'tag:Env': 'prod'},
+        where="GroupName != 'default'")
+    group = {
+        'GroupName': 'web',
+        'IpPermissions': [{'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}],
+        'Tags': [{'Key': 'Env', 'Value': 'prod'}]
+    }
+
+    assert query.matches(group)
+    assert not query.matches(dict(group, GroupName='default'))
+    assert not query.matches(dict(group, Tags=[]))
+    assert not query.matches(dict(group, IpPermissions=[
+        {'IpRanges': [{'CidrIp': '10.0.0.0/8'}]}]))
+
+
+def test_booleans_match_as_the_api_spells_them():
+    query = OrgQuery('ec2', 'describe_vpcs', match={'IsDefault': 'false'})
+
+    assert query.matches({'IsDefault': False})
+    assert not query.matches({'IsDefault': True})
+
+
+def test_project():
+    assert OrgQuery('ec2', 'describe_subnets').project({'A': 1}) == {'A': 1}
+    assert OrgQuery(
+        'ec2', 'describe_subnets', select='{Id: SubnetId}'
+    ).project({'SubnetId': 's-1', 'VpcId': 'v'}) == {'Id': 's-1'}
+    assert OrgQuery(
+        'ec2', 'describe_subnets', select='SubnetId'
+    ).project({'SubnetId': 's-1'}) == {'Value': 's-1'}
+
+
+def test_items_sends_the_pushed_down_filters_on_every_page():
+    query = OrgQuery(
+        'ec2', 'describe_subnets', match={'State': 'available'},
+        where="starts_with(CidrBlock, '10.')",
+        select='{SubnetId: SubnetId}')
+    filters = [{'Name': 'state', 'Values': ['available']}]
+    ec2 = ec2_client()
+    with Stubber(ec2) as stubber:
+        stubber.add_response('describe_subnets', {
+            'Subnets': [
+                {'SubnetId': 's-1', 'State': 'available',
+                 'CidrBlock': '10.0.0.0/24'},
+                {'SubnetId': 's-2', 'State': 'available',
+                 'CidrBlock': '172.16.0.0/24'}
+            ],
+            'NextToken': 'n'}, {'Filters': filters})
+        stubber.add_response('describe_subnets', {
+            'Subnets': [{'SubnetId': 's-3', 'State': 'available',
+                         'CidrBlock': '10.0.1.0/24'}]},
+            {'Filters': filters, 'NextToken': 'n'})
+
+        assert list(query.items(ec2)) == [
+            {'SubnetId': 's-1'}, {'SubnetId': 's-3'}]
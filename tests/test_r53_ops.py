@@ -0,0 +1,114 @@
+import threading
+import time
+import pytest
+from app.r53_ops import Route53Ops
+from app.rate_limiter import AdaptiveRateLimiter
+
+
+class Expression():
+    def __init__(self, expression):
+        self.expression = expression
+
+
+class Paginator():
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+        self.result_keys = [Expression(
+            'HostedZones' if operation == 'list_hosted_zones'
+            else 'ResourceRecordSets')]
+
+    def paginate(self, HostedZoneId=None):
+        if self.operation == 'list_hosted_zones':
+            yield {'HostedZones': self.client.zones}
+            return
+        records = self.client.records[HostedZoneId]
+        for start in range(0, len(records), self.client.page_size):
+            with self.client.lock:
+                self.client.calls.append(HostedZoneId)
+                self.client.in_flight += 1
+                self.client.max_in_flight = max(
+                    self.client.max_in_flight, self.client.in_flight)
+            time.sleep(0.01)
+            with self.client.lock:
+                self.client.in_flight -= 1
+            yield {'ResourceRecordSets':
+                   records[start:start + self.client.page_size]}
+
+
+class Route53():
+    """list_hosted_zones and list_resource_record_sets of a few zones"""
+
+    def __init__(self, zones=4, records=5, page_size=2):
+        self.page_size = page_size
+        self.zones = [
+            {'Id': f"/hostedzone/Z{z}", 'Name': f"z{z}.example.com.",
+             'ResourceRecordSetCount': records}
+            for z in range(zones)
+        ]
+        self.records = {
+            zone['Id']: [
+                {'Name': f"r{n}.{zone['Name']}", 'Type': 'A'}
+                for n in range(records)
+            ] for zone in self.zones
+        }
+        self.lock = threading.Lock()
+        self.calls = list()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr('app.json_cache.CACHE_DIR', str(tmp_path))
+
+
+def test_record_sets_of_every_zone_are_paged_concurrently():
+    client = Route53()
+
+    record_sets = list(Route53Ops(client, '123456789012').iter_record_sets(
+        max_workers=4))
+
+    assert len(record_sets) == 20
+    assert {(r['HostedZoneId'], r['Name']) for r in record_sets} == {
+        (zone['Id'], r['Name'])
+        for zone in client.zones for r in client.records[zone['Id']]
+    }
+    assert client.max_in_flight > 1
+
+
+def test_unchanged_zones_come_from_the_cache():
+    client = Route53()
+    list(Route53Ops(client).iter_record_sets())
+    client.calls.clear()
+
+    assert len(list(Route53Ops(client).iter_record_sets())) == 20
+    assert client.calls == []
+
+
+def test_stopping_early_skips_the_remaining_zones():
+    client = Route53(zones=20, records=10)
+
+    record_sets = Route53Ops(client).iter_record_sets(max_workers=2)
+    next(record_sets)
+    record_sets.close()
+    time.sleep(0.2)
+
+    assert len(set(client.calls)) < 20
+
+
+def test_route53_operations_share_one_bucket_per_account():
+    limiter = AdaptiveRateLimiter()
+
+    zones = limiter.bucket('route53', 'ListHostedZones', '1', 'us-east-1')
+    records = limiter.bucket(
+        'route53', 'ListResourceRecordSets', '1', 'eu-west-1')
+
+    assert zones is records
+    assert limiter.bucket('route53', 'ListHostedZones', '2', None) \
+        is not zones
+    assert limiter.bucket('ec2', 'DescribeSubnets', '1', 'eu-west-1') \
+        is not limiter.bucket('ec2', 'DescribeVpcs', '1', 'eu-west-1')